@@ -33,3 +33,8 @@ print('\n{0}\n'.format(cd.scan_file('/tmp/NO_EICAR')))
 print('\n{0}\n'.format(cd.scan_stream(cd.EICAR())))
 
 
+
+# scan several buffers in a session, on a single connection
+with cd.session() as session:
+    requests = [session.submit_scan_stream(cd.EICAR()) for i in range(10)]
+    print('\n{0}\n'.format([request.result() for request in requests]))
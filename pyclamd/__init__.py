@@ -5,9 +5,31 @@ import sys
 if sys.version_info[0] <= 2:
     from pyclamd import __version__
     from pyclamd import *
+    from pool import ClamdPool
+    from cache import CachingClamd, VerdictCache
+    from incremental import ScanIndex, scan_tree_incremental
+    from cluster import ClamdCluster
+    from hedge import HedgedClamd
+    from metrics import StatsPoller, Histogram, HistogramObserver
+    from admission import AdmissionController, OverloadError
+    from watch import Watcher, watch
+    from scheduler import PriorityScheduler, SchedulerLane
+    from singleflight import SingleFlightClamd
 elif sys.version_info[0] >= 3:
     from .pyclamd import __version__
     from .pyclamd import *
+    from .pool import ClamdPool
+    from .cache import CachingClamd, VerdictCache
+    from .incremental import ScanIndex, scan_tree_incremental
+    from .cluster import ClamdCluster
+    from .hedge import HedgedClamd
+    from .metrics import StatsPoller, Histogram, HistogramObserver
+    from .admission import AdmissionController, OverloadError
+    from .watch import Watcher, watch
+    from .scheduler import PriorityScheduler, SchedulerLane
+    from .singleflight import SingleFlightClamd
+    if sys.version_info >= (3, 5):
+        from .aio import AsyncClamd, AsyncClamdUnixSocket, AsyncClamdNetworkSocket, AsyncSingleFlightClamd
 
 
 
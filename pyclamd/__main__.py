@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+__main__.py - python -m pyclamd, see cli.py
+"""
+
+import sys
+
+from .cli import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
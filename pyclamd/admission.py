@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+admission.py - adaptive client-side concurrency limit (AIMD)
+
+Usage :
+
+  import pyclamd
+  cd = pyclamd.AdmissionController(pyclamd.ClamdAgnostic(), max_limit=32, queue_threshold=4, stats_interval=2.0)
+  cd.scan_stream(cd.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  cd.limit
+  # 8
+"""
+
+import collections
+import socket
+import threading
+import time
+
+from .pyclamd import scan_many
+from .metrics import StatsPoller
+
+
+############################################################################
+
+
+class OverloadError(Exception):
+    """
+    Class for errors when a request is refused locally because too many
+    requests are waiting for clamd. It is not a ConnectionError: clamd was
+    not reached, so ClamdPool, ClamdCluster and HedgedClamd do not take it
+    for a failure of a connection or of a node.
+    """
+
+
+
+class AdmissionController(object):
+    """
+    Client wrapper limiting the number of requests sent to clamd at the same
+    time, the limit being adjusted with AIMD (additive increase,
+    multiplicative decrease):
+      - each request completed in time while the limit is reached raises it
+        by 1/limit (about +1 per round of limit requests)
+      - a congestion signal multiplies it by backoff, at most once per
+        target latency: a request slower than the target latency, a
+        ConnectionError, or a STATS sample showing a clamd queue longer than
+        queue_threshold (the limit does not increase while it is so)
+
+    Requests over the limit wait for a slot, or fail at once with
+    OverloadError when max_waiting requests are already waiting or after
+    wait_timeout seconds.
+
+    The target latency is target_latency, or latency_tolerance times the
+    lowest recent latency if None. When scanned sizes vary a lot, an
+    explicit target_latency is better.
+
+    Other methods are those of the wrapped client, without limit.
+    """
+    # methods sending a request which are limited
+    _limited = frozenset(['ping', 'version', 'stats', 'get_stats', 'scan_file', 'contscan_file', 'multiscan_file',
+                          'scan_stream', 'scan_iter', 'scan_fileobj', 'scan_fd', 'scan_path_fildes'])
+
+    def __init__(self, client, initial_limit=8, min_limit=1, max_limit=64, backoff=0.5,
+                 target_latency=None, latency_tolerance=2.0, queue_threshold=None, stats_interval=None,
+                 max_waiting=None, wait_timeout=None):
+        """
+        client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool, ClamdCluster...
+        initial_limit, min_limit, max_limit (int) : concurrency limits
+        backoff (float) : factor applied to the limit on congestion
+        target_latency (float or None) : latency (seconds) above which a
+          request is a congestion signal, None to derive it from the lowest
+          recent latency
+        latency_tolerance (float) : target latency / lowest recent latency,
+          when target_latency is None
+        queue_threshold (int or None) : clamd queue length above which clamd
+          is congested, None to ignore the queue
+        stats_interval (float or None) : seconds between two STATS of the
+          client by a StatsPoller, None to only use observe_stats()
+        max_waiting (int or None) : requests allowed to wait for a slot, None
+          for no limit
+        wait_timeout (float or None) : longest wait for a slot, None to wait
+          forever
+        """
+        assert 1 <= min_limit <= initial_limit <= max_limit, 'Wrong value for limits, should be 1 <= min_limit <= initial_limit <= max_limit'
+        assert 0 < backoff < 1, 'Wrong value for [backoff], should be between 0 and 1 [was {0}]'.format(backoff)
+        assert latency_tolerance > 1, 'Wrong value for [latency_tolerance], should be > 1 [was {0}]'.format(latency_tolerance)
+
+        self.client = client
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.target_latency = target_latency
+        self.latency_tolerance = latency_tolerance
+        self.queue_threshold = queue_threshold
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+
+        self._lock = threading.Condition()
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        self._latencies = collections.deque(maxlen=100)
+        self._last_decrease = 0.0
+        self._queue_length = None
+
+        self._admitted = 0
+        self._rejected = 0
+        self._increases = 0
+        self._decreases = 0
+        self._wait_time = 0.0
+
+        self.poller = None
+        if stats_interval is not None:
+            self.poller = StatsPoller([client], interval=stats_interval, history=1, on_sample=self._on_stats)
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(self.client, name)
+        if name not in self._limited:
+            return attribute
+
+        def limited(*args, **kwargs):
+            return self._call(attribute, *args, **kwargs)
+        return limited
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def close(self):
+        """
+        Stop the StatsPoller, if any
+        """
+        if self.poller is not None:
+            self.poller.close()
+        return
+
+
+    def scan_many(self, items, concurrency=None, ordered=False):
+        """
+        See pyclamd.scan_many, at most the current limit of scans run at the
+        same time
+
+        concurrency (int or None) : number of threads, max_limit if None
+        """
+        return scan_many(self, items, concurrency=concurrency or self.max_limit, ordered=ordered)
+
+
+    @property
+    def limit(self):
+        """
+        (int) current concurrency limit
+        """
+        return int(self._limit)
+
+
+    def observe_stats(self, stats):
+        """
+        Take the clamd queue length into account
+
+        stats (ClamdStats) : STATS of clamd, e.g. from StatsPoller(on_sample=...)
+        """
+        with self._lock:
+            self._queue_length = stats.queue_length
+            if self._queue_congested():
+                self._decrease(time.time())
+        return
+
+
+    def admission_stats(self):
+        """
+        Get statistics about admission
+
+        return: (dict) with keys
+          - limit: current concurrency limit (float, its integer part is used)
+          - in_flight: requests sent to clamd
+          - waiting: requests waiting for a slot
+          - admitted: requests sent to clamd since creation
+          - rejected: requests refused with OverloadError
+          - increases, decreases: limit changes
+          - wait_time: total time spent waiting for a slot (seconds)
+          - target_latency: current target latency (seconds) or None
+          - queue_length: last clamd queue length observed or None
+        """
+        with self._lock:
+            return {
+                'limit': self._limit,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'increases': self._increases,
+                'decreases': self._decreases,
+                'wait_time': self._wait_time,
+                'target_latency': self._target(),
+                'queue_length': self._queue_length,
+                }
+
+
+    def _call(self, method, *args, **kwargs):
+        """
+        internal use only
+        runs method in a slot, adjusting the limit with its latency
+        """
+        self._acquire()
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except socket.error:
+            self._release(None)
+            raise
+        except:
+            # not a sign of congestion
+            self._release(time.time() - start, observe=False)
+            raise
+        self._release(time.time() - start)
+        return result
+
+
+    def _acquire(self):
+        """
+        internal use only
+        """
+        start = time.time()
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                if self.max_waiting is not None and self._waiting >= self.max_waiting:
+                    self._rejected += 1
+                    raise OverloadError('Too many requests waiting for clamd ({0})'.format(self._waiting))
+
+                self._waiting += 1
+                try:
+                    while self._in_flight >= int(self._limit):
+                        if self.wait_timeout is None:
+                            self._lock.wait()
+                            continue
+                        remaining = self.wait_timeout - (time.time() - start)
+                        if remaining <= 0:
+                            self._rejected += 1
+                            raise OverloadError('No slot for clamd after {0}s'.format(self.wait_timeout))
+                        self._lock.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                self._wait_time += time.time() - start
+
+            self._in_flight += 1
+            self._admitted += 1
+        return
+
+
+    def _release(self, latency, observe=True):
+        """
+        internal use only
+        latency is None for a failed request
+        """
+        with self._lock:
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight -= 1
+            if observe:
+                if latency is not None:
+                    self._latencies.append(latency)
+                target = self._target()
+                if latency is None or (target is not None and latency > target):
+                    self._decrease(time.time())
+                elif saturated and self._limit < self.max_limit and not self._queue_congested():
+                    # additive increase, only when the limit was reached
+                    self._limit = min(self._limit + 1.0 / self._limit, float(self.max_limit))
+                    self._increases += 1
+            self._lock.notify_all()
+        return
+
+
+    def _decrease(self, now):
+        """
+        internal use only
+        multiplicative decrease, self._lock being held
+        """
+        # requests sent before the previous decrease still complete late, one
+        # decrease per round trip
+        if now - self._last_decrease < (self._target() or 0.0):
+            return
+        self._last_decrease = now
+        limit = max(self._limit * self.backoff, float(self.min_limit))
+        if limit < self._limit:
+            self._limit = limit
+            self._decreases += 1
+        return
+
+
+    def _target(self):
+        """
+        internal use only
+        """
+        if self.target_latency is not None:
+            return self.target_latency
+        if len(self._latencies) < 10:
+            return None
+        return min(self._latencies) * self.latency_tolerance
+
+
+    def _queue_congested(self):
+        """
+        internal use only
+        """
+        return self.queue_threshold is not None and self._queue_length is not None and self._queue_length > self.queue_threshold
+
+
+    def _on_stats(self, name, stats):
+        """
+        internal use only
+        """
+        self.observe_stats(stats)
+        return
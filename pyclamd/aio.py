@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+aio.py - asyncio clients for clamd (Python >= 3.5)
+
+Usage :
+
+  import asyncio
+  import pyclamd
+  async def main():
+      cd = pyclamd.AsyncClamdNetworkSocket(max_concurrency=16)
+      print(await cd.ping())
+      print((await cd.scan_stream(cd.EICAR()))['stream'])
+  asyncio.run(main())
+  # True
+  # ('FOUND', 'Eicar-Test-Signature')
+"""
+
+import asyncio
+
+from .pyclamd import _ClamdGeneric, BufferTooLongError, ClamdStats, ConnectionError, isstr
+from .pyclamd import _assert_stream_type, _encode_command, _decode, _parse_scan_results, _unix_socket_from_conf
+from .pyclamd import _register_fork_safe, _check_fork, _limits_from_conf_for
+from .cache import content_digest
+from .singleflight import _file_key, _copy_result
+from .pyclamd import _stream_frames, _stream_view, _STREAM_END, DEFAULT_CHUNK_SIZE
+
+
+############################################################################
+
+
+class AsyncClamd(object):
+    """
+    Abstract class for asyncio clamd clients, with the same methods as
+    ClamdUnixSocket and ClamdNetworkSocket but as coroutines.
+
+    Each command uses its own connection. Cancelling a coroutine closes its
+    connection, which makes clamd abort the command.
+    """
+    # size of INSTREAM chunks, it MUST be < StreamMaxLength in clamd.conf
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    # size limits of clamd (ClamdLimits) checked before sending data, None
+    # when unknown
+    limits = None
+
+    def __init__(self, timeout=None, max_concurrency=None):
+        """
+        Generic initialisation
+
+        timeout (float or None) : timeout of a whole command
+        max_concurrency (int or None) : maximum number of commands running at
+          the same time, the other ones wait for their turn
+        """
+        assert isinstance(timeout, (float, int)) or timeout is None, 'Wrong type for [timeout], should be either None or a float [was {0}]'.format(type(timeout))
+        assert (isinstance(max_concurrency, int) and max_concurrency > 0) or max_concurrency is None, 'Wrong value for [max_concurrency], should be either None or a positive int [was {0}]'.format(max_concurrency)
+
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        _register_fork_safe(self)
+        return
+
+
+    def __getstate__(self):
+        """
+        Only the endpoint and its settings are pickled
+        """
+        return dict((name, value) for name, value in self.__dict__.items() if not name.startswith('_'))
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        AsyncClamd.__init__(self, self.timeout, self.max_concurrency)
+        return
+
+
+    def _after_fork(self):
+        """
+        internal use only
+        the semaphore is bound to an event loop of the parent process
+        """
+        self._semaphore = None
+        return
+
+
+    EICAR = _ClamdGeneric.EICAR
+    _stream_max_length = _ClamdGeneric._stream_max_length
+    _check_stream_length = _ClamdGeneric._check_stream_length
+
+
+    async def ping(self):
+        """
+        Send a PING to the clamav server, which should reply
+        by a PONG.
+
+        return: True if the server replies to PING
+
+        May raise:
+          - ConnectionError: if the server do not reply by PONG
+        """
+        result = await self._command('PING')
+        if result == 'PONG':
+            return True
+        raise ConnectionError('Could not ping clamd server [{0}]'.format(result))
+
+
+    async def version(self):
+        """
+        Get Clamscan version
+
+        return: (string) clamscan version
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return await self._command('VERSION')
+
+
+    async def stats(self):
+        """
+        Get Clamscan stats
+
+        return: (string) clamscan stats
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return '{0}\n'.format(await self._command('STATS'))
+
+
+    async def get_stats(self):
+        """
+        Get Clamscan stats, parsed
+
+        return: (ClamdStats)
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return ClamdStats(await self.stats())
+
+
+    async def reload(self):
+        """
+        Force Clamd to reload signature database
+
+        return: (string) "RELOADING"
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return await self._command('RELOAD')
+
+
+    async def scan_file(self, file):
+        """
+        Scan a file or directory given by filename and stop on first virus or error found.
+
+        See _ClamdGeneric.scan_file
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        result = await self._command('SCAN {0}'.format(file))
+        return _parse_scan_results(result.splitlines(), stop_on_error=True)
+
+
+    async def contscan_file(self, file):
+        """
+        Scan a file or directory given by filename, do not stop on error or
+        virus found.
+
+        See _ClamdGeneric.contscan_file
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        result = await self._command('CONTSCAN {0}'.format(file))
+        return _parse_scan_results(result.splitlines())
+
+
+    async def multiscan_file(self, file):
+        """
+        Scan a file or directory given by filename using multiple threads.
+
+        See _ClamdGeneric.multiscan_file
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        result = await self._command('MULTISCAN {0}'.format(file))
+        return _parse_scan_results(result.splitlines())
+
+
+    async def scan_stream(self, stream):
+        """
+        Scan a buffer or a stream of chunks
+
+        stream: either
+          - (bytes, bytearray or any object supporting the buffer protocol):
+            buffer to scan
+          - an async iterable or an iterable of bytes: chunks to scan, sent
+            to clamd as they come
+
+        return either:
+          - (dict): {filename1: "virusname"}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the stream size exceeds clamd limits,
+            before the chunk exceeding them is sent when limits are known
+          - ConnectionError: in case of communication problem
+        """
+        # a str is iterable but is not a stream of bytes
+        if isinstance(stream, str) or (not hasattr(stream, '__aiter__') and not hasattr(stream, '__iter__')):
+            _assert_stream_type(stream)
+        try:
+            self._check_stream_length(len(_stream_view(stream)))
+        except TypeError:
+            # chunks, checked while they are sent
+            pass
+        result = await self._command('INSTREAM', stream)
+        return _parse_scan_results(result.splitlines())
+
+
+    async def _open(self):
+        """
+        internal use only
+        returns (reader, writer) connected to clamd
+        """
+        raise NotImplementedError
+
+
+    async def _command(self, cmd, stream=None):
+        """
+        internal use only
+        sends a command, and an INSTREAM payload if stream is not None, and
+        returns the whole stripped reply of clamd
+        """
+        _check_fork(self)
+        if self.max_concurrency is not None and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if self._semaphore is None:
+            return await self._wait_for(self._run_command(cmd, stream))
+        async with self._semaphore:
+            return await self._wait_for(self._run_command(cmd, stream))
+
+
+    async def _wait_for(self, coroutine):
+        """
+        internal use only
+        """
+        if self.timeout is None:
+            return await coroutine
+        try:
+            return await asyncio.wait_for(coroutine, self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError('Timeout while waiting for clamd')
+
+
+    async def _run_command(self, cmd, stream):
+        """
+        internal use only
+        """
+        reader, writer = await self._open()
+        try:
+            try:
+                writer.write(_encode_command(cmd))
+                if stream is not None:
+                    await self._send_stream(writer, stream)
+                await writer.drain()
+            except OSError:
+                # clamd closes the connection when a stream exceeds
+                # StreamMaxLength, its reply is still worth reading
+                if stream is None:
+                    raise ConnectionError('Unable to send {0}'.format(cmd.split()[0]))
+
+            try:
+                data = await reader.read()
+            except OSError:
+                raise ConnectionError('Unable to read reply of {0}'.format(cmd.split()[0]))
+        finally:
+            writer.close()
+
+        if stream is not None and not data:
+            raise ConnectionError('Unable to scan stream')
+        return _decode(data).strip()
+
+
+    async def _send_stream(self, writer, stream):
+        """
+        internal use only
+        sends stream as INSTREAM chunks followed by the terminating zero
+        length chunk
+        """
+        try:
+            memoryview(stream)
+            chunks = [stream]
+        except TypeError:
+            chunks = stream
+
+        length = 0
+        if hasattr(chunks, '__aiter__'):
+            async for chunk in chunks:
+                length = await self._send_chunk(writer, chunk, length)
+        else:
+            for chunk in chunks:
+                length = await self._send_chunk(writer, chunk, length)
+
+        # Terminating stream
+        writer.write(_STREAM_END)
+        return
+
+
+    async def _send_chunk(self, writer, chunk, length):
+        """
+        internal use only
+        sends chunk, length bytes being already sent, and returns the length
+        sent with it
+
+        May raise:
+          - BufferTooLongError: if the stream would exceed the StreamMaxLength
+            of limits, before the chunk is sent
+        """
+        view = _stream_view(chunk)
+        length += len(view)
+        self._check_stream_length(length)
+        writer.writelines(list(_stream_frames(view, self.chunk_size)))
+        await writer.drain()
+        return length
+
+
+
+############################################################################
+
+
+class AsyncClamdUnixSocket(AsyncClamd):
+    """
+    asyncio client for clamd with an unix socket
+    """
+    def __init__(self, filename=None, timeout=None, max_concurrency=None, limits=None):
+        """
+        Unix Socket Class initialisation, no connection is made
+
+        filename (string) : unix socket filename or None to get the socket from /etc/clamav/clamd.conf or /etc/clamd.conf
+        timeout (float or None) : timeout of a whole command
+        max_concurrency (int or None) : maximum number of commands running at
+          the same time
+        limits (ClamdLimits or None) : size limits of clamd, None to read them
+          from clamd.conf when its LocalSocket is filename
+        """
+        if filename is None:
+            filename = _unix_socket_from_conf()
+
+        assert isstr(filename), 'Wrong type for [filename], should be a string [was {0}]'.format(type(filename))
+
+        AsyncClamd.__init__(self, timeout=timeout, max_concurrency=max_concurrency)
+        self.unix_socket = filename
+        self.limits = limits if limits is not None else _limits_from_conf_for(unix_socket=filename)
+        return
+
+
+    async def _open(self):
+        """
+        internal use only
+        """
+        try:
+            return await asyncio.open_unix_connection(self.unix_socket)
+        except OSError:
+            raise ConnectionError('Could not reach clamd using unix socket ({0})'.format((self.unix_socket)))
+
+
+
+class AsyncClamdNetworkSocket(AsyncClamd):
+    """
+    asyncio client for clamd with a network socket
+    """
+    def __init__(self, host='127.0.0.1', port=3310, timeout=None, max_concurrency=None, limits=None):
+        """
+        Network Class initialisation, no connection is made
+
+        host (string) : hostname or ip address
+        port (int) : TCP port
+        timeout (float or None) : timeout of a whole command
+        max_concurrency (int or None) : maximum number of commands running at
+          the same time
+        limits (ClamdLimits or None) : size limits of clamd, None to read them
+          from clamd.conf when host is local and its TCPSocket is port
+        """
+        assert isinstance(host, str), 'Wrong type for [host], should be a string [was {0}]'.format(type(host))
+        assert isinstance(port, int), 'Wrong type for [port], should be an int [was {0}]'.format(type(port))
+
+        AsyncClamd.__init__(self, timeout=timeout, max_concurrency=max_concurrency)
+        self.host = host
+        self.port = port
+        self.limits = limits if limits is not None else _limits_from_conf_for(host=host, port=port)
+        return
+
+
+    async def _open(self):
+        """
+        internal use only
+        """
+        try:
+            return await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            raise ConnectionError('Could not reach clamd using network ({0}, {1})'.format(self.host, self.port))
+
+
+
+############################################################################
+
+
+class AsyncSingleFlightClamd(object):
+    """
+    Wrapper of an asyncio client sending a scan only once when identical
+    scans are awaited at the same time, see SingleFlightClamd. The scan runs
+    in its own task: cancelling a caller does not cancel it for the others.
+
+    Other methods are those of the wrapped client.
+    """
+    def __init__(self, client):
+        """
+        client (AsyncClamdUnixSocket or AsyncClamdNetworkSocket) : wrapped
+          client
+        """
+        self.client = client
+
+        self._flights = {}
+        self._calls = 0
+        self._shared = 0
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+
+    async def scan_stream(self, stream):
+        """
+        See AsyncClamd.scan_stream, a buffer being scanned already is not
+        sent again. Iterables of chunks are always sent.
+        """
+        try:
+            memoryview(stream)
+        except TypeError:
+            return await self.client.scan_stream(stream)
+        return await self._do(('stream', content_digest(stream)), self.client.scan_stream, stream)
+
+
+    async def scan_file(self, file):
+        """
+        See AsyncClamd.scan_file, a file being scanned already is not scanned
+        again, directories always are
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        key = _file_key(file)
+        if key is None:
+            return await self.client.scan_file(file)
+        return await self._do(key, self.client.scan_file, file)
+
+
+    def flight_stats(self):
+        """
+        Get statistics about deduplication, see SingleFlightClamd.flight_stats
+        """
+        return {'calls': self._calls, 'shared': self._shared, 'in_flight': len(self._flights)}
+
+
+    async def _do(self, key, scan, *args):
+        """
+        internal use only
+        awaits the task of the scan with the same key, started if needed
+        """
+        self._calls += 1
+        task = self._flights.get(key)
+        if task is None:
+            task = self._flights[key] = asyncio.ensure_future(scan(*args))
+            task.add_done_callback(lambda done: self._landed(key, done))
+        else:
+            self._shared += 1
+        return _copy_result(await asyncio.shield(task))
+
+
+    def _landed(self, key, task):
+        """
+        internal use only
+        """
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # retrieved, not to be logged as never retrieved when every
+            # caller was cancelled
+            task.exception()
+        return
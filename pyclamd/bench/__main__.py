@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+__main__.py - runs the pyclamd benchmarks
+
+Usage :
+  python -m pyclamd.bench [--quick] [--json FILE]
+  python -m pyclamd.bench --unix /var/run/clamav/clamd.ctl
+  python -m pyclamd.bench --host 127.0.0.1 --port 3310
+
+Without --unix or --host, scans are sent to a FakeClamd on a unix socket,
+which measures pyclamd alone.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from ..pyclamd import ClamdUnixSocket, ClamdNetworkSocket
+from .fakeclamd import FakeClamd
+from .benchmarks import metadata, bench_connect, bench_session, bench_instream, bench_concurrent, bench_instream_framing, bench_reply_parsing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyclamd.bench', description='pyclamd benchmarks')
+    parser.add_argument('--unix', help='clamd unix socket, instead of the emulator')
+    parser.add_argument('--host', help='clamd host, instead of the emulator')
+    parser.add_argument('--port', default=3310, type=int, help='clamd port')
+    parser.add_argument('--tcp', action='store_true', help='emulator on TCP instead of a unix socket')
+    parser.add_argument('--latency', default=0.0, type=float, help='seconds added by the emulator to each command')
+    parser.add_argument('-n', '--count', default=1000, type=int, help='number of calls per benchmark')
+    parser.add_argument('--size', default=1024, type=int, help='size of scanned buffers')
+    parser.add_argument('--quick', action='store_true', help='fewer calls and smaller buffers')
+    parser.add_argument('--json', metavar='FILE', help='write results as JSON to FILE, - for stdout')
+    args = parser.parse_args(argv)
+
+    count = args.count
+    sizes = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+    chunk_sizes = [1024, 64 * 1024, 1024 * 1024]
+    if args.quick:
+        count = min(count, 100)
+        sizes = [1024, 64 * 1024, 1024 * 1024]
+
+    fake = None
+    directory = None
+    if args.unix:
+        target = 'unix:{0}'.format(args.unix)
+        cd = ClamdUnixSocket(args.unix)
+    elif args.host:
+        target = 'tcp://{0}:{1}'.format(args.host, args.port)
+        cd = ClamdNetworkSocket(args.host, args.port)
+    else:
+        if args.tcp:
+            fake = FakeClamd(latency=args.latency)
+        else:
+            directory = tempfile.mkdtemp()
+            fake = FakeClamd(unix_socket=os.path.join(directory, 'clamd.ctl'), latency=args.latency)
+        target = 'emulator {0}'.format(fake.endpoint)
+        cd = fake.client()
+
+    output = sys.stderr if args.json == '-' else sys.stdout
+    results = []
+    try:
+        for name, benchmark in [
+                ('connect', lambda: bench_connect(cd, count)),
+                ('session', lambda: bench_session(cd, count, args.size)),
+                ('instream', lambda: bench_instream(cd, sizes, chunk_sizes)),
+                ('concurrent', lambda: bench_concurrent(cd, count, args.size, [1, 4, 16])),
+                ('framing', lambda: bench_instream_framing(sizes, chunk_sizes)),
+                ('parsing', lambda: bench_reply_parsing(10000 if args.quick else 100000)),
+                ]:
+            for result in benchmark():
+                result['benchmark'] = name
+                results.append(result)
+                output.write('{0:<55} {1:>12.1f} {2}\n'.format(result['name'], result['value'], result['unit']))
+                output.flush()
+    finally:
+        if fake is not None:
+            fake.close()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    if args.json:
+        report = {'metadata': metadata(target), 'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as fileobj:
+                json.dump(report, fileobj, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
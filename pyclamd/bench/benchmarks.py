@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+benchmarks.py - pyclamd benchmarks
+
+Each benchmark returns a list of results, dicts with keys name, value and
+unit, the same for every run so that results of two runs can be compared.
+
+Usage :
+
+>>> from pyclamd.bench import FakeClamd, bench_connect
+>>> with FakeClamd() as fake:
+...     results = bench_connect(fake.client(), 100)
+>>> results[0]['unit']
+'calls/s'
+"""
+
+import platform
+import socket
+import struct
+import threading
+import time
+
+from ..pyclamd import __version__, _send_stream, _parse_reply, ReplyDecoder, _clock
+
+
+############################################################################
+
+
+def _result(name, value, unit):
+    """
+    internal use only
+    """
+    return {'name': name, 'value': value, 'unit': unit}
+
+
+def _timeit(func, count):
+    """
+    internal use only
+    runs func count times and returns the number of calls per second
+    """
+    start = _clock()
+    for i in range(count):
+        func()
+    return count / (_clock() - start)
+
+
+def metadata(target):
+    """
+    return: (dict) description of a benchmark run, for the JSON output
+    """
+    return {
+        'pyclamd': __version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'target': target,
+        }
+
+
+############################################################################
+
+
+def bench_connect(cd, count):
+    """
+    Measure connection setup: a connection alone, PING on its own connection
+    and PING in a session
+
+    cd : ClamdUnixSocket or ClamdNetworkSocket
+
+    return: list of results (calls/s)
+    """
+    def connect():
+        cd._connect().close()
+
+    results = [_result('connect', _timeit(connect, count), 'calls/s'),
+               _result('ping, one connection per call', _timeit(cd.ping, count), 'calls/s')]
+    with cd.session() as session:
+        results.append(_result('ping, session', _timeit(session.ping, count), 'calls/s'))
+    return results
+
+
+def bench_session(cd, count, size):
+    """
+    Compare one connection per call with IDSESSION, with and without
+    pipelining
+
+    return: list of results (scans/s)
+    """
+    buffer_to_test = b'x' * size
+    results = []
+
+    results.append(_result('scan_stream {0} bytes, one connection per call'.format(size), _timeit(lambda: cd.scan_stream(buffer_to_test), count), 'scans/s'))
+
+    with cd.session() as session:
+        results.append(_result('scan_stream {0} bytes, session'.format(size), _timeit(lambda: session.scan_stream(buffer_to_test), count), 'scans/s'))
+
+    with cd.session() as session:
+        start = _clock()
+        requests = [session.submit_scan_stream(buffer_to_test) for i in range(count)]
+        for request in requests:
+            request.result()
+        results.append(_result('scan_stream {0} bytes, session pipelined'.format(size), count / (_clock() - start), 'scans/s'))
+
+    return results
+
+
+def bench_instream(cd, sizes, chunk_sizes):
+    """
+    Measure INSTREAM throughput with clamd, across buffer and chunk sizes
+
+    return: list of results (MB/s)
+    """
+    results = []
+    for size in sizes:
+        buffer_to_test = b'x' * size
+        for chunk_size in chunk_sizes:
+            count = max(1, (16 * 1024 * 1024) // size)
+            start = _clock()
+            for i in range(count):
+                cd.scan_stream(buffer_to_test, chunk_size=chunk_size)
+            results.append(_result('scan_stream {0} bytes, chunk {1}'.format(size, chunk_size), size * count / (_clock() - start) / 1e6, 'MB/s'))
+    return results
+
+
+def bench_concurrent(cd, count, size, concurrencies):
+    """
+    Measure scan_many throughput across concurrency levels
+
+    return: list of results (scans/s)
+    """
+    items = [b'x' * size] * count
+    results = []
+    for concurrency in concurrencies:
+        start = _clock()
+        for result in cd.scan_many(items, concurrency=concurrency):
+            if result.error is not None:
+                raise result.error
+        results.append(_result('scan_many {0} bytes, concurrency {1}'.format(size, concurrency), count / (_clock() - start), 'scans/s'))
+    return results
+
+
+############################################################################
+
+
+def _legacy_send_stream(clamd_socket, buffer_to_test):
+    """
+    internal use only
+    INSTREAM framing of pyclamd <= 0.3.14, for comparison
+    """
+    max_chunk_size = 1024
+    chunks_left = buffer_to_test
+    while len(chunks_left)>0:
+        chunk = chunks_left[:max_chunk_size]
+        chunks_left = chunks_left[max_chunk_size:]
+        clamd_socket.send(struct.pack('!L', len(chunk)))
+        clamd_socket.send(chunk)
+    clamd_socket.send(struct.pack('!L', 0))
+
+
+def _sink():
+    """
+    internal use only
+    returns (socket, thread) where everything sent on socket is read and
+    dropped by thread
+    """
+    client, server = socket.socketpair()
+    def drain():
+        while server.recv(1024 * 1024):
+            pass
+        server.close()
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return client, thread
+
+
+def bench_instream_framing(sizes, chunk_sizes):
+    """
+    Measure INSTREAM framing throughput on a local socket, without clamd
+
+    return: list of results (MB/s)
+    """
+    results = []
+    for size in sizes:
+        buffer_to_test = b'x' * size
+        engines = [('chunk {0}'.format(chunk_size), lambda sock, c=chunk_size: _send_stream(sock, buffer_to_test, c)) for chunk_size in chunk_sizes]
+        if size <= 1024 * 1024:
+            # the legacy framing copies the rest of the buffer for each chunk
+            engines.insert(0, ('legacy', lambda sock: _legacy_send_stream(sock, buffer_to_test)))
+        for engine_name, engine in engines:
+            count = max(1, (64 * 1024 * 1024) // size)
+            sock, thread = _sink()
+            start = _clock()
+            for i in range(count):
+                engine(sock)
+            elapsed = _clock() - start
+            sock.close()
+            thread.join()
+            results.append(_result('INSTREAM framing {0} bytes, {1}'.format(size, engine_name), size * count / elapsed / 1e6, 'MB/s'))
+    return results
+
+
+def _legacy_parse_response(msg):
+    """
+    internal use only
+    reply line parsing of pyclamd <= 0.3.14, for comparison
+    """
+    msg = msg.strip()
+    filename = msg.split(': ')[0]
+    left = msg.split(': ')[1:]
+    result = ": ".join(left)
+    if result != 'OK':
+        parts = result.split()
+        reason = ' '.join(parts[:-1])
+        status = parts[-1]
+    else:
+        reason, status = '', 'OK'
+    return filename, reason, status
+
+
+def _legacy_parse_reply(reads):
+    """
+    internal use only
+    reply decoding of pyclamd <= 0.3.14: each read decoded and split into
+    lines (a line split between two reads gives two broken lines)
+    """
+    for data in reads:
+        for line in bytes.decode(data).strip().splitlines():
+            yield _legacy_parse_response(line)
+
+
+def _codec_parse_reply(reads):
+    """
+    internal use only
+    reply decoding with ReplyDecoder
+    """
+    decoder = ReplyDecoder()
+    for data in reads:
+        for line in decoder.feed(data):
+            yield _parse_reply(line)
+    for line in decoder.flush():
+        yield _parse_reply(line)
+
+
+def _codec_parse_reply_skip_ok(reads):
+    """
+    internal use only
+    reply decoding with ReplyDecoder, OK lines skipped before being parsed as
+    iter_contscan does
+    """
+    decoder = ReplyDecoder()
+    for data in reads:
+        for line in decoder.feed(data):
+            if not line.endswith(b' OK'):
+                yield _parse_reply(line)
+
+
+def bench_reply_parsing(count):
+    """
+    Measure the parsing of CONTSCAN replies, without clamd
+
+    return: list of results (lines/s)
+    """
+    lines = []
+    for i in range(count):
+        if i % 10 == 0:
+            lines.append('/srv/data/dir{0}/file{1}.bin: Eicar-Test-Signature FOUND\n'.format(i % 97, i))
+        elif i % 10 == 1:
+            lines.append('/srv/data/dir{0}/file{1}.bin: lstat() failed: No such file or directory. ERROR\n'.format(i % 97, i))
+        else:
+            lines.append('/srv/data/dir{0}/file{1}.bin: OK\n'.format(i % 97, i))
+    reply = ''.join(lines).encode()
+    reads = [reply[start:start + 4096] for start in range(0, len(reply), 4096)]
+
+    # the legacy parsing only works when reads end on line boundaries
+    aligned_reads, read = [], ''
+    for line in lines:
+        if len(read) + len(line) > 4096:
+            aligned_reads.append(read.encode())
+            read = ''
+        read += line
+    aligned_reads.append(read.encode())
+
+    results = []
+    for name, parse, data in [('legacy _parse_response', _legacy_parse_reply, aligned_reads), ('ReplyDecoder + _parse_reply', _codec_parse_reply, reads), ('ReplyDecoder, OK lines skipped', _codec_parse_reply_skip_ok, reads)]:
+        start = _clock()
+        for result in parse(data):
+            pass
+        results.append(_result('reply parsing, {0}'.format(name), count / (_clock() - start), 'lines/s'))
+    return results
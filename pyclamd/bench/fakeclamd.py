@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+fakeclamd.py - in-process clamd protocol emulator, for tests and benchmarks
+
+It answers PING, VERSION, RELOAD, STATS, SCAN, CONTSCAN, MULTISCAN, INSTREAM,
+FILDES (unix socket) and IDSESSION/END, with n, z or no command prefix, and
+finds the signatures it is given (EICAR by default) in scanned data.
+
+Usage :
+
+>>> from pyclamd.bench import FakeClamd
+>>> with FakeClamd(latency=0.001) as fake:
+...     cd = fake.client()
+...     print(cd.scan_stream(cd.EICAR()))
+{'stream': ('FOUND', 'Eicar-Test-Signature')}
+"""
+
+import array
+import base64
+import os
+import socket
+import struct
+import threading
+import time
+
+from ..pyclamd import ClamdUnixSocket, ClamdNetworkSocket
+
+
+############################################################################
+
+
+DEFAULT_VERSION = 'ClamAV 0.103.8/26900/Mon Jan  2 09:00:00 2023'
+
+# EICAR test string, encoded for skipping virus scanners
+EICAR = base64.b64decode('WDVPIVAlQEFQWzRcUFpYNTQoUF4pN0NDKTd9JEVJQ0FSLVNUQU5EQVJELUFOVElWSVJVUy1URVNU\nLUZJTEUhJEgrSCo=\n'.encode('ascii'))
+
+
+class _Connection(object):
+    """
+    internal use only
+    reader of a client connection. Nothing is read ahead, so that the file
+    descriptor following FILDES is received by recvmsg.
+    """
+    def __init__(self, client_socket):
+        self.socket = client_socket
+        return
+
+
+    def read(self, size):
+        """
+        returns exactly size bytes, less if the client closed the connection
+        """
+        data = bytearray()
+        while len(data) < size:
+            received = self.socket.recv(size - len(data))
+            if not received:
+                break
+            data += received
+        return bytes(data)
+
+
+    def read_command(self):
+        """
+        returns (command, terminator) or (None, None) when the client closed
+        the connection
+        """
+        command = bytearray()
+        while True:
+            data = self.socket.recv(4096, socket.MSG_PEEK)
+            if not data:
+                if not command:
+                    return None, None
+                break
+            if not command and data[:1] == b'z':
+                terminator = b'\0'
+            elif not command:
+                terminator = b'\n'
+            index = data.find(terminator)
+            if index >= 0:
+                command += self.socket.recv(index + 1)[:index]
+                break
+            command += self.socket.recv(len(data))
+
+        if command[:1] in (b'n', b'z'):
+            del command[:1]
+        return bytes(command).decode('utf-8', 'replace'), terminator
+
+
+
+class FakeClamd(object):
+    """
+    clamd emulator serving in a background thread, on a unix socket or on
+    TCP, each connection in its own thread
+    """
+    def __init__(self, unix_socket=None, host='127.0.0.1', port=0, latency=0.0, throughput=None,
+                 max_threads=10, stream_max_length=25 * 1024 * 1024, signatures=None, version=DEFAULT_VERSION):
+        """
+        unix_socket (string or None) : unix socket filename, None for TCP
+        host (string), port (int) : TCP address, port 0 for any free port
+        latency (float) : seconds added to the processing of each command
+        throughput (float or None) : bytes per second scanned, None for
+          unlimited
+        max_threads (int) : commands processed at the same time, the other
+          ones wait in queue (reported by STATS)
+        stream_max_length (int) : StreamMaxLength, longer INSTREAM are refused
+        signatures (dict or None) : {bytes: virus name}, EICAR if None
+        version (string) : reply to VERSION
+        """
+        self.unix_socket = unix_socket
+        self.latency = latency
+        self.throughput = throughput
+        self.max_threads = max_threads
+        self.stream_max_length = stream_max_length
+        self.signatures = signatures if signatures is not None else {EICAR: 'Eicar-Test-Signature'}
+        self.version = version
+
+        self.connections = 0
+        self.commands = 0
+        self.reloads = 0
+
+        self._lock = threading.Lock()
+        self._threads = threading.Semaphore(max_threads)
+        self._busy = 0
+        self._queued = 0
+        self._closed = False
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(unix_socket)
+            self.address = unix_socket
+        else:
+            self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._server.bind((host, port))
+            self.address = self._server.getsockname()
+        self._server.listen(128)
+
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    @property
+    def endpoint(self):
+        """
+        (string) endpoint of the emulator, see cluster.parse_endpoint
+        """
+        if self.unix_socket is not None:
+            return 'unix:{0}'.format(self.unix_socket)
+        return 'tcp://{0}:{1}'.format(*self.address)
+
+
+    def client(self, timeout=None):
+        """
+        return: a ClamdUnixSocket or ClamdNetworkSocket connected to the
+          emulator
+        """
+        if self.unix_socket is not None:
+            return ClamdUnixSocket(self.unix_socket, timeout=timeout)
+        return ClamdNetworkSocket(self.address[0], self.address[1], timeout=timeout)
+
+
+    def close(self):
+        """
+        Stop accepting connections
+        """
+        self._closed = True
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server.close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        return
+
+
+    def scan(self, data):
+        """
+        return: (string) name of the first signature found in data, or None
+        """
+        for signature, name in self.signatures.items():
+            if signature in data:
+                return name
+        return None
+
+
+    def _serve(self):
+        """
+        internal use only
+        """
+        while not self._closed:
+            try:
+                client_socket, address = self._server.accept()
+            except socket.error:
+                return
+            with self._lock:
+                self.connections += 1
+            thread = threading.Thread(target=self._handle, args=(client_socket,))
+            thread.daemon = True
+            thread.start()
+        return
+
+
+    def _handle(self, client_socket):
+        """
+        internal use only
+        serves the commands of one connection
+        """
+        connection = _Connection(client_socket)
+        session = False
+        request_id = 0
+        try:
+            while True:
+                command, terminator = connection.read_command()
+                if command is None:
+                    break
+                if command == 'IDSESSION':
+                    session = True
+                    continue
+                if command == 'END':
+                    break
+
+                request_id += 1
+                lines, keep_open = self._process(command, connection)
+                if session:
+                    lines[0] = '{0}: {1}'.format(request_id, lines[0])
+                client_socket.sendall(b''.join(line.encode('utf-8') + terminator for line in lines))
+                if not session or not keep_open:
+                    break
+        except socket.error:
+            pass
+        finally:
+            client_socket.close()
+        return
+
+
+    def _process(self, command, connection):
+        """
+        internal use only
+        returns (reply lines, connection may stay open)
+        """
+        with self._lock:
+            self.commands += 1
+            self._queued += 1
+        self._threads.acquire()
+        with self._lock:
+            self._queued -= 1
+            self._busy += 1
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self._reply(command, connection)
+        finally:
+            with self._lock:
+                self._busy -= 1
+            self._threads.release()
+
+
+    def _reply(self, command, connection):
+        """
+        internal use only
+        """
+        name, sep, argument = command.partition(' ')
+        if name == 'PING':
+            return ['PONG'], True
+        if name == 'VERSION':
+            return [self.version], True
+        if name == 'RELOAD':
+            self.reloads += 1
+            return ['RELOADING'], True
+        if name == 'STATS':
+            return self._stats(), True
+        if name == 'INSTREAM':
+            return self._instream(connection)
+        if name == 'FILDES':
+            return self._fildes(connection), True
+        if name in ('SCAN', 'CONTSCAN', 'MULTISCAN'):
+            return self._scan_path(argument, stop=(name == 'SCAN')), True
+        return ['UNKNOWN COMMAND'], False
+
+
+    def _stats(self):
+        """
+        internal use only
+        """
+        with self._lock:
+            busy, queued = self._busy, self._queued
+        return ['POOLS: 1',
+                'STATE: VALID PRIMARY',
+                'THREADS: live {0}  idle {1} max {2} idle-timeout 30'.format(busy, self.max_threads - busy, self.max_threads),
+                'QUEUE: {0} items'.format(queued)] + ['\tINSTREAM 0.000100'] * queued + [
+                'MEMSTATS: heap 9.082M mmap 0.000M used 6.902M free 2.184M releasable 0.129M pools 1 pools_used 565.979M pools_total 565.999M',
+                'END']
+
+
+    def _throttle(self, size):
+        """
+        internal use only
+        """
+        if self.throughput:
+            time.sleep(size / float(self.throughput))
+        return
+
+
+    def _instream(self, connection):
+        """
+        internal use only
+        """
+        data = bytearray()
+        while True:
+            header = connection.read(4)
+            if len(header) < 4:
+                return ['stream: Unexpected end of stream. ERROR'], False
+            size = struct.unpack('!L', header)[0]
+            if size == 0:
+                break
+            if len(data) + size > self.stream_max_length:
+                return ['INSTREAM size limit exceeded. ERROR'], False
+            data += connection.read(size)
+        self._throttle(len(data))
+        virus = self.scan(bytes(data))
+        if virus is None:
+            return ['stream: OK'], True
+        return ['stream: {0} FOUND'.format(virus)], True
+
+
+    def _fildes(self, connection):
+        """
+        internal use only
+        """
+        message, ancillary, flags, address = connection.socket.recvmsg(1, socket.CMSG_LEN(array.array('i').itemsize))
+        fds = array.array('i')
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:fds.itemsize])
+        if not fds:
+            return ['No file descriptor received. ERROR']
+        fd = fds[0]
+        chunks = []
+        try:
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        data = b''.join(chunks)
+        self._throttle(len(data))
+        virus = self.scan(data)
+        if virus is None:
+            return ['fd[{0}]: OK'.format(fd)]
+        return ['fd[{0}]: {1} FOUND'.format(fd, virus)]
+
+
+    def _scan_path(self, path, stop):
+        """
+        internal use only
+        """
+        if os.path.isdir(path):
+            filenames = []
+            for dirpath, dirnames, names in os.walk(path):
+                dirnames.sort()
+                # like clamd, sockets, fifos and devices are skipped
+                filenames.extend(filename for filename in (os.path.join(dirpath, name) for name in sorted(names)) if os.path.isfile(filename))
+        elif os.path.exists(path):
+            filenames = [path]
+        else:
+            return ['{0}: lstat() failed: No such file or directory. ERROR'.format(path)]
+
+        lines = []
+        for filename in filenames:
+            try:
+                with open(filename, 'rb') as fileobj:
+                    data = fileobj.read()
+            except (IOError, OSError):
+                lines.append('{0}: Access denied. ERROR'.format(filename))
+                if stop:
+                    break
+                continue
+            self._throttle(len(data))
+            virus = self.scan(data)
+            if virus is not None:
+                lines.append('{0}: {1} FOUND'.format(filename, virus))
+                if stop:
+                    break
+        if not lines:
+            lines.append('{0}: OK'.format(path))
+        return lines
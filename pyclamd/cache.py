@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+cache.py - verdict cache keyed by content digest and signature database version
+
+Usage :
+
+  import pyclamd
+  cd = pyclamd.CachingClamd(pyclamd.ClamdAgnostic(), pyclamd.VerdictCache(maxsize=10000, ttl=3600))
+  cd.scan_stream(cd.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  cd.scan_stream(cd.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  cd.cache.cache_stats()['hits']
+  # 1
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from .pyclamd import isstr, _assert_stream_type, _stream_view, _iter_fileobj, DEFAULT_CHUNK_SIZE
+
+
+############################################################################
+
+
+def content_digest(buffer_to_test):
+    """
+    Digest of a buffer used as cache key. hashlib releases the GIL while
+    hashing buffers larger than 2047 bytes, other threads keep running.
+
+    buffer_to_test : any object supporting the buffer protocol
+
+    return: (string) hexadecimal SHA-256 digest
+    """
+    return hashlib.sha256(_stream_view(buffer_to_test)).hexdigest()
+
+
+def file_digest(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Digest of the content of a file, read by chunks
+
+    file (string) : filename
+
+    return: (string) hexadecimal SHA-256 digest
+
+    May raise:
+      - IOError: if the file can not be read
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as fileobj:
+        for chunk in _iter_fileobj(fileobj, chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def db_version(version):
+    """
+    Signature database part of the reply to VERSION
+
+    version (string) : reply of clamd, e.g. 'ClamAV 0.103.8/26900/Mon Jan  2 09:00:00 2023'
+
+    return: (string) engine and database versions, e.g. 'ClamAV 0.103.8/26900'
+    """
+    return '/'.join(version.split('/')[:2])
+
+
+############################################################################
+
+
+class VerdictCache(object):
+    """
+    Thread-safe LRU cache of verdicts, with an optional time to live, for a
+    given signature database version
+    """
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        Cache initialisation
+
+        maxsize (int) : maximum number of verdicts kept, the least recently
+          used ones are evicted first
+        ttl (float or None) : verdicts older than ttl seconds are not used
+        """
+        assert isinstance(maxsize, int) and maxsize > 0, 'Wrong value for [maxsize], should be a positive int [was {0}]'.format(maxsize)
+        assert isinstance(ttl, (float, int)) or ttl is None, 'Wrong type for [ttl], should be either None or a float [was {0}]'.format(type(ttl))
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db_version = None
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+        return
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key):
+        """
+        Get a verdict
+
+        key (string) : content digest
+
+        return: (found, verdict) where verdict is ('FOUND', 'virusname') or
+          None for a clean content
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and entry[0] < time.time():
+                del self._entries[key]
+                self._expirations += 1
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+                return False, None
+
+            self._hits += 1
+            self._move_to_end(key)
+            return True, entry[1]
+
+
+    def put(self, key, verdict):
+        """
+        Store a verdict
+
+        key (string) : content digest
+        verdict : ('FOUND', 'virusname') or None for a clean content
+        """
+        expiry = None
+        if self.ttl is not None:
+            expiry = time.time() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (expiry, verdict)
+            self._move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return
+
+
+    def set_db_version(self, version):
+        """
+        Set the signature database version the verdicts belong to, the cache
+        is cleared if it changed
+
+        version (string) : database version, see db_version()
+        """
+        with self._lock:
+            if version != self.db_version:
+                if self.db_version is not None:
+                    self._invalidations += 1
+                self.db_version = version
+                self._entries.clear()
+        return
+
+
+    def clear(self):
+        """
+        Remove every verdict
+        """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+        return
+
+
+    def cache_stats(self):
+        """
+        Get statistics about the cache
+
+        return: (dict) with keys
+          - size: verdicts in the cache
+          - hits: lookups which found a verdict
+          - misses: lookups which did not
+          - evictions: verdicts removed because the cache was full
+          - expirations: verdicts removed because older than ttl
+          - invalidations: times the cache was cleared (database change)
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+                }
+
+
+    def _move_to_end(self, key):
+        """
+        internal use only
+        """
+        try:
+            self._entries.move_to_end(key)
+        except AttributeError:
+            # Python2
+            self._entries[key] = self._entries.pop(key)
+        return
+
+
+
+############################################################################
+
+
+class CachingClamd(object):
+    """
+    Client wrapper answering scan_stream and scan_file from a VerdictCache
+    when the same content was already scanned with the same signature
+    database. Other methods are those of the wrapped client.
+
+    The database version is checked with VERSION at most every
+    version_check_interval seconds, and right after reload().
+    """
+    def __init__(self, client, cache=None, version_check_interval=60.0):
+        """
+        client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool...
+        cache (VerdictCache or None) : cache to use, a new one if None
+        version_check_interval (float) : seconds between two VERSION checks
+        """
+        assert isinstance(version_check_interval, (float, int)), 'Wrong type for [version_check_interval], should be a float [was {0}]'.format(type(version_check_interval))
+
+        if cache is None:
+            cache = VerdictCache()
+        self.client = client
+        self.cache = cache
+        self.version_check_interval = version_check_interval
+
+        self._lock = threading.Lock()
+        self._last_check = None
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+
+    def reload(self):
+        """
+        Force Clamd to reload signature database, the cache is cleared
+
+        return: (string) "RELOADING"
+        """
+        result = self.client.reload()
+        self.cache.clear()
+        with self._lock:
+            # the new database version is read on next scan
+            self._last_check = None
+        return result
+
+
+    def scan_stream(self, buffer_to_test, *args, **kwargs):
+        """
+        See _ClamdGeneric.scan_stream, the verdict may come from the cache
+        """
+        _assert_stream_type(buffer_to_test)
+        return self._cached('stream', content_digest(buffer_to_test), self.client.scan_stream, buffer_to_test, *args, **kwargs)
+
+
+    def scan_file(self, file):
+        """
+        See _ClamdGeneric.scan_file, the verdict of a file may come from the
+        cache, directories are always scanned
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        if not os.path.isfile(file):
+            return self.client.scan_file(file)
+        try:
+            key = file_digest(file)
+        except (IOError, OSError):
+            # readable by clamd only
+            return self.client.scan_file(file)
+        return self._cached(file, key, self.client.scan_file, file)
+
+
+    def _cached(self, name, key, scan, *args, **kwargs):
+        """
+        internal use only
+        returns the cached verdict of key or scans and stores it
+        """
+        self._check_version()
+
+        found, verdict = self.cache.get(key)
+        if found:
+            if verdict is None:
+                return None
+            return {name: verdict}
+
+        result = scan(*args, **kwargs)
+        if result is None:
+            self.cache.put(key, None)
+        else:
+            verdicts = list(result.values())
+            # errors are not kept, they may not happen again
+            if len(verdicts) == 1 and verdicts[0][0] == 'FOUND':
+                self.cache.put(key, verdicts[0])
+        return result
+
+
+    def _check_version(self):
+        """
+        internal use only
+        """
+        with self._lock:
+            now = time.time()
+            if self._last_check is not None and now - self._last_check < self.version_check_interval:
+                return
+            self._last_check = now
+        self.cache.set_db_version(db_version(self.client.version()))
+        return
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+cli.py - pyclamd command line scanner
+
+Files are scanned on several connections, spread over one or more clamd
+endpoints. Each file is scanned by path with MULTISCAN when clamd runs on
+this host and can read it, otherwise its content is sent with INSTREAM. One
+JSON object per file is written on stdout, and a summary on stderr.
+
+Usage :
+  pyclamd [-e ENDPOINT]... [-j N] [--mode auto|multiscan|instream] PATH...
+  pyclamd --watch /srv/uploads
+  find /srv -newer stamp | pyclamd -f - -j 16
+  curl -s https://example.org/file | pyclamd -
+
+Exit status, as clamdscan : 0 no virus found, 1 virus found, 2 errors.
+"""
+
+import argparse
+import json
+import os
+import stat
+import sys
+import threading
+
+from .pyclamd import ConnectionError, scan_many, _clock, _unix_socket_from_conf, _LOCAL_HOSTS
+from .cluster import ClamdCluster
+from .watch import watch
+
+
+############################################################################
+
+
+# replies of a path scan meaning that clamd could not open the file, which is
+# then sent with INSTREAM
+_UNREADABLE = ('Access denied.', 'lstat() failed: No such file or directory.', "Can't open file or directory")
+
+
+def _is_local(name):
+    """
+    internal use only
+    name being an endpoint name of cluster.parse_endpoint
+    """
+    if name.startswith('unix:'):
+        return True
+    host = name[len('tcp://'):].rpartition(':')[0].strip('[]')
+    return host in _LOCAL_HOSTS
+
+
+def _default_endpoint():
+    """
+    internal use only
+    the unix socket of clamd.conf, or TCP on localhost
+    """
+    try:
+        return 'unix:{0}'.format(_unix_socket_from_conf())
+    except ConnectionError:
+        return 'tcp://127.0.0.1:3310'
+
+
+def _iter_paths(paths, files_from, separator):
+    """
+    internal use only
+    yields the files to scan: '-' for stdin, regular files under
+    directories, and the names read from files_from
+    """
+    names = list(paths)
+    if files_from is not None:
+        if files_from == '-':
+            data = sys.stdin.read()
+        else:
+            with open(files_from, 'r') as fileobj:
+                data = fileobj.read()
+        names.extend(name.rstrip('\r\n') for name in data.split(separator) if name.strip())
+
+    for name in names:
+        if name == '-':
+            yield name
+        elif os.path.isdir(name):
+            for dirpath, dirnames, filenames in os.walk(name):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        yield os.path.abspath(path)
+        else:
+            yield os.path.abspath(name)
+    return
+
+
+
+class _Scanner(object):
+    """
+    internal use only
+    client given to scan_many, its scan_file chooses the method of each file
+    and measures it
+    """
+    def __init__(self, client, mode, chunk_size):
+        self.client = client
+        self.mode = mode
+        self.chunk_size = chunk_size
+        return
+
+
+    def scan_file(self, path):
+        """
+        returns a dict: JSON record of the file
+        """
+        start = _clock()
+        record = {'path': path}
+        if path == '-':
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+            counter = _CountingReader(stdin)
+            record.update(method='INSTREAM', result=self.client.scan_fileobj(counter, chunk_size=self.chunk_size))
+            record['size'] = counter.size
+        else:
+            st = os.stat(path)
+            record['size'] = st.st_size
+            result = None
+            if self._by_path(st):
+                record['method'] = 'MULTISCAN'
+                result = self.client.multiscan_file(path)
+                if result is not None and result.get(path, (None, None))[1] in _UNREADABLE:
+                    # clamd can not open the file, scan its content
+                    result = None
+                    record['method'] = None
+            if record.get('method') is None:
+                record['method'] = 'INSTREAM'
+                with open(path, 'rb') as fileobj:
+                    result = self.client.scan_fileobj(fileobj, chunk_size=self.chunk_size)
+            record['result'] = result
+        record['latency'] = _clock() - start
+        return record
+
+
+    def _by_path(self, st):
+        """
+        internal use only
+        """
+        if self.mode == 'auto':
+            # clamd runs as its own user, it can read files readable by all
+            return bool(st.st_mode & stat.S_IROTH)
+        return self.mode == 'multiscan'
+
+
+
+class _CountingReader(object):
+    """
+    internal use only
+    file object counting the bytes read
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        return
+
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        return data
+
+
+    def readinto(self, buffer):
+        if not hasattr(self.fileobj, 'readinto'):
+            data = self.fileobj.read(len(buffer))
+            buffer[:len(data)] = data
+            size = len(data)
+        else:
+            size = self.fileobj.readinto(buffer)
+        self.size += size or 0
+        return size
+
+
+
+def _record(scan_result):
+    """
+    internal use only
+    turns a ScanResult into the JSON record of the file
+    """
+    if scan_result.error is not None:
+        return {'path': scan_result.item, 'status': 'ERROR', 'reason': str(scan_result.error) or type(scan_result.error).__name__,
+                'method': None, 'size': None, 'latency': None}
+
+    record = scan_result.result
+    result = record.pop('result')
+    if not result:
+        record['status'], record['reason'] = 'OK', None
+    else:
+        # one file scanned, its single entry ('stream' with INSTREAM)
+        status, reason = list(result.values())[0]
+        record['status'], record['reason'] = status, reason
+    return record
+
+
+class Summary(object):
+    """
+    Counts of a CLI run: files, bytes, verdicts, methods and latencies
+    """
+    def __init__(self):
+        self.start = _clock()
+        self.files = 0
+        self.bytes = 0
+        self.infected = 0
+        self.errors = 0
+        self.methods = {}
+        self.latencies = []
+        return
+
+
+    def add(self, record):
+        """
+        Count the JSON record of a file
+        """
+        self.files += 1
+        self.bytes += record['size'] or 0
+        if record['status'] == 'FOUND':
+            self.infected += 1
+        elif record['status'] == 'ERROR':
+            self.errors += 1
+        if record['method'] is not None:
+            self.methods[record['method']] = self.methods.get(record['method'], 0) + 1
+        if record['latency'] is not None:
+            self.latencies.append(record['latency'])
+        return
+
+
+    def as_dict(self):
+        """
+        return: (dict) files, bytes, infected, errors, methods, elapsed,
+          files_per_s, mb_per_s and latency (p50, p90, p99, max in seconds)
+        """
+        elapsed = _clock() - self.start
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[int(round(p / 100.0 * (len(latencies) - 1)))]
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'infected': self.infected,
+            'errors': self.errors,
+            'methods': dict(self.methods),
+            'elapsed': elapsed,
+            'files_per_s': self.files / elapsed if elapsed else None,
+            'mb_per_s': self.bytes / elapsed / 1e6 if elapsed else None,
+            'latency': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99), 'max': latencies[-1] if latencies else None},
+            }
+
+
+    def format(self):
+        """
+        return: (string) summary for humans
+        """
+        summary = self.as_dict()
+        lines = ['----------- SCAN SUMMARY -----------',
+                 'Scanned files: {files}'.format(**summary),
+                 'Infected files: {infected}'.format(**summary),
+                 'Errors: {errors}'.format(**summary),
+                 'Data scanned: {0:.2f} MB'.format(summary['bytes'] / 1e6),
+                 'Time: {0:.3f} s ({1:.1f} files/s, {2:.2f} MB/s)'.format(summary['elapsed'], summary['files_per_s'] or 0.0, summary['mb_per_s'] or 0.0)]
+        if self.latencies:
+            lines.append('Latency: p50 {p50:.4f} s, p90 {p90:.4f} s, p99 {p99:.4f} s, max {max:.4f} s'.format(**summary['latency']))
+        if self.methods:
+            lines.append('Methods: {0}'.format(', '.join('{0} {1}'.format(method, count) for method, count in sorted(self.methods.items()))))
+        return '\n'.join(lines)
+
+
+def _watch(cluster, mode, args):
+    """
+    internal use only
+    --watch: one JSON object per scan, until interrupted
+    """
+    lock = threading.Lock()
+    def on_result(path, result, error):
+        if error is not None:
+            status, reason = 'ERROR', str(error) or type(error).__name__
+        elif not result:
+            status, reason = 'OK', None
+        else:
+            status, reason = list(result.values())[0]
+        if args.infected and status == 'OK':
+            return
+        record = {'path': path, 'status': status, 'reason': reason, 'method': 'INSTREAM' if mode == 'instream' else 'SCAN'}
+        with lock:
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            sys.stdout.flush()
+
+    watch(cluster, args.paths, on_result, concurrency=args.concurrency, use_stream=(mode == 'instream'))
+    cluster.close()
+    return 0
+
+
+############################################################################
+
+
+def main(argv=None):
+    """
+    Entry point of the pyclamd command
+
+    return: (int) exit status
+    """
+    parser = argparse.ArgumentParser(prog='pyclamd', description='Scan files with clamd, one JSON result per line (NDJSON)')
+    parser.add_argument('paths', nargs='*', help='files or directories to scan, - for stdin')
+    parser.add_argument('-e', '--endpoint', action='append', help='clamd endpoint: unix:/path, tcp://host:port or host:port (repeatable, default: LocalSocket of clamd.conf, else 127.0.0.1:3310)')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='number of concurrent connections (default: 8)')
+    parser.add_argument('-f', '--files-from', metavar='FILE', help='read the files to scan from FILE, one per line, - for stdin')
+    parser.add_argument('-0', '--null', action='store_true', help='names of --files-from are separated by null characters')
+    parser.add_argument('--mode', choices=['auto', 'multiscan', 'instream'], default='auto',
+                        help='auto: MULTISCAN of files readable by clamd when all endpoints are local, INSTREAM otherwise (default)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='size of INSTREAM chunks')
+    parser.add_argument('--timeout', type=float, default=None, help='socket timeout (seconds)')
+    parser.add_argument('-w', '--watch', action='store_true', help='scan the files written or moved into the given directories until interrupted (Linux inotify)')
+    parser.add_argument('-i', '--infected', action='store_true', help='only print infected files and errors')
+    parser.add_argument('--summary', choices=['text', 'json', 'none'], default='text', help='summary written on stderr (default: text)')
+    args = parser.parse_args(argv)
+
+    if not args.paths and args.files_from is None:
+        parser.error('nothing to scan, give paths or --files-from')
+    if args.concurrency < 1:
+        parser.error('--concurrency should be a positive int')
+
+    cluster = ClamdCluster(args.endpoint or [_default_endpoint()], timeout=args.timeout, health_interval=None)
+    mode = args.mode
+    if mode == 'auto' and not all(_is_local(node.name) for node in cluster.nodes):
+        mode = 'instream'
+    if args.watch:
+        return _watch(cluster, mode, args)
+    scanner = _Scanner(cluster, mode, args.chunk_size)
+
+    summary = Summary()
+    paths = _iter_paths(args.paths, args.files_from, '\0' if args.null else '\n')
+    try:
+        for scan_result in scan_many(scanner, paths, concurrency=args.concurrency):
+            record = _record(scan_result)
+            summary.add(record)
+            if args.infected and record['status'] == 'OK':
+                continue
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        sys.stdout.flush()
+        cluster.close()
+
+    if args.summary == 'text':
+        sys.stderr.write(summary.format() + '\n')
+    elif args.summary == 'json':
+        sys.stderr.write(json.dumps(summary.as_dict(), sort_keys=True) + '\n')
+
+    if summary.errors:
+        return 2
+    if summary.infected:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
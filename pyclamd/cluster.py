@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+cluster.py - client for several clamd nodes
+
+Usage :
+
+  import pyclamd
+  cluster = pyclamd.ClamdCluster(['unix:/var/run/clamav/clamd.ctl', 'tcp://10.0.0.2:3310', 'tcp://10.0.0.3:3310'], weights=[1, 2, 2])
+  cluster.scan_stream(cluster.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  [node['healthy'] for node in cluster.node_stats()]
+  # [True, True, True]
+"""
+
+import random
+import socket
+import threading
+import time
+
+from .pyclamd import ClamdUnixSocket, ClamdNetworkSocket, _ClamdGeneric, isstr, scan_many, _register_fork_safe, _check_fork
+
+
+############################################################################
+
+
+def parse_endpoint(endpoint, timeout=None):
+    """
+    Get a function creating a client for an endpoint
+
+    endpoint : either
+      - a client (ClamdUnixSocket, ClamdNetworkSocket...)
+      - (string) 'unix:/path/to/clamd.sock' or '/path/to/clamd.sock'
+      - (string) 'tcp://host:port', 'host:port' or 'host' (port 3310)
+      - (tuple) (host, port)
+    timeout (float or None) : socket timeout of created clients
+
+    return: (name, factory) where factory() returns a client, connecting to
+      clamd to test it
+    """
+    if hasattr(endpoint, 'scan_stream'):
+        if hasattr(endpoint, 'unix_socket'):
+            name = 'unix:{0}'.format(endpoint.unix_socket)
+        elif hasattr(endpoint, 'host') and hasattr(endpoint, 'port'):
+            name = 'tcp://{0}:{1}'.format(endpoint.host, endpoint.port)
+        else:
+            name = repr(endpoint)
+        return name, lambda: endpoint
+
+    if isinstance(endpoint, tuple):
+        host, port = endpoint
+    else:
+        assert isstr(endpoint), 'Wrong type for [endpoint], should be a string, a tuple or a client [was {0}]'.format(type(endpoint))
+        if endpoint.startswith('unix:') or endpoint.startswith('/'):
+            filename = endpoint[len('unix:'):] if endpoint.startswith('unix:') else endpoint
+            return 'unix:{0}'.format(filename), lambda: ClamdUnixSocket(filename, timeout=timeout)
+        if endpoint.startswith('tcp://'):
+            endpoint = endpoint[len('tcp://'):]
+        host, sep, port = endpoint.rpartition(':')
+        if not sep or not port.isdigit():
+            host, port = endpoint, 3310
+        host = host.strip('[]')
+    port = int(port)
+    return 'tcp://{0}:{1}'.format(host, port), lambda: ClamdNetworkSocket(host, port, timeout=timeout)
+
+
+
+class ClamdNode(object):
+    """
+    A clamd endpoint of a ClamdCluster, with its health and metrics
+    """
+    def __init__(self, endpoint, weight=1, timeout=None):
+        """
+        endpoint : see parse_endpoint
+        weight (float) : share of requests, relative to the other nodes
+        timeout (float or None) : socket timeout
+        """
+        assert isinstance(weight, (float, int)) and weight > 0, 'Wrong value for [weight], should be a positive number [was {0}]'.format(weight)
+
+        self.name, self._factory = parse_endpoint(endpoint, timeout)
+        self.weight = weight
+        self.client = None
+        self.healthy = True
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.latency = None
+        self.total_latency = 0.0
+        self.last_error = None
+        return
+
+
+    def get_client(self):
+        """
+        return: the client of the node, created on first use
+
+        May raise:
+          - ConnectionError: if clamd can not be reached
+        """
+        if self.client is None:
+            self.client = self._factory()
+        return self.client
+
+
+    def stats(self):
+        """
+        return: (dict) metrics of the node
+        """
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': self.latency,
+            'mean_latency': self.total_latency / (self.requests - self.errors) if self.requests > self.errors else None,
+            'last_error': None if self.last_error is None else str(self.last_error),
+            }
+
+
+
+############################################################################
+
+
+class ClamdCluster(object):
+    """
+    Client spreading requests over several clamd nodes
+
+    Each request goes to the healthy node with the fewest requests in flight
+    relative to its weight. A request failing with a communication error is
+    retried on another node. Nodes are checked with PING in the background:
+    they are ejected after eject_after consecutive failures (of PINGs or
+    requests) and readmitted after readmit_after successful PINGs.
+
+    SCAN, CONTSCAN and MULTISCAN go to any node: the scanned paths must be
+    readable by every clamd.
+    """
+    # methods whose arguments may be sent again to another node
+    _retriable = frozenset(['ping', 'version', 'stats', 'get_stats', 'scan_file', 'contscan_file', 'multiscan_file', 'scan_stream'])
+
+    def __init__(self, endpoints, weights=None, timeout=None, health_interval=5.0, eject_after=2, readmit_after=1):
+        """
+        Cluster initialisation, no connection is made
+
+        endpoints (list) : endpoints of the nodes, see parse_endpoint
+        weights (list of numbers or None) : weight of each node, 1 if None
+        timeout (float or None) : socket timeout
+        health_interval (float or None) : seconds between two PINGs of each
+          node by the background health check, None to disable it
+        eject_after (int) : consecutive failures before a node is ejected
+        readmit_after (int) : consecutive successful PINGs before an ejected
+          node is readmitted
+        """
+        assert len(endpoints) > 0, 'Wrong value for [endpoints], at least one endpoint is needed'
+        if weights is None:
+            weights = [1] * len(endpoints)
+        assert len(weights) == len(endpoints), 'Wrong value for [weights], should have one weight per endpoint'
+
+        self.nodes = [ClamdNode(endpoint, weight, timeout) for endpoint, weight in zip(endpoints, weights)]
+        self.eject_after = eject_after
+        self.readmit_after = readmit_after
+        self.health_interval = health_interval
+
+        # arguments of the cluster, to pickle it
+        self._config = {'endpoints': list(endpoints), 'weights': list(weights), 'timeout': timeout,
+                        'health_interval': health_interval, 'eject_after': eject_after, 'readmit_after': readmit_after}
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._start_health_check()
+        _register_fork_safe(self)
+        return
+
+
+    def __getstate__(self):
+        """
+        Only the endpoints and the settings of the cluster are pickled, the
+        other process starts with fresh nodes
+        """
+        return self._config
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+        return
+
+
+    def _start_health_check(self):
+        """
+        internal use only
+        """
+        self._health_thread = None
+        if self.health_interval is not None:
+            self._health_thread = threading.Thread(target=self._health_loop)
+            self._health_thread.daemon = True
+            self._health_thread.start()
+        return
+
+
+    def _after_fork(self):
+        """
+        internal use only
+        the requests in flight and the health check thread of the parent
+        process do not exist in a child process. The clients of the nodes
+        reset their own connections.
+        """
+        self._lock = threading.Lock()
+        for node in self.nodes:
+            node.in_flight = 0
+        if not self._stop.is_set():
+            self._stop = threading.Event()
+            self._start_health_check()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    EICAR = _ClamdGeneric.EICAR
+
+
+    def close(self):
+        """
+        Stop the background health check
+        """
+        self._stop.set()
+        return
+
+
+    def ping(self):
+        """
+        See _ClamdGeneric.ping, on one node
+        """
+        return self._call('ping')
+
+
+    def version(self):
+        """
+        See _ClamdGeneric.version, of one node
+        """
+        return self._call('version')
+
+
+    def stats(self):
+        """
+        See _ClamdGeneric.stats, of one node
+        """
+        return self._call('stats')
+
+
+    def get_stats(self):
+        """
+        See _ClamdGeneric.get_stats, of one node
+        """
+        return self._call('get_stats')
+
+
+    def reload(self):
+        """
+        Force every reachable node to reload its signature database
+
+        return: (string) "RELOADING"
+
+        May raise:
+          - ConnectionError: if no node could be reached
+        """
+        result, error = None, None
+        for node in self.nodes:
+            try:
+                result = node.get_client().reload()
+            except socket.error as e:
+                error = e
+        if result is None:
+            raise error
+        return result
+
+
+    def scan_file(self, file):
+        """
+        See _ClamdGeneric.scan_file
+        """
+        return self._call('scan_file', file)
+
+
+    def contscan_file(self, file):
+        """
+        See _ClamdGeneric.contscan_file
+        """
+        return self._call('contscan_file', file)
+
+
+    def multiscan_file(self, file):
+        """
+        See _ClamdGeneric.multiscan_file
+        """
+        return self._call('multiscan_file', file)
+
+
+    def scan_stream(self, buffer_to_test, chunk_size=None):
+        """
+        See _ClamdGeneric.scan_stream
+        """
+        return self._call('scan_stream', buffer_to_test, chunk_size=chunk_size)
+
+
+    def scan_iter(self, chunks, chunk_size=None):
+        """
+        See _ClamdGeneric.scan_iter, not retried on another node
+        """
+        return self._call('scan_iter', chunks, chunk_size=chunk_size)
+
+
+    def scan_fileobj(self, fileobj, chunk_size=None):
+        """
+        See _ClamdGeneric.scan_fileobj, not retried on another node
+        """
+        return self._call('scan_fileobj', fileobj, chunk_size=chunk_size)
+
+
+    def scan_many(self, items, concurrency=8, ordered=False):
+        """
+        See pyclamd.scan_many, the scans are spread over the nodes
+        """
+        return scan_many(self, items, concurrency=concurrency, ordered=ordered)
+
+
+    def node_stats(self):
+        """
+        Get the metrics of every node
+
+        return: (list of dict) with keys name, weight, healthy, in_flight,
+          requests, errors, latency (moving average, seconds), mean_latency
+          and last_error
+        """
+        with self._lock:
+            return [node.stats() for node in self.nodes]
+
+
+    def _pick(self, exclude):
+        """
+        internal use only
+        returns the node with the fewest requests in flight relative to its
+        weight, ejected nodes being used only if no other node is left
+        """
+        candidates = [node for node in self.nodes if node not in exclude]
+        healthy = [node for node in candidates if node.healthy]
+        if healthy:
+            candidates = healthy
+        if not candidates:
+            return None
+        best = min((node.in_flight + 1.0) / node.weight for node in candidates)
+        return random.choice([node for node in candidates if (node.in_flight + 1.0) / node.weight == best])
+
+
+    def _call(self, name, *args, **kwargs):
+        """
+        internal use only
+        runs a client method on the chosen node, retrying on other nodes if
+        possible
+        """
+        _check_fork(self)
+        tried = set()
+        error = None
+        while True:
+            with self._lock:
+                node = self._pick(tried)
+                if node is None:
+                    raise error
+                tried.add(node)
+                node.in_flight += 1
+
+            start = time.time()
+            try:
+                result = getattr(node.get_client(), name)(*args, **kwargs)
+            except socket.error as e:
+                with self._lock:
+                    node.in_flight -= 1
+                    self._record_failure(node, e)
+                error = e
+                if name in self._retriable:
+                    continue
+                raise
+
+            except:
+                with self._lock:
+                    node.in_flight -= 1
+                raise
+
+            with self._lock:
+                node.in_flight -= 1
+                self._record_success(node, time.time() - start)
+            return result
+
+
+    def _record_success(self, node, latency):
+        """
+        internal use only
+        """
+        node.requests += 1
+        node.total_latency += latency
+        if node.latency is None:
+            node.latency = latency
+        else:
+            node.latency = 0.8 * node.latency + 0.2 * latency
+        node.consecutive_failures = 0
+        return
+
+
+    def _record_failure(self, node, error, request=True):
+        """
+        internal use only
+        """
+        if request:
+            node.requests += 1
+            node.errors += 1
+        node.last_error = error
+        node.consecutive_successes = 0
+        node.consecutive_failures += 1
+        if node.consecutive_failures >= self.eject_after:
+            node.healthy = False
+        return
+
+
+    def _health_loop(self):
+        """
+        internal use only
+        """
+        while not self._stop.wait(self.health_interval):
+            self.check_health()
+        return
+
+
+    def check_health(self):
+        """
+        PING every node now, ejecting or readmitting them
+        """
+        for node in self.nodes:
+            try:
+                node.get_client().ping()
+            except socket.error as e:
+                with self._lock:
+                    self._record_failure(node, e, request=False)
+                continue
+
+            with self._lock:
+                node.consecutive_failures = 0
+                node.consecutive_successes += 1
+                if not node.healthy and node.consecutive_successes >= self.readmit_after:
+                    node.healthy = True
+        return
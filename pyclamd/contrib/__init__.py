@@ -0,0 +1,12 @@
+"""
+pyclamd.contrib - integrations of pyclamd with other frameworks
+
+WSGI and ASGI middlewares scanning request bodies while they are uploaded.
+"""
+
+import sys
+
+from .common import BodyScan, BodyRejectedError
+from .wsgi import ScanningMiddleware
+if sys.version_info >= (3, 5):
+    from .asgi import AsyncScanningMiddleware
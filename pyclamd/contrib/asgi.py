@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+
+"""
+asgi.py - ASGI middleware scanning request bodies while they are uploaded
+(Python >= 3.5)
+
+Each http.request message of the body is sent to clamd (INSTREAM) as soon as
+it is received, so that the scan overlaps the upload and the verdict is known
+when the last message arrives.
+
+Usage :
+
+  import pyclamd
+  from pyclamd.contrib import AsyncScanningMiddleware
+  app = AsyncScanningMiddleware(app, pyclamd.AsyncClamdUnixSocket())
+"""
+
+import asyncio
+import tempfile
+
+from ..pyclamd import BufferTooLongError, ConnectionError
+from .common import BodyScan, BodyRejectedError, _body_length, _too_long
+
+
+############################################################################
+
+
+class _QueueChunks(object):
+    """
+    internal use only
+    async iterator of the chunks put in a queue, up to None
+    """
+    def __init__(self, queue):
+        self._queue = queue
+        return
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        chunk = await self._queue.get()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+
+
+class _ScanningReceive(object):
+    """
+    internal use only
+    ASGI receive callable sending the body to clamd as it is received. The
+    verdict is waited for with the last body message, and BodyRejectedError
+    raised if the request is rejected.
+    """
+    def __init__(self, middleware, receive, scan):
+        self._middleware = middleware
+        self._receive = receive
+        self._scan = scan
+        self._queue = asyncio.Queue(middleware.queue_size)
+        self._task = asyncio.ensure_future(middleware.client.scan_stream(_QueueChunks(self._queue)))
+        return
+
+
+    async def __call__(self):
+        message = await self._receive()
+        if message['type'] == 'http.request':
+            body = message.get('body', b'')
+            if body and not self._scan.done:
+                self._scan.size += len(body)
+                await self._put(body)
+            # the scan ends early when clamd fails
+            if not message.get('more_body', False) or self._task.done():
+                await self._finish()
+        elif message['type'] == 'http.disconnect':
+            self.close()
+        return message
+
+
+    def close(self):
+        """
+        Abort the scan if the body was not received up to its end
+        """
+        if not self._task.done():
+            self._task.cancel()
+        elif not self._task.cancelled():
+            # retrieved, not to be logged as never retrieved
+            self._task.exception()
+        return
+
+
+    async def _put(self, chunk):
+        """
+        internal use only
+        queues a chunk for clamd, waiting while the queue is full unless the
+        scan failed
+        """
+        if not self._queue.full():
+            self._queue.put_nowait(chunk)
+            return
+        put = asyncio.ensure_future(self._queue.put(chunk))
+        await asyncio.wait([put, self._task], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+        return
+
+
+    async def _finish(self):
+        """
+        internal use only
+        """
+        if not self._scan.done:
+            await self._put(None)
+            try:
+                self._scan.finish(result=await self._task)
+            except (ConnectionError, ValueError) as e:
+                self._scan.finish(error=e)
+        if self._scan.rejected(self._middleware.block, self._middleware.fail_open):
+            raise BodyRejectedError(self._scan)
+        return
+
+
+
+class AsyncScanningMiddleware(object):
+    """
+    ASGI middleware scanning request bodies with clamd while they are
+    uploaded, see contrib.wsgi.ScanningMiddleware
+
+    The BodyScan of the request is set in scope['pyclamd.scan'] (None for
+    requests without a body).
+    """
+    def __init__(self, app, client, spool=True, block=True, fail_open=False, spool_max_memory=1024 * 1024, chunk_size=64 * 1024, queue_size=16):
+        """
+        app : ASGI application
+        client (AsyncClamdUnixSocket or AsyncClamdNetworkSocket) : client
+          giving the connections to clamd, its limits are checked against
+          Content-Length. Its timeout covers the whole upload.
+        spool, block, fail_open, spool_max_memory : see ScanningMiddleware
+        chunk_size (int) : size of the body messages given to the
+          application from the spooled body
+        queue_size (int) : body messages received but not yet sent to clamd,
+          receiving waits beyond
+        """
+        assert isinstance(chunk_size, int) and chunk_size > 0, 'Wrong value for [chunk_size], should be a positive int [was {0}]'.format(chunk_size)
+        assert isinstance(queue_size, int) and queue_size > 0, 'Wrong value for [queue_size], should be a positive int [was {0}]'.format(queue_size)
+
+        self.app = app
+        self.client = client
+        self.spool = spool
+        self.block = block
+        self.fail_open = fail_open
+        self.spool_max_memory = spool_max_memory
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        return
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        headers = dict((name.lower(), value) for name, value in scope.get('headers', []))
+        length = _body_length(headers.get(b'content-length', b'').decode('latin-1'), b'chunked' in headers.get(b'transfer-encoding', b'').lower())
+        if length == 0:
+            return await self.app(dict(scope, **{'pyclamd.scan': None}), receive, send)
+
+        scan = BodyScan(length)
+        scope = dict(scope, **{'pyclamd.scan': scan})
+        if _too_long(self.client, length):
+            # refused before the body is received
+            scan.finish(error=BufferTooLongError('Content-Length exceeds StreamMaxLength'))
+            if scan.rejected(self.block, self.fail_open):
+                return await self._reject(scan, send)
+            return await self.app(scope, receive, send)
+
+        body = _ScanningReceive(self, receive, scan)
+        try:
+            if self.spool:
+                await self._spooled(scope, body, receive, send)
+            else:
+                await self._passthrough(scope, body, send)
+        finally:
+            body.close()
+        return
+
+
+    async def _passthrough(self, scope, body, send):
+        """
+        internal use only
+        the application receives the body while it is scanned
+        """
+        started = []
+        async def tracking_send(message):
+            if message['type'] == 'http.response.start':
+                started.append(True)
+            await send(message)
+
+        try:
+            await self.app(scope, body, tracking_send)
+        except BodyRejectedError as e:
+            if started:
+                raise
+            await self._reject(e.scan, send)
+        return
+
+
+    async def _spooled(self, scope, body, receive, send):
+        """
+        internal use only
+        the body is received and scanned before the application is called
+        """
+        with tempfile.SpooledTemporaryFile(self.spool_max_memory) as spooled:
+            try:
+                while True:
+                    message = await body()
+                    if message['type'] != 'http.request':
+                        # the client is gone
+                        return
+                    spooled.write(message.get('body', b''))
+                    if not message.get('more_body', False):
+                        break
+            except BodyRejectedError as e:
+                await self._reject(e.scan, send)
+                return
+
+            spooled.seek(0)
+            done = []
+            async def spooled_receive():
+                if done:
+                    return await receive()
+                data = spooled.read(self.chunk_size)
+                more_body = spooled.tell() < scope['pyclamd.scan'].size
+                if not more_body:
+                    done.append(True)
+                return {'type': 'http.request', 'body': data, 'more_body': more_body}
+
+            await self.app(scope, spooled_receive, send)
+        return
+
+
+    async def _reject(self, scan, send):
+        """
+        internal use only
+        """
+        status, reason, message = scan.response()
+        body = message.encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
+        return
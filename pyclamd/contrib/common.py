@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+
+"""
+common.py - request body scans, shared by the WSGI and ASGI middlewares
+"""
+
+from ..pyclamd import BufferTooLongError
+
+
+############################################################################
+
+
+# reason phrases of the responses to rejected requests
+_REASONS = {403: 'Forbidden', 413: 'Request Entity Too Large', 503: 'Service Unavailable'}
+
+
+class BodyRejectedError(IOError):
+    """
+    Raised by the reads of a request body rejected by its scan, in
+    passthrough mode (the middleware then answers the request if the
+    application lets the exception go)
+    """
+    def __init__(self, scan):
+        IOError.__init__(self, 'Request body rejected by virus scan [{0}]'.format(scan.response()[2].strip()))
+        self.scan = scan
+        return
+
+
+
+class BodyScan(object):
+    """
+    Scan of a request body, given to the application as environ['pyclamd.scan']
+    (WSGI) or scope['pyclamd.scan'] (ASGI)
+
+    Attributes:
+      - length (int or None): Content-Length of the body, None if unknown
+      - size (int): bytes of the body sent to clamd so far
+      - done (bool): True once the verdict is known
+      - result: return value of scan_stream, None if no virus found
+      - error (Exception or None): why the body could not be scanned
+    """
+    def __init__(self, length):
+        self.length = length
+        self.size = 0
+        self.done = False
+        self.result = None
+        self.error = None
+        return
+
+
+    def __repr__(self):
+        return 'BodyScan(size={0}, done={1}, result={2!r}, error={3!r})'.format(self.size, self.done, self.result, self.error)
+
+
+    @property
+    def infected(self):
+        """
+        (bool) True if a virus was found in the body
+        """
+        return self.result is not None and any(status == 'FOUND' for status, reason in self.result.values())
+
+
+    @property
+    def failed(self):
+        """
+        (bool) True if the body could not be scanned
+        """
+        return self.error is not None or (self.result is not None and not self.infected)
+
+
+    def rejected(self, block, fail_open):
+        """
+        return: (bool) True if the request must be rejected
+
+        block (bool) : reject infected bodies
+        fail_open (bool) : accept bodies which could not be scanned, when
+          block is True
+        """
+        return block and self.done and (self.infected or (self.failed and not fail_open))
+
+
+    def response(self):
+        """
+        return: (status code, reason phrase, message) of the response to a
+          rejected request
+        """
+        if self.infected:
+            status, message = 403, 'Virus found: {0}\n'.format(', '.join(reason for status, reason in self.result.values() if status == 'FOUND'))
+        elif isinstance(self.error, BufferTooLongError):
+            status, message = 413, 'Request body too large to be scanned\n'
+        else:
+            status, message = 503, 'Request body could not be scanned\n'
+        return status, _REASONS[status], message
+
+
+    def finish(self, result=None, error=None):
+        """
+        internal use only
+        records the verdict of clamd
+        """
+        self.result = result
+        self.error = error
+        self.done = True
+        return
+
+
+
+def _body_length(content_length, chunked):
+    """
+    internal use only
+    returns the length of a request body from its Content-Length header: 0
+    if the request has no body, None if it is unknown (chunked body)
+    """
+    if content_length:
+        try:
+            return max(0, int(content_length))
+        except ValueError:
+            pass
+    return None if chunked else 0
+
+
+def _too_long(client, length):
+    """
+    internal use only
+    returns True if the body is known to exceed the StreamMaxLength of client
+    """
+    limits = getattr(client, 'limits', None)
+    return length is not None and limits is not None and limits.stream_max_length is not None and length > limits.stream_max_length
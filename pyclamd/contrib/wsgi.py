@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+
+"""
+wsgi.py - WSGI middleware scanning request bodies while they are uploaded
+
+Each chunk of the body is sent to clamd (INSTREAM) as soon as it is read
+from the client, so that the scan overlaps the upload and the verdict is
+known when the last byte arrives.
+
+Usage :
+
+  import pyclamd
+  from pyclamd.contrib import ScanningMiddleware
+  application = ScanningMiddleware(application, pyclamd.ClamdAgnostic())
+"""
+
+import sys
+import tempfile
+
+from ..pyclamd import BufferTooLongError, ConnectionError, ScanningWriter
+from .common import BodyScan, BodyRejectedError, _body_length, _too_long
+
+
+############################################################################
+
+
+class _ScanningInput(object):
+    """
+    internal use only
+    wsgi.input sending what is read to clamd. The verdict is waited for when
+    the end of the body is read, and BodyRejectedError raised if the request
+    is rejected.
+    """
+    def __init__(self, middleware, body, scan):
+        self._middleware = middleware
+        self._body = body
+        self._scan = scan
+        self._remaining = scan.length
+        self._writer = None
+        try:
+            self._writer = ScanningWriter(middleware.client, chunk_size=middleware.chunk_size)
+        except ConnectionError as e:
+            scan.finish(error=e)
+        return
+
+
+    def read(self, size=-1):
+        size = self._size(size)
+        if size is None:
+            data = self._body.read()
+        else:
+            data = self._body.read(size) if size else b''
+        return self._feed(data, size is None or (size > 0 and not data))
+
+
+    def readline(self, size=-1):
+        size = self._size(size)
+        data = self._body.readline() if size is None else self._body.readline(size)
+        return self._feed(data, not data)
+
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+    def close(self):
+        """
+        Abort the scan if the body was not read up to its end
+        """
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+        return
+
+
+    def _size(self, size):
+        """
+        internal use only
+        returns the size to read, capped by the rest of the body, None to read
+        everything
+        """
+        if size is None or size < 0:
+            return self._remaining
+        if self._remaining is not None:
+            return min(size, self._remaining)
+        return size
+
+
+    def _feed(self, data, end):
+        """
+        internal use only
+        sends data to clamd, and waits for the verdict at the end of the body
+        """
+        if data:
+            if self._remaining is not None:
+                self._remaining -= len(data)
+            self._scan.size += len(data)
+            if self._writer is not None:
+                self._writer.write(data)
+        if end or self._remaining == 0:
+            self._finish()
+        return data
+
+
+    def _finish(self):
+        """
+        internal use only
+        """
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            try:
+                self._scan.finish(result=writer.close())
+            except (ConnectionError, ValueError) as e:
+                self._scan.finish(error=e)
+        if self._scan.rejected(self._middleware.block, self._middleware.fail_open):
+            raise BodyRejectedError(self._scan)
+        return
+
+
+
+class ScanningMiddleware(object):
+    """
+    WSGI middleware scanning request bodies with clamd while they are
+    uploaded
+
+    The BodyScan of the request is set in environ['pyclamd.scan'] (None for
+    requests without a body). With spool, the body is read and scanned before
+    the application is called, and given to it from a temporary file; without
+    spool, what the application reads is passed through and scanned at the
+    same time, and reading the end of a rejected body raises
+    BodyRejectedError.
+
+    Rejected requests get a 403 response (virus found), 413 (body longer
+    than StreamMaxLength) or 503 (clamd unavailable).
+    """
+    def __init__(self, app, client, spool=True, block=True, fail_open=False, spool_max_memory=1024 * 1024, chunk_size=64 * 1024):
+        """
+        app : WSGI application
+        client (ClamdUnixSocket or ClamdNetworkSocket) : client giving the
+          connections to clamd, its limits are checked against Content-Length
+        spool (bool) : scan the whole body before calling the application,
+          otherwise the body is scanned while the application reads it
+        block (bool) : reject the requests with a virus, otherwise they are
+          only annotated
+        fail_open (bool) : accept the requests whose body could not be
+          scanned, when block is True
+        spool_max_memory (int) : spooled bodies larger than this are written
+          to a temporary file
+        chunk_size (int) : size of the reads of the body and of the INSTREAM
+          chunks
+        """
+        assert isinstance(chunk_size, int) and chunk_size > 0, 'Wrong value for [chunk_size], should be a positive int [was {0}]'.format(chunk_size)
+
+        self.app = app
+        self.client = client
+        self.spool = spool
+        self.block = block
+        self.fail_open = fail_open
+        self.spool_max_memory = spool_max_memory
+        self.chunk_size = chunk_size
+        return
+
+
+    def __call__(self, environ, start_response):
+        length = _body_length(environ.get('CONTENT_LENGTH'), environ.get('wsgi.input_terminated', False))
+        if length == 0:
+            environ['pyclamd.scan'] = None
+            return self.app(environ, start_response)
+
+        scan = environ['pyclamd.scan'] = BodyScan(length)
+        if _too_long(self.client, length):
+            # refused before the body is read
+            scan.finish(error=BufferTooLongError('Content-Length exceeds StreamMaxLength'))
+            if scan.rejected(self.block, self.fail_open):
+                return self._reject(scan, start_response)
+            return self.app(environ, start_response)
+
+        body = _ScanningInput(self, environ['wsgi.input'], scan)
+        if scan.rejected(self.block, self.fail_open):
+            # clamd could not be reached
+            return self._reject(scan, start_response)
+
+        if not self.spool:
+            environ['wsgi.input'] = body
+            try:
+                return _ClosingIterable(self.app(environ, start_response), body)
+            except BodyRejectedError as e:
+                # the response of the application is not sent yet
+                body.close()
+                return self._reject(e.scan, start_response, sys.exc_info())
+            except:
+                body.close()
+                raise
+
+        spooled = tempfile.SpooledTemporaryFile(self.spool_max_memory)
+        try:
+            while True:
+                data = body.read(self.chunk_size)
+                if not data:
+                    break
+                spooled.write(data)
+        except BodyRejectedError:
+            spooled.close()
+            return self._reject(scan, start_response)
+        except:
+            spooled.close()
+            raise
+        finally:
+            body.close()
+
+        spooled.seek(0)
+        environ['wsgi.input'] = spooled
+        environ['CONTENT_LENGTH'] = str(scan.size)
+        return _ClosingIterable(self.app(environ, start_response), spooled)
+
+
+    def _reject(self, scan, start_response, exc_info=None):
+        """
+        internal use only
+        """
+        status, reason, message = scan.response()
+        body = message.encode('utf-8')
+        start_response('{0} {1}'.format(status, reason), [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))], exc_info)
+        return [body]
+
+
+
+class _ClosingIterable(object):
+    """
+    internal use only
+    response of the application, closing the body given to it (spooled
+    file or _ScanningInput) with it
+    """
+    def __init__(self, iterable, body):
+        self._iterable = iterable
+        self._body = body
+        return
+
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._body.close()
+        return
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+hedge.py - hedged INSTREAM scans over several clamd replicas
+
+A scan not answered after a delay (a percentile of recent scan latencies) is
+sent again to another replica, the first reply wins and the other connection
+is closed. A budget caps the extra load.
+
+Usage :
+
+  import pyclamd
+  cd = pyclamd.HedgedClamd(['unix:/var/run/clamav/clamd.ctl', 'tcp://10.0.0.2:3310'], percentile=95, budget=0.05)
+  cd.scan_stream(cd.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  cd.hedge_stats()['hedges']
+  # 0
+"""
+
+import bisect
+import collections
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # Python2
+    import Queue as queue
+
+from .pyclamd import ConnectionError, BufferTooLongError, _ClamdGeneric
+from .pyclamd import _assert_stream_type, _stream_view, _send_stream, _encode_command, _decode, _parse_scan_results
+from .cluster import parse_endpoint
+
+
+############################################################################
+
+
+class LatencyWindow(object):
+    """
+    Latencies of the last scans, for percentiles
+    """
+    def __init__(self, size=512):
+        """
+        size (int) : number of latencies kept
+        """
+        assert isinstance(size, int) and size > 0, 'Wrong value for [size], should be a positive int [was {0}]'.format(size)
+
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=size)
+        self._sorted = []
+        return
+
+
+    def __len__(self):
+        return len(self._recent)
+
+
+    def add(self, latency):
+        """
+        Add a latency (seconds)
+        """
+        with self._lock:
+            if len(self._recent) == self._recent.maxlen:
+                oldest = self._recent[0]
+                del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+            self._recent.append(latency)
+            bisect.insort(self._sorted, latency)
+        return
+
+
+    def percentile(self, p):
+        """
+        return: (float) the p-th percentile (0 to 100) of the latencies, None
+          if there is none
+        """
+        with self._lock:
+            if not self._sorted:
+                return None
+            index = int(round(p / 100.0 * (len(self._sorted) - 1)))
+            return self._sorted[index]
+
+
+
+class _Attempt(object):
+    """
+    internal use only
+    one INSTREAM scan on its own connection, run in a thread and cancelled by
+    closing its socket
+    """
+    def __init__(self, replica, client, view, chunk_size, results):
+        # index of the replica of client
+        self.replica = replica
+        self.client = client
+        self.cancelled = False
+        self._view = view
+        self._chunk_size = chunk_size if chunk_size is not None else client.chunk_size
+        self._results = results
+        self._lock = threading.Lock()
+        self._socket = None
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return
+
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            clamd_socket, self._socket = self._socket, None
+        if clamd_socket is not None:
+            _close(clamd_socket)
+        return
+
+
+    def _run(self):
+        try:
+            result = self._scan()
+        except Exception as e:
+            self._results.put((self, None, e))
+        else:
+            self._results.put((self, result, None))
+        return
+
+
+    def _scan(self):
+        clamd_socket = self.client._connect()
+        with self._lock:
+            if self.cancelled:
+                _close(clamd_socket)
+                raise ConnectionError('Scan cancelled')
+            self._socket = clamd_socket
+
+        try:
+            try:
+                _send_stream(clamd_socket, self._view, self._chunk_size, header=_encode_command('INSTREAM'))
+            except socket.error:
+                # clamd closes the connection when the stream exceeds
+                # StreamMaxLength, its reply tells so
+                pass
+
+            data = b''
+            try:
+                while True:
+                    received = clamd_socket.recv(4096)
+                    if not received:
+                        break
+                    data += received
+            except socket.error:
+                raise ConnectionError('Unable to scan stream')
+        finally:
+            self.cancel()
+
+        if not data:
+            raise ConnectionError('Unable to scan stream')
+        return _parse_scan_results([line.strip() for line in _decode(data).splitlines()])
+
+
+
+def _close(clamd_socket):
+    """
+    internal use only
+    closes a socket, waking up a thread blocked on it
+    """
+    try:
+        clamd_socket.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    clamd_socket.close()
+    return
+
+
+############################################################################
+
+
+class HedgedClamd(object):
+    """
+    Client sending a slow INSTREAM scan to a second replica
+
+    A scan is sent to the next replica (round robin). When it is not answered
+    after the percentile-th percentile of the recent scan latencies (bounded
+    by min_delay and max_delay), the same buffer is sent to another replica if
+    the budget allows it. The first reply is returned and the other
+    connection closed, which makes its clamd abort the scan. A scan failing
+    with a ConnectionError is sent to another replica without waiting.
+
+    Each scan gives budget hedge tokens, up to burst tokens, and a hedge
+    costs one: budget=0.05 allows 5% more scans than requested.
+
+    Other methods are those of the first replica.
+    """
+    def __init__(self, clients, percentile=95.0, min_delay=0.005, max_delay=1.0, budget=0.05, burst=10, window=512):
+        """
+        clients (list) : replicas, clients (ClamdUnixSocket, ClamdNetworkSocket)
+          or endpoints (see cluster.parse_endpoint)
+        percentile (float) : percentile of recent latencies after which a scan
+          is hedged
+        min_delay, max_delay (float) : bounds of the hedging delay (seconds),
+          max_delay is used until enough latencies are known
+        budget (float) : hedges allowed per scan, on average
+        burst (float) : hedges allowed in a row
+        window (int) : number of recent latencies kept
+        """
+        assert len(clients) > 0, 'Wrong value for [clients], at least one client is needed'
+        assert 0 <= percentile <= 100, 'Wrong value for [percentile], should be between 0 and 100 [was {0}]'.format(percentile)
+        assert 0 <= min_delay <= max_delay, 'Wrong value for [min_delay] and [max_delay], should be 0 <= min_delay <= max_delay'
+        assert budget >= 0, 'Wrong value for [budget], should be a positive number [was {0}]'.format(budget)
+
+        self._factories = [parse_endpoint(client)[1] for client in clients]
+        self._clients = [None] * len(clients)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+        self.latencies = LatencyWindow(window)
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._tokens = burst
+        self._scans = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._denied = 0
+        self._failovers = 0
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._client(0), name)
+
+
+    EICAR = _ClamdGeneric.EICAR
+
+
+    def hedge_delay(self):
+        """
+        return: (float) seconds after which a scan is hedged
+        """
+        if len(self.latencies) < 10:
+            return self.max_delay
+        return min(max(self.latencies.percentile(self.percentile), self.min_delay), self.max_delay)
+
+
+    def hedge_stats(self):
+        """
+        Get statistics about hedging
+
+        return: (dict) with keys
+          - scans: scans requested
+          - hedges: scans sent to a second replica because they were slow
+          - hedge_wins: hedged scans answered first by the second replica
+          - denied: slow scans not hedged because the budget was exhausted
+          - failovers: scans sent to another replica after an error
+          - delay: current hedging delay (seconds)
+        """
+        with self._lock:
+            return {
+                'scans': self._scans,
+                'hedges': self._hedges,
+                'hedge_wins': self._hedge_wins,
+                'denied': self._denied,
+                'failovers': self._failovers,
+                'delay': self.hedge_delay(),
+                }
+
+
+    def scan_stream(self, buffer_to_test, chunk_size=None):
+        """
+        Scan a buffer, hedged on another replica if clamd is slow to answer
+
+        See _ClamdGeneric.scan_stream
+
+        May raise :
+          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - ConnectionError: if no replica could scan the buffer
+        """
+        _assert_stream_type(buffer_to_test)
+        view = _stream_view(buffer_to_test)
+        delay = self.hedge_delay()
+        started = time.time()
+
+        with self._lock:
+            self._scans += 1
+            self._tokens = min(self._tokens + self.budget, self.burst)
+            first = self._next
+            self._next = (self._next + 1) % len(self._factories)
+        replicas = [(first + i) % len(self._factories) for i in range(len(self._factories))]
+
+        results = queue.Queue()
+        running = []
+        hedged = False
+        error = None
+
+        def start():
+            index = replicas.pop(0)
+            try:
+                client = self._client(index)
+            except socket.error as e:
+                results.put((None, None, e))
+                return
+            running.append(_Attempt(index, client, view, chunk_size, results))
+
+        start()
+        try:
+            while True:
+                try:
+                    if hedged or not replicas:
+                        attempt, result, e = results.get()
+                    else:
+                        attempt, result, e = results.get(timeout=delay)
+                except queue.Empty:
+                    # slow replica
+                    hedged = True
+                    with self._lock:
+                        if self._tokens < 1:
+                            self._denied += 1
+                            continue
+                        self._tokens -= 1
+                        self._hedges += 1
+                    start()
+                    continue
+
+                if attempt is not None:
+                    running.remove(attempt)
+                if e is None:
+                    # latency seen by the caller, hedging delay included
+                    self.latencies.add(time.time() - started)
+                    if hedged and attempt.replica != first:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return result
+
+                if isinstance(e, BufferTooLongError):
+                    raise e
+                error = e
+                if replicas and not running:
+                    with self._lock:
+                        self._failovers += 1
+                    start()
+                elif not running:
+                    raise error
+        finally:
+            for attempt in running:
+                attempt.cancel()
+
+
+    def _client(self, index):
+        """
+        internal use only
+        returns the client of a replica, created on first use
+        """
+        if self._clients[index] is None:
+            self._clients[index] = self._factories[index]()
+        return self._clients[index]
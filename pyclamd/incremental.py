@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+incremental.py - incremental directory scans with a persistent index
+
+Files are only sent to clamd when they are new, when they changed (device,
+inode, size, mtime or ctime) or when the signature database changed since
+their last scan.
+
+Usage :
+
+  import pyclamd
+  cd = pyclamd.ClamdAgnostic()
+  with pyclamd.ScanIndex('/var/lib/pyclamd/index.sqlite') as index:
+      result = pyclamd.scan_tree_incremental(cd, '/srv/data', index)
+      print(index.last_run['scanned'])
+"""
+
+import os
+import sqlite3
+import stat
+import time
+
+from .pyclamd import isstr
+from .cache import db_version
+
+
+############################################################################
+
+
+def _stat_key(st):
+    """
+    internal use only
+    returns (device, inode, size, mtime_ns, ctime_ns) of a stat result
+    """
+    try:
+        mtime_ns, ctime_ns = st.st_mtime_ns, st.st_ctime_ns
+    except AttributeError:
+        # Python2
+        mtime_ns, ctime_ns = int(st.st_mtime * 1e9), int(st.st_ctime * 1e9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+
+
+class ScanIndex(object):
+    """
+    Persistent index of scanned files (SQLite), keyed by filename and
+    remembering the stat key of the file and the signature database version
+    of its last scan
+    """
+    def __init__(self, filename):
+        """
+        Index initialisation, the database is created if needed
+
+        filename (string) : SQLite database filename, or ':memory:'
+        """
+        assert isstr(filename), 'Wrong type for [filename], should be a string [was {0}]'.format(type(filename))
+
+        self.filename = filename
+        self.last_run = None
+        self.db = sqlite3.connect(filename)
+        if filename != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            device INTEGER, inode INTEGER, size INTEGER,
+            mtime_ns INTEGER, ctime_ns INTEGER,
+            db_version TEXT, status TEXT, reason TEXT,
+            scanned_at REAL, run INTEGER)''')
+        self.db.commit()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.db.close()
+        return
+
+
+    def lookup(self, path):
+        """
+        Get the last scan of a file
+
+        return: ((device, inode, size, mtime_ns, ctime_ns), db_version, verdict)
+          where verdict is None or ('FOUND', 'virusname'), or None if the file
+          is not in the index
+        """
+        row = self.db.execute('SELECT device, inode, size, mtime_ns, ctime_ns, db_version, status, reason FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        verdict = None
+        if row[6] != 'OK':
+            verdict = (row[6], row[7])
+        return (tuple(row[:5]), row[5], verdict)
+
+
+    def record(self, path, key, version, verdict, run=None):
+        """
+        Store the scan of a file, committed by commit()
+
+        path (string) : filename
+        key (tuple) : (device, inode, size, mtime_ns, ctime_ns)
+        version (string) : signature database version
+        verdict : None or ('FOUND', 'virusname')
+        run (int or None) : identifier of the scan run
+        """
+        status, reason = verdict or ('OK', '')
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path,) + tuple(key) + (version, status, reason, time.time(), run))
+        return
+
+
+    def touch(self, paths, run):
+        """
+        Mark unchanged files as seen by run
+        """
+        self.db.executemany('UPDATE files SET run = ? WHERE path = ?', [(run, path) for path in paths])
+        return
+
+
+    def prune(self, top, run):
+        """
+        Remove the files under top which were not seen by run
+
+        return: (int) number of files removed from the index
+        """
+        top = os.path.join(top, '')
+        # paths starting with top, by a case sensitive range (LIKE ignores
+        # the case of ASCII letters)
+        end = top[:-1] + chr(ord(top[-1]) + 1)
+        cursor = self.db.execute('DELETE FROM files WHERE path >= ? AND path < ? AND (run IS NULL OR run != ?)', (top, end, run))
+        return cursor.rowcount
+
+
+    def commit(self):
+        """
+        Commit recorded scans
+        """
+        self.db.commit()
+        return
+
+
+
+############################################################################
+
+
+def scan_tree_incremental(client, top, index, max_pending=64, followlinks=False, commit_every=1000, commit_interval=5.0):
+    """
+    Scan the files of a directory tree which are new or changed since their
+    last scan recorded in index, or all of them if the signature database
+    changed. Files are scanned with SCAN requests pipelined in one clamd
+    session, so they MUST be readable by clamd.
+
+    client : ClamdUnixSocket, ClamdNetworkSocket or any client with session()
+    top (string) : directory (MUST BE ABSOLUTE PATH !)
+    index (ScanIndex) : index of previous scans, updated
+    max_pending (int) : maximum number of SCAN requests waiting for a reply
+    followlinks (bool) : follow symbolic links to directories
+    commit_every (int) : scans recorded in index between two commits
+    commit_interval (float) : longest time in seconds between two commits,
+      so that an interrupted run does not lose the scans already done
+
+    return either :
+      - (dict): {filename1: ('FOUND', 'virusname'), filename2: ('ERROR', 'reason')},
+        infected files found by previous runs included
+      - None: if no virus found
+
+    index.last_run is set to a dict with keys files, scanned, unchanged and
+    removed (files gone from the tree, removed from the index).
+
+    May raise:
+      - ConnectionError: in case of communication problem
+    """
+    assert isstr(top), 'Wrong type for [top], should be a string [was {0}]'.format(type(top))
+    assert isinstance(commit_every, int) and commit_every > 0, 'Wrong value for [commit_every], should be a positive int [was {0}]'.format(commit_every)
+
+    version = db_version(client.version())
+    run = int(time.time() * 1000)
+    dr = {}
+    counters = {'files': 0, 'scanned': 0, 'unchanged': 0, 'removed': 0}
+    unchanged = []
+    # scans recorded since the last commit, and its time
+    uncommitted = {'count': 0, 'time': time.time()}
+
+    def record(path, key, request):
+        result = request.result()
+        counters['scanned'] += 1
+        if result is None:
+            index.record(path, key, version, None, run)
+        else:
+            for filename, verdict in result.items():
+                dr[path] = verdict
+                # errors are not recorded, the file is scanned again next time
+                if verdict[0] == 'FOUND':
+                    index.record(path, key, version, verdict, run)
+
+        uncommitted['count'] += 1
+        if uncommitted['count'] >= commit_every or time.time() - uncommitted['time'] >= commit_interval:
+            index.commit()
+            uncommitted['count'] = 0
+            uncommitted['time'] = time.time()
+        return
+
+    with client.session(max_pending=max_pending) as session:
+        requests = []
+        for dirpath, dirnames, filenames in os.walk(top, followlinks=followlinks):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                counters['files'] += 1
+
+                key = _stat_key(st)
+                previous = index.lookup(path)
+                if previous is not None and previous[0] == key and previous[1] == version:
+                    counters['unchanged'] += 1
+                    unchanged.append(path)
+                    if previous[2] is not None:
+                        dr[path] = previous[2]
+                    continue
+
+                if len(requests) >= max_pending:
+                    record(*requests.pop(0))
+                requests.append((path, key, session.submit_scan_file(path)))
+
+        for request in requests:
+            record(*request)
+
+    index.touch(unchanged, run)
+    counters['removed'] = index.prune(top, run)
+    index.commit()
+    index.last_run = counters
+
+    if not dr:
+        return None
+    return dr
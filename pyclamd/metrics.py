@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+metrics.py - metrics about clamd and pyclamd
+
+Usage :
+
+  #   import pyclamd
+  #   cd = pyclamd.ClamdAgnostic()
+  #   cd.observer = pyclamd.HistogramObserver()
+  #   cd.scan_stream(cd.EICAR())['stream']
+  #   # ('FOUND', 'Eicar-Test-Signature')
+  #   cd.observer.summary()[('INSTREAM', '<1KiB')]['verdicts']
+  #   # {'FOUND': 1}
+
+  #   import pyclamd
+  #   poller = pyclamd.StatsPoller(['unix:/var/run/clamav/clamd.ctl', 'tcp://10.0.0.2:3310'], interval=10)
+  #   poller.poll()
+  #   poller.latest('tcp://10.0.0.2:3310').queue_length
+  #   # 0
+  #   poller.series('tcp://10.0.0.2:3310', 'threads_busy')
+  #   # [(1792224000.0, 1)]
+"""
+
+import bisect
+import collections
+import socket
+import threading
+import time
+
+from .cluster import parse_endpoint
+
+
+############################################################################
+
+
+# upper bounds (seconds) of the latency buckets of HistogramObserver
+DEFAULT_LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# upper bounds (bytes sent) of the size classes of HistogramObserver
+DEFAULT_SIZE_BOUNDS = (1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+
+
+def _size_label(size):
+    """
+    internal use only
+    """
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{0}{1}'.format(size, unit)
+        size //= 1024
+    return '{0}GiB'.format(size)
+
+
+
+class Histogram(object):
+    """
+    Histogram of values with fixed bucket bounds
+    """
+    def __init__(self, bounds=DEFAULT_LATENCY_BOUNDS):
+        """
+        bounds (sorted list) : upper bounds of the buckets, a last bucket
+          counts the larger values
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+        return
+
+
+    def add(self, value):
+        """
+        Count a value
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        return
+
+
+    def merge(self, other):
+        """
+        Add the values counted by another histogram with the same bounds
+        """
+        assert self.bounds == other.bounds, 'Wrong value for [other], should have the same bounds'
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return
+
+
+    def percentile(self, p):
+        """
+        return: (float) upper bound of the bucket holding the p-th percentile
+          (0 to 100), the largest value for the last bucket, None if empty
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+
+    def as_dict(self):
+        """
+        return: (dict) with keys count, sum, mean, max, p50, p90, p99 and
+          buckets, a list of (upper bound, count), None for the last bound
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds + (None,), self.counts)),
+            }
+
+
+
+class HistogramObserver(object):
+    """
+    Observer of clamd commands (see NullObserver) collecting, by command and
+    size class of the bytes sent, histograms of the connect time, time to
+    first reply byte and total time, and counts of verdicts and errors.
+    Thread-safe, it may observe several clients.
+    """
+    enabled = True
+
+    _times = ('connect_time', 'first_byte_time', 'total_time')
+
+    def __init__(self, latency_bounds=DEFAULT_LATENCY_BOUNDS, size_bounds=DEFAULT_SIZE_BOUNDS):
+        """
+        latency_bounds (sorted list) : upper bounds (seconds) of the buckets
+        size_bounds (sorted list) : upper bounds (bytes) of the size classes
+        """
+        self.latency_bounds = tuple(latency_bounds)
+        self.size_bounds = tuple(size_bounds)
+        self.size_classes = ['<{0}'.format(_size_label(bound)) for bound in self.size_bounds]
+        self.size_classes.append('>={0}'.format(_size_label(self.size_bounds[-1])))
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        return
+
+
+    def observe(self, trace):
+        """
+        Count a CommandTrace
+        """
+        key = (trace.command, self.size_classes[bisect.bisect_right(self.size_bounds, trace.bytes_sent)])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = self._new_entry()
+            entry['count'] += 1
+            entry['bytes_sent'] += trace.bytes_sent
+            for name in self._times:
+                value = getattr(trace, name)
+                if value is not None:
+                    entry[name].add(value)
+            if trace.verdict is not None:
+                entry['verdicts'][trace.verdict] = entry['verdicts'].get(trace.verdict, 0) + 1
+            if trace.error is not None:
+                entry['errors'][trace.error] = entry['errors'].get(trace.error, 0) + 1
+        return
+
+
+    def histogram(self, command, name='total_time', size_class=None):
+        """
+        Get a histogram
+
+        command (string) : e.g. 'INSTREAM', 'SCAN', 'MULTISCAN'
+        name (string) : 'connect_time', 'first_byte_time' or 'total_time'
+        size_class (string or None) : one of size_classes, None for all
+
+        return: (Histogram)
+        """
+        assert name in self._times, 'Wrong value for [name], should be one of {0} [was {1}]'.format(self._times, name)
+
+        result = Histogram(self.latency_bounds)
+        with self._lock:
+            for (entry_command, entry_size_class), entry in self._entries.items():
+                if entry_command == command and size_class in (None, entry_size_class):
+                    result.merge(entry[name])
+        return result
+
+
+    def summary(self):
+        """
+        Get every measure
+
+        return: (dict) {(command, size class): {count, bytes_sent, verdicts,
+          errors, connect_time, first_byte_time, total_time}}, verdicts and
+          errors being counts by verdict or exception name, times being
+          Histogram.as_dict()
+        """
+        with self._lock:
+            result = {}
+            for key, entry in self._entries.items():
+                result[key] = {
+                    'count': entry['count'],
+                    'bytes_sent': entry['bytes_sent'],
+                    'verdicts': dict(entry['verdicts']),
+                    'errors': dict(entry['errors']),
+                    }
+                for name in self._times:
+                    result[key][name] = entry[name].as_dict()
+            return result
+
+
+    def reset(self):
+        """
+        Forget every measure
+        """
+        with self._lock:
+            self._entries = {}
+        return
+
+
+    def _new_entry(self):
+        """
+        internal use only
+        """
+        entry = {'count': 0, 'bytes_sent': 0, 'verdicts': {}, 'errors': {}}
+        for name in self._times:
+            entry[name] = Histogram(self.latency_bounds)
+        return entry
+
+
+
+############################################################################
+
+
+class StatsPoller(object):
+    """
+    Samples STATS of several clamd endpoints on an interval, in a background
+    thread, and keeps the recent samples of each one
+    """
+    def __init__(self, clients, interval=10.0, history=360, on_sample=None, start=True):
+        """
+        clients : either
+          - (list) clients or endpoints, see cluster.parse_endpoint
+          - (ClamdCluster) every node of the cluster is sampled
+        interval (float) : seconds between two samples of an endpoint
+        history (int) : number of samples kept per endpoint
+        on_sample (callable or None) : called as on_sample(name, stats) after
+          each successful sample, stats being a ClamdStats
+        start (bool) : start the background thread, otherwise samples are
+          only taken by poll()
+        """
+        assert isinstance(interval, (float, int)) and interval > 0, 'Wrong value for [interval], should be a positive float [was {0}]'.format(interval)
+        assert isinstance(history, int) and history > 0, 'Wrong value for [history], should be a positive int [was {0}]'.format(history)
+
+        if hasattr(clients, 'nodes'):
+            self._endpoints = [(node.name, node.get_client) for node in clients.nodes]
+        else:
+            self._endpoints = [parse_endpoint(client) for client in clients]
+        self.names = [name for name, factory in self._endpoints]
+        self.interval = interval
+        self.on_sample = on_sample
+
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._samples = dict((name, collections.deque(maxlen=history)) for name in self.names)
+        self._errors = dict((name, 0) for name in self.names)
+        self._last_errors = dict((name, None) for name in self.names)
+
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def close(self):
+        """
+        Stop the background thread
+        """
+        self._stop.set()
+        return
+
+
+    def poll(self):
+        """
+        Sample every endpoint now
+
+        return: (dict) {name: ClamdStats or None if it could not be sampled}
+        """
+        result = {}
+        for name, factory in self._endpoints:
+            result[name] = self._sample(name, factory)
+        return result
+
+
+    def latest(self, name=None):
+        """
+        Get the last sample of an endpoint
+
+        name (string or None) : endpoint name, None for every endpoint
+
+        return: ClamdStats or None if no sample was taken yet, or a dict
+          {name: ClamdStats or None} if name is None
+        """
+        with self._lock:
+            if name is None:
+                return dict((name, samples[-1][1] if samples else None) for name, samples in self._samples.items())
+            samples = self._samples[name]
+            return samples[-1][1] if samples else None
+
+
+    def history(self, name):
+        """
+        return: (list) (timestamp, ClamdStats) samples of an endpoint, oldest
+          first
+        """
+        with self._lock:
+            return list(self._samples[name])
+
+
+    def series(self, name, field):
+        """
+        Get the time series of a field
+
+        name (string) : endpoint name
+        field (string) : ClamdStats attribute, e.g. 'queue_length',
+          'threads_busy' or 'memory_used'
+
+        return: (list) (timestamp, value) samples, oldest first
+        """
+        return [(timestamp, getattr(stats, field)) for timestamp, stats in self.history(name)]
+
+
+    def errors(self):
+        """
+        return: (dict) {name: (failed samples, last error or None)}
+        """
+        with self._lock:
+            return dict((name, (self._errors[name], self._last_errors[name])) for name in self.names)
+
+
+    def _run(self):
+        """
+        internal use only
+        """
+        while True:
+            self.poll()
+            if self._stop.wait(self.interval):
+                return
+
+
+    def _sample(self, name, factory):
+        """
+        internal use only
+        """
+        try:
+            client = self._clients.get(name)
+            if client is None:
+                client = self._clients[name] = factory()
+            stats = client.get_stats()
+        except socket.error as e:
+            with self._lock:
+                self._errors[name] += 1
+                self._last_errors[name] = e
+            return None
+
+        with self._lock:
+            self._samples[name].append((time.time(), stats))
+        if self.on_sample is not None:
+            self.on_sample(name, stats)
+        return stats
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+pool.py - thread-safe pool of clamd connections
+
+Usage :
+
+  import pyclamd
+  pool = pyclamd.ClamdPool(pyclamd.ClamdAgnostic(), maxsize=4)
+  pool.scan_stream(pool.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  with pool.connection() as session:
+      requests = [session.submit_scan_stream(pool.EICAR()) for i in range(4)]
+  pool.pool_stats()['checkouts']
+  # 2
+"""
+
+import contextlib
+import socket
+import threading
+import time
+
+from .pyclamd import ConnectionError, scan_many, _register_fork_safe, _check_fork
+
+
+############################################################################
+
+
+class ClamdPool(object):
+    """
+    Thread-safe pool of warm clamd connections (IDSESSION sessions)
+
+    A ClamdPool may be used in place of ClamdUnixSocket or ClamdNetworkSocket
+    and shared between threads: PING, VERSION, STATS, SCAN and INSTREAM are
+    sent on a pooled connection, other commands (CONTSCAN, MULTISCAN,
+    RELOAD...) are sent by the wrapped client on a new connection.
+    """
+    def __init__(self, client, maxsize=8, idle_timeout=20.0, check_interval=5.0, wait_timeout=None):
+        """
+        Pool initialisation
+
+        client (ClamdUnixSocket or ClamdNetworkSocket) : client giving the
+          connections to clamd
+        maxsize (int) : maximum number of open connections
+        idle_timeout (float) : connections unused for longer are closed. It
+          should be lower than IdleTimeout in clamd.conf (30s by default)
+        check_interval (float) : connections unused for longer are checked
+          with a PING before being used
+        wait_timeout (float or None) : how long to wait for a free connection
+          when maxsize connections are in use, None to wait forever
+        """
+        assert isinstance(maxsize, int) and maxsize > 0, 'Wrong value for [maxsize], should be a positive int [was {0}]'.format(maxsize)
+        assert isinstance(idle_timeout, (float, int)), 'Wrong type for [idle_timeout], should be a float [was {0}]'.format(type(idle_timeout))
+        assert isinstance(check_interval, (float, int)), 'Wrong type for [check_interval], should be a float [was {0}]'.format(type(check_interval))
+        assert isinstance(wait_timeout, (float, int)) or wait_timeout is None, 'Wrong type for [wait_timeout], should be either None or a float [was {0}]'.format(type(wait_timeout))
+
+        self.client = client
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.closed = False
+
+        self._reset()
+        _register_fork_safe(self)
+        return
+
+
+    def __getstate__(self):
+        """
+        Only the client and the settings of the pool are pickled, the other
+        process gets an empty pool
+        """
+        return {'client': self.client, 'maxsize': self.maxsize, 'idle_timeout': self.idle_timeout,
+                'check_interval': self.check_interval, 'wait_timeout': self.wait_timeout}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+        return
+
+
+    def _reset(self):
+        """
+        internal use only
+        """
+        self._lock = threading.Condition()
+        self._idle = []
+        self._size = 0
+
+        self._checkouts = 0
+        self._misses = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._evictions = 0
+        self._failed_checks = 0
+        return
+
+
+    def _after_fork(self):
+        """
+        internal use only
+        the connections of the parent process are left to it (each
+        ClamdSession is reset on its own), a child process starts with an
+        empty pool
+        """
+        self._reset()
+        return
+
+
+    def __getattr__(self, name):
+        # commands which can not be sent in a session are delegated to the
+        # wrapped client
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def ping(self):
+        """
+        See _ClamdGeneric.ping
+        """
+        return self._call('ping')
+
+
+    def version(self):
+        """
+        See _ClamdGeneric.version
+        """
+        return self._call('version')
+
+
+    def stats(self):
+        """
+        See _ClamdGeneric.stats
+        """
+        return self._call('stats')
+
+
+    def get_stats(self):
+        """
+        See _ClamdGeneric.get_stats
+        """
+        return self._call('get_stats')
+
+
+    def scan_file(self, file, *args, **kwargs):
+        """
+        Scan a file given by filename, see ClamdSession.scan_file
+        """
+        return self._call('scan_file', file, *args, **kwargs)
+
+
+    def scan_stream(self, buffer_to_test, *args, **kwargs):
+        """
+        Scan a buffer, see ClamdSession.scan_stream (chunk_size)
+        """
+        return self._call('scan_stream', buffer_to_test, *args, **kwargs)
+
+
+    def scan_many(self, items, concurrency=None, ordered=False):
+        """
+        Scan many items on pooled connections, see pyclamd.scan_many
+
+        concurrency (int or None) : number of concurrent scans, maxsize if
+          None
+        """
+        return scan_many(self, items, concurrency=concurrency or self.maxsize, ordered=ordered)
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with statement
+
+        return: (ClamdSession) for the exclusive use of the caller
+
+        May raise:
+          - ConnectionError: if no connection could be opened or none was
+            freed before wait_timeout
+        """
+        session = self._checkout()
+        pid = self._pid
+        try:
+            yield session
+        except socket.error:
+            self._checkin(session, pid, broken=True)
+            raise
+        except:
+            # errors of the caller (BufferTooLongError, wrong argument...)
+            # do not break the connection
+            self._checkin(session, pid, broken=session.error is not None)
+            raise
+        self._checkin(session, pid, broken=session.error is not None)
+        return
+
+
+    def close(self):
+        """
+        Close idle connections, connections in use are closed when they are
+        given back to the pool
+
+        return: nothing
+        """
+        with self._lock:
+            self.closed = True
+            idle = [session for session, last_used in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._lock.notify_all()
+        self._close_sessions(idle)
+        return
+
+
+    def pool_stats(self):
+        """
+        Get statistics about the pool
+
+        return: (dict) with keys
+          - size: open connections
+          - idle: open connections not in use
+          - checkouts: connections given to callers
+          - misses: checkouts which had to open a new connection
+          - wait_time: total time spent waiting for a connection (seconds)
+          - max_wait_time: longest wait for a connection (seconds)
+          - evictions: connections closed because they were idle too long
+          - failed_checks: connections found dead by the PING check
+        """
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'misses': self._misses,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'evictions': self._evictions,
+                'failed_checks': self._failed_checks,
+                }
+
+
+    def _call(self, name, *args, **kwargs):
+        """
+        internal use only
+        runs a ClamdSession method on a pooled connection
+        """
+        with self.connection() as session:
+            return getattr(session, name)(*args, **kwargs)
+
+
+    def _checkout(self):
+        """
+        internal use only
+        """
+        _check_fork(self)
+        start = time.time()
+        with self._lock:
+            while True:
+                if self.closed:
+                    raise ConnectionError('Pool is closed')
+                evicted = self._evict_idle()
+                if self._idle:
+                    session, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxsize:
+                    self._size += 1
+                    session, last_used = None, None
+                    break
+                if self.wait_timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = self.wait_timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise ConnectionError('No clamd connection available in pool after {0}s'.format(self.wait_timeout))
+                    self._lock.wait(remaining)
+
+            wait_time = time.time() - start
+            self._checkouts += 1
+            self._wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            if session is None:
+                self._misses += 1
+        self._close_sessions(evicted)
+
+        if session is not None and time.time() - last_used > self.check_interval:
+            try:
+                session.ping()
+            except ConnectionError:
+                session.close()
+                session = None
+                with self._lock:
+                    self._failed_checks += 1
+                    self._misses += 1
+
+        if session is None:
+            try:
+                session = self.client.session()
+            except:
+                with self._lock:
+                    self._size -= 1
+                    self._lock.notify()
+                raise
+        return session
+
+
+    def _checkin(self, session, pid, broken=False):
+        """
+        internal use only
+        pid is the process which checked out session, a session checked out
+        before a fork is not counted by the pool of the child process
+        """
+        _check_fork(self)
+        if pid != self._pid:
+            self._close_sessions([session])
+            return
+        with self._lock:
+            if broken or self.closed:
+                self._size -= 1
+            else:
+                self._idle.append((session, time.time()))
+                session = None
+            self._lock.notify()
+        if session is not None:
+            self._close_sessions([session])
+        return
+
+
+    def _evict_idle(self):
+        """
+        internal use only
+        removes connections idle for too long, self._lock being held, and
+        returns them to be closed
+        """
+        deadline = time.time() - self.idle_timeout
+        evicted = [session for session, last_used in self._idle if last_used < deadline]
+        if evicted:
+            self._idle = [(session, last_used) for session, last_used in self._idle if last_used >= deadline]
+            self._size -= len(evicted)
+            self._evictions += len(evicted)
+        return evicted
+
+
+    def _close_sessions(self, sessions):
+        """
+        internal use only
+        """
+        for session in sessions:
+            try:
+                session.close()
+            except ConnectionError:
+                pass
+        return
@@ -51,12 +51,68 @@
 # 2014-07-06 v0.3.9 SK/AN: - Bug correction + setup.py improvment for building
 # 2014-07-06 v0.3.10 SK/AN: - Bug correction with python3 bytes stream
 # 2015-03-14 v0.3.14 AN : - Bug correction for clamd.conf default path
+# 2026-10-17 v0.4.0     : - ClamdSession: IDSESSION mode with pipelined commands
+#                           on a single connection
+#                         - clients may be shared between threads
+#                         - ClamdPool: thread-safe pool of clamd connections
+#                         - AsyncClamdUnixSocket / AsyncClamdNetworkSocket:
+#                           asyncio clients, checking the limits of clamd
+#                           as the other clients
+#                         - scan_stream: zero-copy INSTREAM with scatter/gather
+#                           sendmsg and a configurable chunk size, any object
+#                           supporting the buffer protocol may be scanned
+#                         - scan_iter, scan_fileobj and ScanningWriter: scans
+#                           streamed to clamd with constant memory
+#                         - ClamdUnixSocket.scan_fd / scan_path_fildes: file
+#                           descriptors passed to clamd (FILDES)
+#                         - CachingClamd: verdict cache keyed by content digest
+#                           and signature database version
+#                         - scan_tree_incremental: directory scans skipping
+#                           unchanged files, with a persistent index
+#                         - scan_many: batch scans on concurrent connections
+#                         - ClamdCluster: requests spread over several clamd
+#                           nodes, with health checks and failover
+#                         - HedgedClamd: slow INSTREAM scans sent again to
+#                           another replica, within a budget
+#                         - iter_contscan / iter_multiscan: results yielded as
+#                           clamd sends them
+#                         - ReplyDecoder: replies framed by lines whatever the
+#                           reads, newline or null terminated
+#                         - get_stats: STATS parsed into ClamdStats, fixed
+#                           decoding errors in _recv_response_multiline
+#                         - StatsPoller: background sampling of STATS
+#                         - AdmissionController: AIMD concurrency limit driven
+#                           by latency and clamd queue length
+#                         - observer hooks: CommandTrace of each command
+#                           (connect, bytes, first byte, total time, verdict)
+#                         - pyclamd.bench: clamd protocol emulator (FakeClamd)
+#                           and benchmarks with JSON output
+#                         - pyclamd command: concurrent scans of files over
+#                           several endpoints, NDJSON results and a summary
+#                         - Watcher / watch: inotify watch of directories,
+#                           files scanned as they are written (pyclamd --watch)
+#                         - ClamdLimits: StreamMaxLength, MaxFileSize and
+#                           MaxScanSize read from clamd.conf or given, streams
+#                           too long refused before being sent, large files
+#                           passed with FILDES or scanned by path instead
+#                         - lazy clients, clamd.conf parsed once per process,
+#                           ClamdAgnostic picks its endpoint from clamd.conf
+#                           without connecting
+#                         - fork-safe clients, sessions, pools and clusters,
+#                           reset in child processes; clients, pools and
+#                           clusters may be pickled (endpoint settings only)
+#                         - pyclamd.contrib: WSGI and ASGI middlewares scanning
+#                           request bodies while they are uploaded
+#                         - PriorityScheduler: priority classes and tenants
+#                           served by weighted fair queuing, reserved slots,
+#                           queue wait histograms per class
+#                         - SingleFlightClamd / AsyncSingleFlightClamd:
+#                           identical scans running at the same time sent
+#                           only once
 #------------------------------------------------------------------------------
 # TODO:
 # - improve tests for Win32 platform (avoid to write EICAR file to disk, or
 #   protect it somehow from on-access AV, inside a ZIP/GZip archive isn't enough)
-# - use SESSION/END commands to launch several scans in one session
-#   (for example provide session mode in a Clamd class)
 # - add support for RAWSCAN commands ?
 # ? Maybe use os.abspath to ensure scan_file uses absolute paths for files
 #------------------------------------------------------------------------------
@@ -126,7 +182,7 @@ True
 >>> os.remove('/tmp/EICAR-éèô请收藏我们的网址')
 """
 
-__version__ = "0.3.14"
+__version__ = "0.4.0"
 
 
 # $Source$
@@ -134,9 +190,21 @@ __version__ = "0.3.14"
 
 import os
 import sys
+import array
 import socket
 import struct
 import base64
+import stat
+import time
+import functools
+import threading
+import collections
+import weakref
+try:
+    import queue
+except ImportError:
+    # Python2
+    import Queue as queue
 
 ############################################################################
 
@@ -158,6 +226,695 @@ except NameError:
         return isinstance(s, str)
 
 
+# size of INSTREAM chunks, it MUST be < StreamMaxLength in
+# /etc/clamav/clamd.conf or /etc/clamd.conf
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# chunk lengths are sent as 32 bits unsigned integers
+MAX_CHUNK_SIZE = 2**32 - 1
+
+
+############################################################################
+
+
+# objects holding connections, locks or threads of the process which created
+# them, reset in a child process after a fork
+_fork_safe = weakref.WeakSet()
+
+
+def _register_fork_safe(obj):
+    """
+    internal use only
+    records the process owning obj: obj._after_fork() is called in a child
+    process after a fork, by os.register_at_fork when available, otherwise
+    on the next use of obj (see _check_fork)
+    """
+    obj._pid = os.getpid()
+    _fork_safe.add(obj)
+    return
+
+
+def _check_fork(obj):
+    """
+    internal use only
+    resets obj if it is used by another process than the one owning it
+    """
+    pid = os.getpid()
+    if obj._pid != pid:
+        obj._pid = pid
+        obj._after_fork()
+    return
+
+
+def _after_fork_in_child():
+    """
+    internal use only
+    """
+    for obj in list(_fork_safe):
+        _check_fork(obj)
+    return
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _assert_stream_type(buffer_to_test):
+    """
+    internal use only
+    checks the type of a buffer given to scan_stream
+    """
+    if sys.version_info[0] <= 2:
+        # Python2
+        assert isstr(buffer_to_test) or isinstance(buffer_to_test, (bytearray, memoryview, buffer)), 'Wrong type fom [buffer_to_test], should be str [was {0}]'.format(type(buffer_to_test))
+    else:
+        # Python3
+        try:
+            memoryview(buffer_to_test)
+        except TypeError:
+            raise AssertionError('Wrong type fom [buffer_to_test], should be bytes, bytearray or support the buffer protocol [was {0}]'.format(type(buffer_to_test)))
+    return
+
+
+def _encode_command(cmd):
+    """
+    internal use only
+    returns cmd prefixed by n and terminated by \\n, ready to be sent to clamd
+    """
+    try:
+        return str.encode('n{0}\n'.format(cmd))
+    except UnicodeDecodeError:
+        return 'n{0}\n'.format(cmd)
+
+
+def _decode(data):
+    """
+    internal use only
+    decodes bytes received from clamd, keeping them as is if not decodable
+    """
+    try:
+        return bytes.decode(data)
+    except UnicodeDecodeError:
+        return data
+
+
+def _split_reply(line, colon, space):
+    """
+    internal use only
+    splits a reply line of SCAN, CONTSCAN, MULTISCAN or INSTREAM in one pass,
+    line being either bytes or a string (colon and space of the same type)
+
+    return: (filename, reason, status)
+    """
+    filename, sep, result = line.strip().partition(colon)
+    if not sep:
+        filename, result = filename[:0], filename
+    reason, sep, status = result.rpartition(space)
+    return filename, reason, status
+
+
+def _parse_response(msg):
+    """
+    internal use only
+    parses responses for SCAN, CONTSCAN, MULTISCAN and STREAM commands.
+
+    return: (filename, reason, status)
+    """
+    return _split_reply(msg, ': ', ' ')
+
+
+def _parse_reply(line):
+    """
+    internal use only
+    same as _parse_response for a line of bytes, decoded once split
+    """
+    filename, reason, status = _split_reply(line, b': ', b' ')
+    try:
+        return filename.decode('utf-8'), reason.decode('utf-8'), status.decode('utf-8')
+    except UnicodeDecodeError:
+        return _decode(filename), _decode(reason), _decode(status)
+
+
+def _parse_scan_results(results, stop_on_error=False):
+    """
+    internal use only
+    parses the reply lines of SCAN, CONTSCAN, MULTISCAN and INSTREAM
+
+    results (list of strings) : reply lines
+    stop_on_error (bool) : ignore the lines following the first ERROR, as SCAN
+      does
+
+    return either :
+      - (dict): {filename1: ('FOUND', 'virusname'), filename2: ('ERROR', 'reason')}
+      - None: if no virus found
+
+    May raise :
+      - BufferTooLongError: if clamd replied that the stream was too long
+    """
+    dr = {}
+    for result in results:
+        if len(result) == 0:
+            continue
+
+        if result == 'INSTREAM size limit exceeded. ERROR':
+            raise BufferTooLongError(result)
+
+        filename, reason, status = _parse_response(result)
+        if status == 'ERROR':
+            dr[filename] = ('ERROR', '{0}'.format(reason))
+            if stop_on_error:
+                break
+
+        elif status == 'FOUND':
+            dr[filename] = ('FOUND', '{0}'.format(reason))
+
+    if not dr:
+        return None
+    return dr
+
+
+def _stats_number(value):
+    """
+    internal use only
+    converts a STATS value: '9.082M' to 9.082 (MB), '12' to 12, 'N/A' to None
+    """
+    try:
+        if value.endswith('M'):
+            return float(value[:-1])
+        if '.' in value:
+            return float(value)
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _stats_pairs(value):
+    """
+    internal use only
+    returns the 'name value name value...' pairs of a STATS line as a dict
+    """
+    words = value.split()
+    return dict((words[i], _stats_number(words[i + 1])) for i in range(0, len(words) - 1, 2))
+
+
+
+class ClamdStats(object):
+    """
+    Parsed reply of STATS
+
+    Attributes (None when clamd did not give them):
+      - raw (string): reply of clamd
+      - pools (int): number of thread pools
+      - state (string): e.g. 'VALID PRIMARY'
+      - threads_live, threads_idle, threads_max (int): scanning threads
+      - threads_idle_timeout (int): seconds before an idle thread exits
+      - queue_length (int): commands waiting for a thread
+      - queue_items (list): (command, seconds in queue, filename or None)
+      - memory_heap, memory_mmap, memory_used, memory_free,
+        memory_releasable, memory_pools_used, memory_pools_total (float): MB
+    """
+    fields = ('pools', 'state', 'threads_live', 'threads_idle', 'threads_max', 'threads_idle_timeout',
+              'queue_length', 'memory_heap', 'memory_mmap', 'memory_used', 'memory_free',
+              'memory_releasable', 'memory_pools_used', 'memory_pools_total')
+
+    def __init__(self, raw):
+        """
+        raw (string) : reply of STATS
+        """
+        assert isstr(raw), 'Wrong type for [raw], should be a string [was {0}]'.format(type(raw))
+
+        self.raw = raw
+        for field in self.fields:
+            setattr(self, field, None)
+        self.queue_items = []
+
+        in_queue = False
+        for line in raw.splitlines():
+            line = line.strip()
+            if not line or line == 'END':
+                continue
+            key, sep, value = line.partition(': ')
+            if key == 'POOLS':
+                self.pools = _stats_number(value)
+            elif key == 'STATE':
+                self.state = value
+            elif key == 'THREADS':
+                threads = _stats_pairs(value)
+                self.threads_live = threads.get('live')
+                self.threads_idle = threads.get('idle')
+                self.threads_max = threads.get('max')
+                self.threads_idle_timeout = threads.get('idle-timeout')
+            elif key == 'QUEUE':
+                self.queue_length = _stats_number(value.split()[0])
+                in_queue = True
+                continue
+            elif key == 'MEMSTATS':
+                memory = _stats_pairs(value)
+                for name in ('heap', 'mmap', 'used', 'free', 'releasable', 'pools_used', 'pools_total'):
+                    setattr(self, 'memory_' + name, memory.get(name))
+            elif in_queue:
+                # commands in queue: 'COMMAND seconds [filename]'
+                parts = line.split(None, 2)
+                seconds = _stats_number(parts[1]) if len(parts) > 1 else None
+                self.queue_items.append((parts[0], seconds, parts[2] if len(parts) > 2 else None))
+                continue
+            in_queue = False
+        return
+
+
+    def __repr__(self):
+        return 'ClamdStats({0})'.format(', '.join('{0}={1!r}'.format(field, getattr(self, field)) for field in self.fields))
+
+
+    @property
+    def threads_busy(self):
+        """
+        (int) threads scanning, None if unknown
+        """
+        if self.threads_live is None or self.threads_idle is None:
+            return None
+        return self.threads_live - self.threads_idle
+
+
+    def as_dict(self):
+        """
+        return: (dict) the parsed fields, queue_items and threads_busy
+        """
+        result = dict((field, getattr(self, field)) for field in self.fields)
+        result['threads_busy'] = self.threads_busy
+        result['queue_items'] = list(self.queue_items)
+        return result
+
+
+
+class ReplyDecoder(object):
+    """
+    Incremental decoder of clamd replies: data received from clamd is fed as
+    it comes and complete lines are returned as bytes, whatever the way they
+    were split between reads. Lines end with a newline (n-prefixed commands)
+    or a null character (z-prefixed commands). Empty lines are dropped.
+
+    >>> decoder = ReplyDecoder()
+    >>> decoder.feed(b'/tmp/a: OK\\n/tmp/b: Eica')
+    [b'/tmp/a: OK']
+    >>> decoder.feed(b'r-Test-Signature FOUND\\n')
+    [b'/tmp/b: Eicar-Test-Signature FOUND']
+    """
+    def __init__(self, delimiter=None):
+        """
+        delimiter (bytes or None) : b'\\n', b'\\0' or None for both
+        """
+        assert delimiter in (None, b'\n', b'\0'), 'Wrong value for [delimiter], should be None, newline or null [was {0!r}]'.format(delimiter)
+
+        self.delimiter = delimiter
+        self._buffer = bytearray()
+        return
+
+
+    def feed(self, data):
+        """
+        Add data received from clamd
+
+        return: (list of bytes) the lines completed by data
+        """
+        if self.delimiter is None:
+            delimiter = b'\n'
+            if b'\0' in data:
+                data = data.replace(b'\0', b'\n')
+        else:
+            delimiter = self.delimiter
+
+        if delimiter not in data:
+            # most replies are shorter than a read, nothing to split yet
+            self._buffer += data
+            return []
+
+        buffer = self._buffer
+        buffer += data
+        end = buffer.rfind(delimiter)
+        lines = bytes(buffer[:end]).split(delimiter)
+        del buffer[:end + 1]
+        if not all(lines):
+            lines = [line for line in lines if line]
+        return lines
+
+
+    def flush(self):
+        """
+        Get the last line when clamd closed the connection without
+        terminating it
+
+        return: (list of bytes) the pending line, if any
+        """
+        line = bytes(self._buffer)
+        del self._buffer[:]
+        if line.strip():
+            return [line]
+        return []
+
+
+
+def _iter_lines(clamd_socket, bufsize=4096):
+    """
+    internal use only
+    yields the lines (bytes) received on clamd_socket until it is closed by
+    clamd
+    """
+    decoder = ReplyDecoder()
+    while True:
+        data = clamd_socket.recv(bufsize)
+        if not data:
+            break
+        for line in decoder.feed(data):
+            yield line
+    for line in decoder.flush():
+        yield line
+    return
+
+
+def _stream_view(buffer_to_test):
+    """
+    internal use only
+    returns a memoryview of bytes on any object supporting the buffer
+    protocol (bytes, bytearray, mmap, array, numpy arrays...), without copy
+    """
+    view = memoryview(buffer_to_test)
+    if sys.version_info[0] >= 3 and (view.ndim != 1 or view.itemsize != 1):
+        view = view.cast('B')
+    return view
+
+
+def _stream_frames(view, chunk_size):
+    """
+    internal use only
+    yields INSTREAM frames (length prefix, payload) slicing view without copy
+    """
+    for start in range(0, len(view), chunk_size):
+        chunk = view[start:start + chunk_size]
+        yield struct.pack('!L', len(chunk))
+        yield chunk
+    return
+
+
+# terminating zero length chunk of INSTREAM
+_STREAM_END = struct.pack('!L', 0)
+
+# maximum number of buffers given to one sendmsg call
+_IOV_MAX = 64
+
+
+def _send_buffers(clamd_socket, buffers):
+    """
+    internal use only
+    sends all buffers on clamd_socket, with scatter/gather sendmsg when
+    available, handling short writes
+    """
+    if not hasattr(clamd_socket, 'sendmsg'):
+        # Python2 and Windows
+        for data in buffers:
+            clamd_socket.sendall(data)
+        return
+
+    first = 0
+    while first < len(buffers):
+        sent = clamd_socket.sendmsg(buffers[first:first + _IOV_MAX])
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = memoryview(buffers[first])[sent:]
+    return
+
+
+def _send_frames(clamd_socket, buffers, chunk, chunk_size):
+    """
+    internal use only
+    appends the INSTREAM frames of chunk to buffers, sending them by groups of
+    _IOV_MAX, and returns the buffers not sent yet
+    """
+    for frame in _stream_frames(_stream_view(chunk), chunk_size):
+        buffers.append(frame)
+        if len(buffers) >= _IOV_MAX:
+            _send_buffers(clamd_socket, buffers)
+            buffers = []
+    return buffers
+
+
+def _check_chunk_size(chunk_size):
+    """
+    internal use only
+    returns chunk_size or DEFAULT_CHUNK_SIZE if None
+    """
+    if chunk_size is None:
+        return DEFAULT_CHUNK_SIZE
+    assert isinstance(chunk_size, int) and 0 < chunk_size <= MAX_CHUNK_SIZE, 'Wrong value for [chunk_size], should be an int between 1 and {0} [was {1}]'.format(MAX_CHUNK_SIZE, chunk_size)
+    return chunk_size
+
+
+def _send_stream(clamd_socket, buffer_to_test, chunk_size=None, header=None):
+    """
+    internal use only
+    sends buffer_to_test as INSTREAM chunks on clamd_socket, followed by the
+    terminating zero length chunk.
+
+    clamd_socket (socket) : connected socket
+    buffer_to_test : any object supporting the buffer protocol
+    chunk_size (int or None) : size of INSTREAM chunks, DEFAULT_CHUNK_SIZE if None
+    header (bytes or None) : sent before the first chunk, in the same system
+      call (usually the INSTREAM command)
+    """
+    chunk_size = _check_chunk_size(chunk_size)
+    buffers = [header] if header is not None else []
+    buffers = _send_frames(clamd_socket, buffers, buffer_to_test, chunk_size)
+    buffers.append(_STREAM_END)
+    _send_buffers(clamd_socket, buffers)
+    return
+
+
+def _send_stream_iter(clamd_socket, chunks, chunk_size=None, header=None):
+    """
+    internal use only
+    same as _send_stream for an iterable of buffers. Each buffer is sent
+    before the next one is requested, so the iterable may reuse its memory.
+    """
+    chunk_size = _check_chunk_size(chunk_size)
+    buffers = [header] if header is not None else []
+    for chunk in chunks:
+        buffers = _send_frames(clamd_socket, buffers, chunk, chunk_size)
+        _send_buffers(clamd_socket, buffers)
+        buffers = []
+    buffers.append(_STREAM_END)
+    _send_buffers(clamd_socket, buffers)
+    return
+
+
+def _fileno(fd):
+    """
+    internal use only
+    returns the file descriptor of fd, an int or a file object
+    """
+    if hasattr(fd, 'fileno'):
+        fd = fd.fileno()
+    assert isinstance(fd, int), 'Wrong type for [fd], should be an int or a file object [was {0}]'.format(type(fd))
+    return fd
+
+
+def _check_fildes(clamd_socket):
+    """
+    internal use only
+    raises NotImplementedError if file descriptors can not be passed on
+    clamd_socket
+    """
+    if not hasattr(clamd_socket, 'sendmsg') or not hasattr(socket, 'SCM_RIGHTS'):
+        raise NotImplementedError('FILDES needs socket.sendmsg and SCM_RIGHTS (Python >= 3.3 on unix)')
+    return
+
+
+def _send_fildes(clamd_socket, fd):
+    """
+    internal use only
+    sends the FILDES command followed by fd as SCM_RIGHTS ancillary data of a
+    one byte message, as clamdscan does
+    """
+    _check_fildes(clamd_socket)
+    clamd_socket.sendall(_encode_command('FILDES'))
+    clamd_socket.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+    return
+
+
+def _iter_fileobj(fileobj, chunk_size):
+    """
+    internal use only
+    yields the content of fileobj by chunks of at most chunk_size bytes. The
+    same memory is reused for every chunk when fileobj has readinto.
+    """
+    if hasattr(fileobj, 'readinto'):
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            size = fileobj.readinto(buf)
+            if not size:
+                break
+            yield view[:size]
+    else:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            yield data
+    return
+
+
+############################################################################
+
+
+# monotonic clock when available
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class CommandTrace(object):
+    """
+    Measures of one clamd command, given to observers
+
+    Attributes :
+      - command (string): 'PING', 'SCAN', 'INSTREAM', 'FILDES'...
+      - connect_time (float): seconds spent connecting to clamd
+      - bytes_sent, bytes_received (int): bytes exchanged with clamd
+      - first_byte_time (float or None): seconds from the start of the
+        command to the first byte of the reply
+      - total_time (float): seconds from the start to the end of the command
+      - verdict (string or None): for scans, 'OK', 'FOUND' (a virus was
+        found) or 'ERROR' (only errors were reported)
+      - error (string or None): class name of the exception raised
+    """
+    __slots__ = ('command', 'start', 'connect_time', 'bytes_sent', 'bytes_received',
+                 'first_byte_time', 'total_time', 'verdict', 'error')
+
+    def __init__(self, command):
+        self.command = command
+        self.start = _clock()
+        self.connect_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first_byte_time = None
+        self.total_time = None
+        self.verdict = None
+        self.error = None
+        return
+
+
+    def __repr__(self):
+        return 'CommandTrace({0})'.format(', '.join('{0}={1!r}'.format(name, getattr(self, name)) for name in self.__slots__ if name != 'start'))
+
+
+
+class NullObserver(object):
+    """
+    Observer of clamd commands doing nothing, the default one.
+
+    An observer is any object with an enabled attribute and an
+    observe(trace) method called with a CommandTrace at the end of each
+    command of a client. Commands are not measured while enabled is False.
+    """
+    enabled = False
+
+    def observe(self, trace):
+        return
+
+
+# default observer of clients
+NULL_OBSERVER = NullObserver()
+
+
+def _verdict(result):
+    """
+    internal use only
+    summarizes the result of a scan
+    """
+    if result is None:
+        return 'OK'
+    for status, reason in result.values():
+        if status == 'FOUND':
+            return 'FOUND'
+    return 'ERROR'
+
+
+def _observed(command, scan=False):
+    """
+    internal use only
+    decorator of _ClamdGeneric methods reporting a CommandTrace to the
+    observer of the client. Methods called by an observed method are part of
+    its trace.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            observer = self.observer
+            if not observer.enabled or getattr(self._thread_local, 'trace', None) is not None:
+                return method(self, *args, **kwargs)
+
+            trace = self._thread_local.trace = CommandTrace(command)
+            try:
+                result = method(self, *args, **kwargs)
+                if scan:
+                    trace.verdict = _verdict(result)
+                return result
+            except Exception as e:
+                trace.error = type(e).__name__
+                raise
+            finally:
+                self._thread_local.trace = None
+                trace.total_time = _clock() - trace.start
+                observer.observe(trace)
+        return wrapper
+    return decorator
+
+
+
+class _ObservedSocket(object):
+    """
+    internal use only
+    socket wrapper counting the bytes exchanged in a CommandTrace
+    """
+    def __init__(self, clamd_socket, trace):
+        self._socket = clamd_socket
+        self._trace = trace
+        if hasattr(clamd_socket, 'sendmsg'):
+            self.sendmsg = self._sendmsg
+        return
+
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+    def send(self, data, *args):
+        sent = self._socket.send(data, *args)
+        self._trace.bytes_sent += sent
+        return sent
+
+
+    def sendall(self, data, *args):
+        self._socket.sendall(data, *args)
+        self._trace.bytes_sent += len(data)
+        return
+
+
+    def _sendmsg(self, buffers, *args):
+        sent = self._socket.sendmsg(buffers, *args)
+        self._trace.bytes_sent += sent
+        return sent
+
+
+    def recv(self, bufsize, *args):
+        data = self._socket.recv(bufsize, *args)
+        trace = self._trace
+        if data and trace.first_byte_time is None:
+            trace.first_byte_time = _clock() - trace.start
+        trace.bytes_received += len(data)
+        return data
+
+
+
 ############################################################################
 
 
@@ -165,6 +922,62 @@ class _ClamdGeneric(object):
     """
     Abstract class for clamd
     """
+
+    # size of INSTREAM chunks used by scan_stream, it MUST be < StreamMaxLength
+    # in clamd.conf
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    # observer of the commands, see NullObserver
+    observer = NULL_OBSERVER
+
+    # size limits of clamd (ClamdLimits) checked before sending data, None
+    # when unknown
+    limits = None
+
+    def __init__(self):
+        """
+        Generic initialisation, the socket used by a command is kept per
+        thread so that an instance may be shared between threads
+        """
+        self._thread_local = threading.local()
+        _register_fork_safe(self)
+        return
+
+
+    def __getstate__(self):
+        """
+        Only the endpoint and its settings are pickled (not the connections
+        nor the observer), so that a client may be given to another process
+        """
+        return dict((name, value) for name, value in self.__dict__.items() if not name.startswith('_') and name != 'observer')
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _ClamdGeneric.__init__(self)
+        return
+
+
+    def _after_fork(self):
+        """
+        internal use only
+        the connections of the parent process are left to it
+        """
+        self._thread_local = threading.local()
+        return
+
+
+    def _get_clamd_socket(self):
+        return self._thread_local.clamd_socket
+
+
+    def _set_clamd_socket(self, clamd_socket):
+        self._thread_local.clamd_socket = clamd_socket
+        self._thread_local.replies = None
+
+
+    clamd_socket = property(_get_clamd_socket, _set_clamd_socket)
+
     
     def EICAR(self):
         """
@@ -176,6 +989,7 @@ class _ClamdGeneric(object):
         return EICAR
         
 
+    @_observed('PING')
     def ping(self):
         """
         Send a PING to the clamav server, which should reply
@@ -204,6 +1018,7 @@ class _ClamdGeneric(object):
 
 
     
+    @_observed('VERSION')
     def version(self):
         """
         Get Clamscan version
@@ -224,6 +1039,7 @@ class _ClamdGeneric(object):
         return result
 
 
+    @_observed('STATS')
     def stats(self):
         """
         Get Clamscan stats
@@ -239,11 +1055,24 @@ class _ClamdGeneric(object):
             result = self._recv_response_multiline()
             self._close_socket()
         except socket.error:
-            raise ConnectionError('Could not get version information from server')
+            raise ConnectionError('Could not get stats from server')
 
         return result
 
+
+    def get_stats(self):
+        """
+        Get Clamscan stats, parsed
+
+        return: (ClamdStats) threads, queue and memory figures of clamd
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return ClamdStats(self.stats())
+
     
+    @_observed('RELOAD')
     def reload(self):
         """
         Force Clamd to reload signature database
@@ -268,6 +1097,7 @@ class _ClamdGeneric(object):
 
 
     
+    @_observed('SHUTDOWN')
     def shutdown(self):
         """
         Force Clamd to shutdown and exit
@@ -287,6 +1117,7 @@ class _ClamdGeneric(object):
 
 
     
+    @_observed('SCAN', scan=True)
     def scan_file(self, file):
         """
         Scan a file or directory given by filename and stop on first virus or error found.
@@ -338,6 +1169,7 @@ class _ClamdGeneric(object):
 
 
 
+    @_observed('MULTISCAN', scan=True)
     def multiscan_file(self, file):
         """
         Scan a file or directory given by filename using multiple threads (faster on SMP machines).
@@ -353,43 +1185,11 @@ class _ClamdGeneric(object):
         May raise:
           - ConnectionError: in case of communication problem
         """
-        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
-
-        try:
-            self._init_socket()
-            self._send_command('MULTISCAN {0}'.format(file))
-        except socket.error:
-            raise ConnectionError('Unable to scan {0}'.format(file))
-
-        result='...'
-        dr={}
-        while result:
-            try:
-                result = self._recv_response()
-            except socket.error:
-                raise ConnectionError('Unable to scan {0}'.format(file))
-
-            if len(result) > 0:
-                for resline in result.splitlines():
-                    filename, reason, status = self._parse_response(resline)
-
-                    if status == 'ERROR':
-                        dr[filename] = ('ERROR', '{0}'.format(reason))
-                    
-                    elif status == 'FOUND':
-                        dr[filename] = ('FOUND', '{0}'.format(reason))
-
-        self._close_socket()
-        if not dr:
-            return None
-        return dr
-
-
-
-
+        return self._scan_results(self.iter_multiscan(file))
 
 
 
+    @_observed('CONTSCAN', scan=True)
     def contscan_file(self, file):
         """
         Scan a file or directory given by filename
@@ -405,87 +1205,231 @@ class _ClamdGeneric(object):
         May raise:
           - ConnectionError: in case of communication problem
         """
-        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        return self._scan_results(self.iter_contscan(file))
 
-        try:
-            self._init_socket()
-            self._send_command('CONTSCAN {0}'.format(file))
-        except socket.error:
-            raise ConnectionError('Unable to scan  {0}'.format(file))
 
-        result='...'
-        dr={}
-        while result:
-            try:
-                result = self._recv_response()
-            except socket.error:
-                raise ConnectionError('Unable to scan  {0}'.format(file))
 
-            if len(result) > 0:
-                for resline in result.splitlines():
-                    filename, reason, status = self._parse_response(resline)
-                    
-                    if status == 'ERROR':
-                        dr[filename] = ('ERROR', '{0}'.format(reason))
-                    
-                    elif status == 'FOUND':
-                        dr[filename] = ('FOUND', '{0}'.format(reason))
+    def iter_multiscan(self, file, include_ok=False):
+        """
+        Scan a file or directory given by filename using multiple threads,
+        yielding the results as clamd sends them.
 
-        self._close_socket()
-        if not dr:
-            return None
-        return dr
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+        include_ok (bool): also yield the files found clean
+
+        return: generator of (filename, status, reason) where status is
+          'FOUND', 'ERROR' or 'OK'. Closing the generator before its end
+          closes the connection, which aborts the scan.
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return self._iter_scan('MULTISCAN', file, include_ok)
+
+
+
+    def iter_contscan(self, file, include_ok=False):
+        """
+        Scan a file or directory given by filename, do not stop on error or
+        virus found, yielding the results as clamd sends them.
+
+        See iter_multiscan
+        """
+        return self._iter_scan('CONTSCAN', file, include_ok)
 
 
 
-    def scan_stream(self, buffer_to_test):
+    @_observed('INSTREAM', scan=True)
+    def scan_stream(self, buffer_to_test, chunk_size=None):
         """
         Scan a buffer
 
         on Python2.X :
           - buffer_to_test (string): buffer to scan
         on Python3.X :
-          - buffer_to_test (bytes or bytearray): buffer to scan
+          - buffer_to_test (bytes, bytearray or any object supporting the
+            buffer protocol, as mmap or numpy arrays): buffer to scan, it is
+            sent without being copied
+        chunk_size (int or None) : size of INSTREAM chunks, self.chunk_size if
+          None. It MUST be < StreamMaxLength in clamd.conf
 
         return either:
           - (dict): {filename1: "virusname"}
           - None: if no virus found
 
         May raise :
-          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - BufferTooLongError: if the buffer size exceeds clamd limits,
+            before anything is sent when limits are known
           - ConnectionError: in case of communication problem
         """
-        try:
-            if sys.version_info[0] <= 2:
-                # Python2
-                assert isstr(buffer_to_test), 'Wrong type fom [buffer_to_test], should be str [was {0}]'.format(type(buffer_to_test))
-            else:
-                # Python3
-                assert isinstance(buffer_to_test, bytes) or isinstance(buffer_to_test, bytearray), 'Wrong type fom [buffer_to_test], should be bytes or bytearray [was {0}]'.format(type(buffer_to_test))
-            
-            self._init_socket()
-            self._send_command('INSTREAM')
+        _assert_stream_type(buffer_to_test)
+        self._check_stream_length(len(_stream_view(buffer_to_test)))
+        return self._scan_instream(_send_stream, buffer_to_test, chunk_size)
+
 
-            max_chunk_size = 1024 # MUST be < StreamMaxLength in /etc/clamav/clamd.conf or /etc/clamd.conf
 
-            chunks_left = buffer_to_test
-            while len(chunks_left)>0:
-                chunk = chunks_left[:max_chunk_size]
-                chunks_left = chunks_left[max_chunk_size:]
+    @_observed('INSTREAM', scan=True)
+    def scan_iter(self, chunks, chunk_size=None):
+        """
+        Scan a stream given as an iterable of buffers, sent to clamd as they
+        come: memory use does not depend on the size of the stream
 
-                #size = bytes.decode(struct.pack('!L', len(chunk)))
-                size = struct.pack('!L', len(chunk))
-                #self.clamd_socket.send(str.encode('{0}{1}'.format(size, chunk)))
-                #self.clamd_socket.send('{0}'.format(size) + chunk)
-                self.clamd_socket.send(size)
-                self.clamd_socket.send(chunk)
+        chunks (iterable of bytes, bytearray or any object supporting the
+          buffer protocol) : content to scan
+        chunk_size (int or None) : maximum size of INSTREAM chunks,
+          self.chunk_size if None. Larger buffers are split.
 
-            # Terminating stream
-            self.clamd_socket.send(struct.pack('!L', 0))
-                
-            
+        return either:
+          - (dict): {'stream': ('FOUND', 'virusname')}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the stream size exceeds clamd limits,
+            before the chunk exceeding them is sent when limits are known
+          - ConnectionError: in case of communication problem
+        """
+        if self._stream_max_length() is not None:
+            chunks = _limit_chunks(chunks, self._stream_max_length())
+        return self._scan_instream(_send_stream_iter, chunks, chunk_size)
+
+
+
+    @_observed('INSTREAM', scan=True)
+    def scan_fileobj(self, fileobj, chunk_size=None):
+        """
+        Scan the content of a file object from its current position, read by
+        chunks: memory use does not depend on the size of the file
+
+        A regular file larger than the StreamMaxLength of limits is not sent:
+        when clamd runs on this host, the file is passed to it (FILDES) or
+        scanned by path if it is read from its start, otherwise
+        BufferTooLongError is raised at once. The observer is given the
+        command actually sent.
+
+        fileobj (file object opened in binary mode) : content to scan
+        chunk_size (int or None) : size of the reads and of INSTREAM chunks,
+          self.chunk_size if None
+
+        return either:
+          - (dict): {'stream': ('FOUND', 'virusname')}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the stream size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        assert hasattr(fileobj, 'read'), 'Wrong type for [fileobj], should be a file object [was {0}]'.format(type(fileobj))
+        chunk_size = _check_chunk_size(chunk_size or self.chunk_size)
+        chunks = _iter_fileobj(fileobj, chunk_size)
+        max_length = self._stream_max_length()
+        if max_length is not None:
+            size = _remaining_size(fileobj)
+            if size is not None and size > max_length:
+                return self._scan_oversize(fileobj, size)
+            chunks = _limit_chunks(chunks, max_length)
+        return self._scan_instream(_send_stream_iter, chunks, chunk_size)
+
+
+
+    def _stream_max_length(self):
+        """
+        internal use only
+        returns the StreamMaxLength of limits, None if unknown
+        """
+        if self.limits is None:
+            return None
+        return self.limits.stream_max_length
+
+
+
+    def _check_stream_length(self, length):
+        """
+        internal use only
+
+        May raise:
+          - BufferTooLongError: if length exceeds the StreamMaxLength of limits
+        """
+        max_length = self._stream_max_length()
+        if max_length is not None and length > max_length:
+            raise BufferTooLongError('Stream of {0} bytes exceeds StreamMaxLength ({1} bytes)'.format(length, max_length))
+        return
+
+
+
+    def _is_local(self):
+        """
+        internal use only
+        returns True if clamd runs on this host
+        """
+        return False
+
+
+
+    def _scan_oversize(self, fileobj, size):
+        """
+        internal use only
+        scans a regular file too large for INSTREAM without sending its
+        content: by file descriptor (FILDES) or by path when clamd runs on
+        this host. Returns the result as scan_fileobj.
+
+        May raise:
+          - BufferTooLongError: if the file can not be scanned this way
+        """
+        if self.limits.max_file_size is not None and size > self.limits.max_file_size:
+            raise BufferTooLongError('File of {0} bytes exceeds MaxFileSize ({1} bytes), clamd would not scan it'.format(size, self.limits.max_file_size))
+
+        name = getattr(fileobj, 'name', None)
+        fildes = hasattr(self, 'scan_fd') and hasattr(socket.socket, 'sendmsg') and hasattr(socket, 'SCM_RIGHTS')
+        by_path = isstr(name) and os.path.isabs(name)
+        if not self._is_local() or fileobj.tell() != 0 or not (fildes or by_path):
+            raise BufferTooLongError('Stream of {0} bytes exceeds StreamMaxLength ({1} bytes)'.format(size, self.limits.stream_max_length))
+
+        # the trace of scan_fileobj reports the command actually sent
+        trace = getattr(self._thread_local, 'trace', None)
+        if trace is not None:
+            trace.command = 'FILDES' if fildes else 'SCAN'
+
+        if fildes:
+            result = self.scan_fd(fileobj)
+        else:
+            result = self.scan_file(name)
+        if result is None:
+            return None
+        return dict(('stream', value) for value in result.values())
+
+
+
+    def _scan_instream(self, send, payload, chunk_size):
+        """
+        internal use only
+        sends INSTREAM with send(socket, payload, chunk_size, header) and
+        returns the parsed reply
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+
+        try:
+            self._init_socket()
+        except socket.error:
+            raise ConnectionError('Unable to scan stream')
+
+        try:
+            send(self.clamd_socket, payload, chunk_size, header=_encode_command('INSTREAM'))
         except socket.error:
+            # clamd closes the connection when the stream exceeds
+            # StreamMaxLength, its reply tells so
+            try:
+                result = self._recv_response()
+            except socket.error:
+                result = ''
+            self._close_socket()
+            if result == 'INSTREAM size limit exceeded. ERROR':
+                raise BufferTooLongError(result)
             raise ConnectionError('Unable to scan stream')
+        except:
+            # error while producing the payload
+            self._close_socket()
+            raise
 
 
         result='...'
@@ -519,51 +1463,134 @@ class _ClamdGeneric(object):
 
 
     
+    def scan_many(self, items, concurrency=8, ordered=False):
+        """
+        Scan many files, buffers or file objects on concurrent connections,
+        see scan_many()
+        """
+        return scan_many(self, items, concurrency=concurrency, ordered=ordered)
+
+
+
+    def session(self, max_pending=64):
+        """
+        Open a clamd session (IDSESSION) on a single connection.
+
+        Commands sent through the returned ClamdSession are pipelined on the
+        same socket instead of opening a new connection for each call.
+
+        max_pending (int) : maximum number of requests waiting for a reply
+          before a new request blocks until the oldest one is answered
+
+        return: (ClamdSession) to be closed with close() or used in a with
+          statement
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return ClamdSession(self, max_pending=max_pending)
+
+
+
+    def _iter_scan(self, command, file, include_ok):
+        """
+        internal use only
+        generator sending command with file and yielding the reply lines
+        parsed as (filename, status, reason)
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+
+        try:
+            self._init_socket()
+            self._send_command('{0} {1}'.format(command, file))
+        except socket.error:
+            raise ConnectionError('Unable to scan {0}'.format(file))
+
+        # the socket of this thread may be replaced while the generator is
+        # suspended
+        clamd_socket = self.clamd_socket
+        try:
+            try:
+                for line in _iter_lines(clamd_socket):
+                    if not include_ok and line.endswith(b' OK'):
+                        continue
+                    filename, reason, status = _parse_reply(line)
+                    yield filename, status, reason
+            except socket.error:
+                raise ConnectionError('Unable to scan {0}'.format(file))
+        finally:
+            clamd_socket.close()
+        return
+
+
+
+    def _scan_results(self, results):
+        """
+        internal use only
+        returns the results of _iter_scan as a dict, or None if empty
+        """
+        dr = {}
+        for filename, status, reason in results:
+            dr[filename] = (status, reason)
+        if not dr:
+            return None
+        return dr
+
+
+
+    def _init_socket(self):
+        """
+        internal use only
+        """
+        _check_fork(self)
+        trace = getattr(self._thread_local, 'trace', None)
+        if trace is None:
+            self.clamd_socket = self._connect()
+            return
+
+        start = _clock()
+        try:
+            clamd_socket = self._connect()
+        finally:
+            trace.connect_time += _clock() - start
+        self.clamd_socket = _ObservedSocket(clamd_socket, trace)
+        return
+
+
+
     def _send_command(self, cmd):
         """
         `man clamd` recommends to prefix commands with z, but we will use \n
         terminated strings, as python<->clamd has some problems with \0x00
         """
-        try:
-            cmd = str.encode('n{0}\n'.format(cmd))
-        except UnicodeDecodeError:
-            cmd = 'n{0}\n'.format(cmd)
-        self.clamd_socket.send(cmd)
+        self.clamd_socket.send(_encode_command(cmd))
         return
 
     
 
     def _recv_response(self):
         """
-        receive response from clamd and strip all whitespace characters
+        receive the next reply line from clamd and strip all whitespace
+        characters, '' once clamd closed the connection
         """
-        data = self.clamd_socket.recv(4096)
-        try:
-            response = bytes.decode(data).strip()
-        except UnicodeDecodeError:
-            response = data.strip()
-
-        return response
+        if self._thread_local.replies is None:
+            self._thread_local.replies = _iter_lines(self.clamd_socket)
+        line = next(self._thread_local.replies, b'')
+        return _decode(line).strip()
 
 
 
     def _recv_response_multiline(self):
         """
-        receive multiple line response from clamd and strip all whitespace characters
+        receive multiple line response from clamd, up to END, and strip
+        trailing whitespace characters of each line
         """
         response = ''
-        c = '...'
-        while c != '':
-            try:
-                data = self.clamd_socket.recv(4096)
-                try:
-                    c = bytes.decode(data).strip()
-                except UnicodeDecodeError:
-                    response = data.strip()
-            except socket.error:
+        for line in _iter_lines(self.clamd_socket):
+            line = _decode(line).rstrip()
+            response += '{0}\n'.format(line)
+            if line == 'END':
                 break
-                
-            response += '{0}\n'.format(c)
         return response
 
 
@@ -580,105 +1607,330 @@ class _ClamdGeneric(object):
         """
         parses responses for SCAN, CONTSCAN, MULTISCAN and STREAM commands.
         """
-        msg = msg.strip()
-        filename = msg.split(': ')[0]
-        left = msg.split(': ')[1:]
-        if isstr(left):
-            result = left
-        else:
-            result = ": ".join(left)
-            
-        if result != 'OK':
-            parts = result.split()
-            reason = ' '.join(parts[:-1])
-            status = parts[-1]
-        else:
-            reason, status = '', 'OK'
+        return _parse_response(msg)
 
 
-        return filename, reason, status
 
 
+############################################################################
 
 
-############################################################################
+# clamd.conf locations, the first one found is used
+CLAMD_CONF_PATHS = ['/etc/clamav/clamd.conf', '/etc/clamd.conf']
 
 
-class ClamdUnixSocket(_ClamdGeneric):
+# parsed clamd.conf files, {path: ((mtime, size), options)}
+_conf_cache = {}
+_conf_cache_lock = threading.Lock()
+
+
+def _read_clamd_conf(path=None):
     """
-    Class for using clamd with an unix socket
+    internal use only
+    returns the options of clamd.conf as a dict {name: value} (not to be
+    modified), the last value of options given several times, {} if there is
+    no clamd.conf. A file is parsed once per process, and again only when
+    its modification time or size change.
+
+    path (string or None) : clamd.conf filename, None for CLAMD_CONF_PATHS
     """
-    def __init__(self, filename=None, timeout=None):
-        """
-        Unix Socket Class initialisation
-        
-        filename (string) : unix socket filename or None to get the socket from /etc/clamav/clamd.conf or /etc/clamd.conf
-        timeout (float or None) : socket timeout
-        """
+    for path in ([path] if path is not None else CLAMD_CONF_PATHS):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            break
+    else:
+        return {}
+
+    version = (st.st_mtime, st.st_size)
+    with _conf_cache_lock:
+        cached = _conf_cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    options = {}
+    with open(path, 'r') as conffile:
+        for line in conffile.readlines():
+            fields = line.strip().split(None, 1)
+            if len(fields) == 2 and not fields[0].startswith('#'):
+                options[fields[0]] = fields[1].strip()
+    with _conf_cache_lock:
+        _conf_cache[path] = (version, options)
+    return options
+
+
+def _unix_socket_from_conf():
+    """
+    internal use only
+    returns the LocalSocket of /etc/clamav/clamd.conf or /etc/clamd.conf
 
-        # try to get unix socket from clamd.conf
-        if filename is None:
-            for clamdpath in ['/etc/clamav/clamd.conf', '/etc/clamd.conf']:
-                if os.path.isfile(clamdpath):
-                    break
-            else:
-                raise ConnectionError('Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf')
-            
-            with open(clamdpath, 'r') as conffile:
-                for line in conffile.readlines():
-                    try:
-                        if line.strip().split()[0] == 'LocalSocket':
-                            filename = line.strip().split()[1]
-                            break
-                    except IndexError:
-                        pass
-                            
-                else:
-                    raise ConnectionError('Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf')
-        
-        assert isstr(filename), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
-        assert isinstance(timeout, (float, int)) or timeout is None, 'Wrong type for [timeout], should be either None or a float [was {0}]'.format(type(timeout))
+    May raise:
+      - ConnectionError: if the unix socket could not be found
+    """
+    try:
+        return _read_clamd_conf()['LocalSocket']
+    except KeyError:
+        raise ConnectionError('Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf')
 
-        _ClamdGeneric.__init__(self)
-        
-        self.unix_socket = filename
-        self.timeout = timeout
 
-        # tests the socket
-        self._init_socket()
-        self._close_socket()
+def _parse_size(value):
+    """
+    internal use only
+    returns the bytes of a clamd.conf size ('25M', '100K', '1G' or bytes),
+    None for 0 (no limit)
+    """
+    value = value.strip().upper()
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(value[-1:], 1)
+    if multiplier != 1:
+        value = value[:-1]
+    return int(value) * multiplier or None
 
-        return
 
 
-    def _init_socket(self):
+class ClamdLimits(object):
+    """
+    Size limits of clamd, checked before sending data:
+      - stream_max_length: StreamMaxLength, longest INSTREAM accepted
+      - max_file_size: MaxFileSize, larger files are not scanned by clamd
+      - max_scan_size: MaxScanSize, data scanned in a file and its content
+    A limit is None when there is none.
+    """
+    def __init__(self, stream_max_length=None, max_file_size=None, max_scan_size=None):
         """
-        internal use only
+        stream_max_length, max_file_size, max_scan_size (int or None) : limits
+          in bytes, None for no limit
         """
-        self.clamd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        if not self.timeout is None:
-            self.clamd_socket.settimeout(self.timeout)
+        for name, value in [('stream_max_length', stream_max_length), ('max_file_size', max_file_size), ('max_scan_size', max_scan_size)]:
+            assert value is None or (isinstance(value, int) and value > 0), 'Wrong value for [{0}], should be None or a positive int [was {1}]'.format(name, value)
 
-        try:
-            self.clamd_socket.connect(self.unix_socket)
-        except socket.error:
-            raise ConnectionError('Could not reach clamd using unix socket ({0})'.format((self.unix_socket)))
+        self.stream_max_length = stream_max_length
+        self.max_file_size = max_file_size
+        self.max_scan_size = max_scan_size
         return
-    
 
-############################################################################
+
+    def __repr__(self):
+        return 'ClamdLimits(stream_max_length={0}, max_file_size={1}, max_scan_size={2})'.format(self.stream_max_length, self.max_file_size, self.max_scan_size)
+
+
+# defaults of clamd (>= 0.101) for the limits not set in clamd.conf
+_DEFAULT_LIMITS = {'StreamMaxLength': '100M', 'MaxFileSize': '100M', 'MaxScanSize': '400M'}
+
+
+def limits_from_conf(path=None):
+    """
+    Get the size limits of clamd from clamd.conf, clamd defaults being used
+    for the limits it does not set
+
+    path (string or None) : clamd.conf filename, None for
+      /etc/clamav/clamd.conf or /etc/clamd.conf
+
+    return: (ClamdLimits) or None if there is no clamd.conf
+    """
+    options = _read_clamd_conf(path)
+    if not options:
+        return None
+    values = dict(_DEFAULT_LIMITS)
+    values.update((name, options[name]) for name in _DEFAULT_LIMITS if name in options)
+    return ClamdLimits(stream_max_length=_parse_size(values['StreamMaxLength']),
+                       max_file_size=_parse_size(values['MaxFileSize']),
+                       max_scan_size=_parse_size(values['MaxScanSize']))
+
+
+# hosts on which clamd shares the filesystem of pyclamd
+_LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+
+def _limits_from_conf_for(unix_socket=None, host=None, port=None):
+    """
+    internal use only
+    returns the limits of clamd.conf if it configures the given socket (the
+    clamd being this one), None otherwise
+    """
+    options = _read_clamd_conf()
+    if unix_socket is not None and options.get('LocalSocket') != unix_socket:
+        return None
+    if unix_socket is None and (host not in _LOCAL_HOSTS or options.get('TCPSocket') != str(port)):
+        return None
+    return limits_from_conf()
+
+
+def _remaining_size(fileobj):
+    """
+    internal use only
+    returns the bytes left to read in fileobj if it is a regular file, None
+    otherwise
+    """
+    try:
+        st = os.fstat(fileobj.fileno())
+        position = fileobj.tell()
+    except (AttributeError, OSError, IOError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return max(st.st_size - position, 0)
+
+
+def _limit_chunks(chunks, max_length):
+    """
+    internal use only
+    yields chunks, raising BufferTooLongError before the chunk which would
+    exceed max_length bytes
+    """
+    length = 0
+    for chunk in chunks:
+        length += len(_stream_view(chunk))
+        if length > max_length:
+            raise BufferTooLongError('Stream exceeds StreamMaxLength ({0} bytes)'.format(max_length))
+        yield chunk
+    return
+
+
+class ClamdUnixSocket(_ClamdGeneric):
+    """
+    Class for using clamd with an unix socket
+    """
+    def __init__(self, filename=None, timeout=None, limits=None, lazy=False):
+        """
+        Unix Socket Class initialisation
+        
+        filename (string) : unix socket filename or None to get the socket from /etc/clamav/clamd.conf or /etc/clamd.conf
+        timeout (float or None) : socket timeout
+        limits (ClamdLimits or None) : size limits of clamd, None to read them
+          from clamd.conf when its LocalSocket is filename
+        lazy (bool) : do not test the socket, clamd is first reached by the
+          first command
+        """
+
+        # try to get unix socket from clamd.conf
+        if filename is None:
+            filename = _unix_socket_from_conf()
+        
+        assert isstr(filename), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        assert isinstance(timeout, (float, int)) or timeout is None, 'Wrong type for [timeout], should be either None or a float [was {0}]'.format(type(timeout))
+
+        _ClamdGeneric.__init__(self)
+        
+        self.unix_socket = filename
+        self.timeout = timeout
+        self.limits = limits if limits is not None else _limits_from_conf_for(unix_socket=filename)
+
+        # tests the socket
+        if not lazy:
+            self._init_socket()
+            self._close_socket()
+
+        return
+
+
+    @_observed('FILDES', scan=True)
+    def scan_fd(self, fd):
+        """
+        Scan an open file descriptor: the descriptor is passed to clamd over
+        the unix socket (FILDES command), clamd reads the file itself. The
+        file only needs to be readable by the caller, and its content is not
+        copied through Python.
+
+        fd (int or file object) : descriptor of a regular file opened for
+          reading
+
+        return either :
+          - (dict): {'fd[N]': ('FOUND', 'virusname')}, the filename given by clamd
+          - None: if no virus found
+
+        May raise :
+          - ConnectionError: in case of communication problem
+          - NotImplementedError: if descriptors can not be passed on this
+            platform (Python 2, Windows)
+        """
+        # fd is kept referenced until sent, a file object would close it
+        descriptor = _fileno(fd)
+        try:
+            self._init_socket()
+            _send_fildes(self.clamd_socket, descriptor)
+        except socket.error:
+            raise ConnectionError('Unable to scan file descriptor {0}'.format(descriptor))
+
+        result='...'
+        results=[]
+        while result:
+            try:
+                result = self._recv_response()
+            except socket.error:
+                raise ConnectionError('Unable to scan file descriptor {0}'.format(descriptor))
+            results.extend(result.splitlines())
+
+        self._close_socket()
+        return _parse_scan_results(results)
+
+
+    @_observed('FILDES', scan=True)
+    def scan_path_fildes(self, file):
+        """
+        Open a file and scan it with scan_fd(), for files readable by the
+        caller but not by clamd
+
+        file (string) : filename
+
+        return either :
+          - (dict): {file: ('FOUND', 'virusname')} or {file: ('ERROR', 'reason')}
+          - None: if no virus found
+
+        May raise :
+          - ConnectionError: in case of communication problem
+          - IOError: if the file can not be opened
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        with open(file, 'rb') as fileobj:
+            result = self.scan_fd(fileobj)
+        if result is None:
+            return None
+        return dict((file, value) for value in result.values())
+
+
+    def _is_local(self):
+        """
+        internal use only
+        """
+        return True
+
+
+    def _connect(self):
+        """
+        internal use only
+        returns a new socket connected to clamd
+        """
+        clamd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if not self.timeout is None:
+            clamd_socket.settimeout(self.timeout)
+
+        try:
+            clamd_socket.connect(self.unix_socket)
+        except socket.error:
+            clamd_socket.close()
+            raise ConnectionError('Could not reach clamd using unix socket ({0})'.format((self.unix_socket)))
+        return clamd_socket
+    
+
+############################################################################
 
 
 class ClamdNetworkSocket(_ClamdGeneric):
     """
     Class for using clamd with a network socket
     """
-    def __init__(self, host='127.0.0.1', port=3310, timeout=None):
+    def __init__(self, host='127.0.0.1', port=3310, timeout=None, limits=None, lazy=False):
         """
         Network Class initialisation
         host (string) : hostname or ip address
         port (int) : TCP port
         timeout (float or None) : socket timeout
+        limits (ClamdLimits or None) : size limits of clamd, None to read them
+          from clamd.conf when host is local and its TCPSocket is port
+        lazy (bool) : do not test the socket, clamd is first reached by the
+          first command
         """
             
         assert isinstance(host, str), 'Wrong type for [host], should be a string [was {0}]'.format(type(host))
@@ -690,38 +1942,188 @@ class ClamdNetworkSocket(_ClamdGeneric):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.limits = limits if limits is not None else _limits_from_conf_for(host=host, port=port)
 
         # tests the socket
-        self._init_socket()
-        self._close_socket()
+        if not lazy:
+            self._init_socket()
+            self._close_socket()
 
         return
 
 
-    def _init_socket(self):
+    def _is_local(self):
+        """
+        internal use only
+        """
+        return self.host in _LOCAL_HOSTS
+
+
+    def _connect(self):
         """
         internal use only
+        returns a new socket connected to clamd
         """
-        self.clamd_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clamd_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # commands and INSTREAM chunks are small writes, do not let Nagle's
+        # algorithm delay them (it stalls pipelined sessions)
+        clamd_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if not self.timeout is None:
-            self.clamd_socket.settimeout(self.timeout)
+            clamd_socket.settimeout(self.timeout)
         try:
-            self.clamd_socket.connect((self.host, self.port))
+            clamd_socket.connect((self.host, self.port))
         except socket.error:
+            clamd_socket.close()
             raise ConnectionError('Could not reach clamd using network ({0}, {1})'.format(self.host, self.port))
 
-        return
+        return clamd_socket
 
     
 
+############################################################################
+
+
+ScanResult = collections.namedtuple('ScanResult', ['index', 'item', 'result', 'error'])
+ScanResult.__doc__ = """
+Result of an item of scan_many()
+  - index (int): position of the item in items
+  - item: the item
+  - result: return value of scan_file, scan_stream or scan_fileobj
+  - error (Exception or None): exception raised by the scan, result is then None
+"""
+
+
+def _scan_item(client, item):
+    """
+    internal use only
+    scans item with the method of client matching its type
+    """
+    if isstr(item):
+        return client.scan_file(item)
+    if hasattr(item, 'read'):
+        return client.scan_fileobj(item)
+    return client.scan_stream(item)
+
+
+def _scan_many_worker(client, work, results):
+    """
+    internal use only
+    """
+    while True:
+        job = work.get()
+        if job is None:
+            return
+        index, item = job
+        try:
+            results.put(ScanResult(index, item, _scan_item(client, item), None))
+        except Exception as e:
+            results.put(ScanResult(index, item, None, e))
+
+
+def scan_many(client, items, concurrency=8, ordered=False):
+    """
+    Scan many items with up to concurrency scans running at the same time,
+    each in its own thread and connection. Results are yielded as the scans
+    complete.
+
+    client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool... shared by the
+      threads
+    items (iterable) : items to scan, each one being either
+      - (string): filename scanned with scan_file (MUST BE ABSOLUTE PATH !)
+      - (file object): scanned with scan_fileobj
+      - (bytes, bytearray or buffer): scanned with scan_stream
+      items are read from the iterable only when a scan slot is free, so it
+      may be a generator over a huge list.
+    concurrency (int) : number of concurrent scans, it should not exceed the
+      MaxThreads of clamd (see the THREADS line of stats())
+    ordered (bool) : yield results in the order of items instead of the
+      order of completion
+
+    return: generator of ScanResult(index, item, result, error). An exception
+      raised by a scan does not stop the others, it is given in error.
+    """
+    assert isinstance(concurrency, int) and concurrency > 0, 'Wrong value for [concurrency], should be a positive int [was {0}]'.format(concurrency)
+
+    work = queue.Queue()
+    results = queue.Queue()
+    workers = []
+    for i in range(concurrency):
+        worker = threading.Thread(target=_scan_many_worker, args=(client, work, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    # a few items are queued ahead so that workers never wait for the caller
+    max_in_flight = 2 * concurrency
+    iterator = enumerate(items)
+    exhausted = False
+    in_flight = 0
+    done = {}
+    next_index = 0
+    try:
+        while True:
+            while not exhausted and in_flight < max_in_flight:
+                try:
+                    job = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                work.put(job)
+                in_flight += 1
+
+            if in_flight == 0:
+                break
+
+            if not ordered:
+                result = results.get()
+                in_flight -= 1
+                yield result
+                continue
+
+            # items completed out of order count as in flight until yielded,
+            # which bounds the memory used
+            while next_index not in done:
+                result = results.get()
+                done[result.index] = result
+            while next_index in done:
+                in_flight -= 1
+                result = done.pop(next_index)
+                next_index += 1
+                yield result
+    finally:
+        for worker in workers:
+            work.put(None)
+    return
+
+
 ############################################################################
 
 def ClamdAgnostic():
     """
-    Tries to connect to clamd using ClamdUnixSocket or if it fails, tries
-    with ClamdNetworkSocket and return the corresponding object.
+    Returns a ClamdUnixSocket or a ClamdNetworkSocket for the clamd of this
+    host.
+
+    When clamd.conf gives an existing LocalSocket or a TCPSocket, the client
+    is created lazily for it, without connecting: errors are raised by the
+    first command. Otherwise, tries to connect to clamd using ClamdUnixSocket
+    or if it fails, tries with ClamdNetworkSocket and return the
+    corresponding object.
     Of course, it tries to connect with default settings...
+
+    May raise:
+      - ValueError: if clamd.conf gives no endpoint and clamd could not be
+        reached
     """
+    options = _read_clamd_conf()
+    if os.path.exists(options.get('LocalSocket', '')):
+        return ClamdUnixSocket(options['LocalSocket'], lazy=True)
+    if options.get('TCPSocket', '').isdigit():
+        host = options.get('TCPAddr', '127.0.0.1')
+        if host in ('0.0.0.0', '::'):
+            # listening on every address
+            host = '127.0.0.1'
+        return ClamdNetworkSocket(host, int(options['TCPSocket']), lazy=True)
+
     try:
         # Create object for using unix socket
         cd = ClamdUnixSocket()
@@ -736,6 +2138,634 @@ def ClamdAgnostic():
 ############################################################################
 
 
+class ScanningWriter(object):
+    """
+    File-like object writing to a destination file and scanning the written
+    data with clamd at the same time (INSTREAM), so that the verdict is known
+    as soon as the writing is finished, without reading the data again.
+
+    Usage, cd being a ClamdUnixSocket or a ClamdNetworkSocket and chunks the
+    received data :
+
+      with open('/tmp/upload', 'wb') as dest:
+          with ScanningWriter(cd, dest) as writer:
+              for chunk in chunks:
+                  writer.write(chunk)
+      print(writer.result)
+    """
+    def __init__(self, client, dest=None, chunk_size=None):
+        """
+        Opens a connection to clamd and starts an INSTREAM command
+
+        client (ClamdUnixSocket or ClamdNetworkSocket) : client giving the
+          connection to clamd
+        dest (file object or None) : every write is passed to dest, which is
+          not closed by the ScanningWriter. If None, data is only scanned.
+        chunk_size (int or None) : maximum size of INSTREAM chunks,
+          client.chunk_size if None
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        self.client = client
+        self.dest = dest
+        self.chunk_size = _check_chunk_size(chunk_size or client.chunk_size)
+        self.result = None
+        self.closed = False
+        self.bytes_written = 0
+
+        self._error = None
+        self._header = _encode_command('INSTREAM')
+        self.clamd_socket = client._connect()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return
+
+
+    def write(self, data):
+        """
+        Write data to dest and send it to clamd
+
+        return: number of bytes written
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed ScanningWriter')
+
+        if self.dest is not None:
+            self.dest.write(data)
+        size = len(_stream_view(data))
+        self.bytes_written += size
+
+        if self._error is None and size:
+            buffers = [self._header] if self._header is not None else []
+            self._header = None
+            try:
+                _send_buffers(self.clamd_socket, _send_frames(self.clamd_socket, buffers, data, self.chunk_size))
+            except socket.error as e:
+                # clamd may have closed the connection (StreamMaxLength), the
+                # reason is read by close()
+                self._error = e
+        return size
+
+
+    def writelines(self, lines):
+        """
+        Write every buffer of lines
+        """
+        for data in lines:
+            self.write(data)
+        return
+
+
+    def flush(self):
+        """
+        Flush dest
+        """
+        if self.dest is not None:
+            self.dest.flush()
+        return
+
+
+    def close(self):
+        """
+        Terminate the stream and wait for the verdict of clamd
+
+        return either:
+          - (dict): {'stream': ('FOUND', 'virusname')}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the stream size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        if self.closed:
+            return self.result
+        self.closed = True
+
+        try:
+            if self._error is None:
+                try:
+                    buffers = [self._header] if self._header is not None else []
+                    _send_buffers(self.clamd_socket, buffers + [_STREAM_END])
+                except socket.error as e:
+                    self._error = e
+
+            data = b''
+            try:
+                while True:
+                    received = self.clamd_socket.recv(4096)
+                    if not received:
+                        break
+                    data += received
+            except socket.error:
+                raise ConnectionError('Unable to scan stream')
+        finally:
+            self.clamd_socket.close()
+
+        if not data:
+            raise ConnectionError('Unable to scan stream [{0}]'.format(self._error))
+        self.result = _parse_scan_results([line.strip() for line in _decode(data).splitlines()])
+        return self.result
+
+
+    def abort(self):
+        """
+        Abort the scan without waiting for clamd
+        """
+        self.closed = True
+        self.clamd_socket.close()
+        return
+
+
+
+############################################################################
+
+
+class ClamdRequest(object):
+    """
+    A request sent to clamd inside a ClamdSession, waiting for its reply
+    """
+    def __init__(self, session, request_id, command, parser, multiline=False):
+        """
+        Request initialisation (internal use only, see ClamdSession)
+        """
+        self.session = session
+        self.request_id = request_id
+        self.command = command
+        self.multiline = multiline
+        self.lines = []
+        self.done = False
+        self.error = None
+        self._parser = parser
+        return
+
+
+    def result(self):
+        """
+        Wait for the reply of clamd to this request
+
+        return: the same value as the corresponding ClamdSession method
+
+        May raise:
+          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        self.session._wait(self)
+        if self.error is not None:
+            raise self.error
+        return self._parser([_decode(line) for line in self.lines])
+
+
+
+class ClamdSession(object):
+    """
+    Session with clamd on a single connection (IDSESSION / END commands)
+
+    Requests are pipelined : submit_* methods send a command and return a
+    ClamdRequest immediately, without waiting for the reply of clamd. Replies
+    are prefixed by clamd with the request number and are matched back to
+    their ClamdRequest, whatever the order clamd answers them in.
+
+    Only PING, VERSION, STATS, SCAN, INSTREAM and FILDES may be used in a
+    session.
+    SCAN is expected to be used on files, use CONTSCAN or MULTISCAN outside
+    of a session for directories.
+
+    A session may be shared between threads.
+    """
+    def __init__(self, client, max_pending=64):
+        """
+        Session initialisation, usually done with client.session()
+
+        client (ClamdUnixSocket or ClamdNetworkSocket) : client giving the
+          connection to clamd
+        max_pending (int) : maximum number of requests waiting for a reply.
+          clamd requires its replies to be read before sending more commands,
+          so a new request blocks until the oldest one is answered.
+        """
+        assert isinstance(max_pending, int) and max_pending > 0, 'Wrong value for [max_pending], should be a positive int [was {0}]'.format(max_pending)
+
+        self.client = client
+        self.max_pending = max_pending
+        self.closed = False
+        self.error = None
+
+        self._send_lock = threading.Lock()
+        self._lock = threading.Condition()
+        self._reading = False
+        self._last_id = 0
+        self._pending = {}
+        self._collecting = None
+        self._decoder = ReplyDecoder(b'\n')
+
+        self.clamd_socket = client._connect()
+        try:
+            self.clamd_socket.send(_encode_command('IDSESSION'))
+        except socket.error:
+            self.clamd_socket.close()
+            raise ConnectionError('Could not start clamd session')
+        _register_fork_safe(self)
+        return
+
+
+    def __getstate__(self):
+        raise TypeError('A ClamdSession can not be pickled, pickle its client instead')
+
+
+    def _after_fork(self):
+        """
+        internal use only
+        the connection belongs to the parent process: in a child process it
+        is closed without ending the session, which can not be used anymore
+        """
+        self._send_lock = threading.Lock()
+        self._lock = threading.Condition()
+        self._reading = False
+        if not self.closed and self.error is None:
+            self._fail(ConnectionError('Session was opened by another process'))
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def close(self):
+        """
+        Wait for pending replies and end the session
+
+        return: nothing
+        """
+        _check_fork(self)
+        with self._send_lock:
+            with self._lock:
+                if self.closed:
+                    return
+                while self._pending and self.error is None:
+                    self._wait_locked(self._pending[min(self._pending)])
+                self.closed = True
+                if self.error is None:
+                    try:
+                        self.clamd_socket.send(_encode_command('END'))
+                    except socket.error:
+                        pass
+            self.clamd_socket.close()
+        return
+
+
+    def ping(self):
+        """
+        Send a PING in the session
+
+        return: True if the server replies to PING
+
+        May raise:
+          - ConnectionError: if the server do not reply by PONG
+        """
+        return self.submit_ping().result()
+
+
+    def version(self):
+        """
+        Get Clamscan version
+
+        return: (string) clamscan version
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return self.submit_version().result()
+
+
+    def stats(self):
+        """
+        Get Clamscan stats
+
+        return: (string) clamscan stats
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return self.submit_stats().result()
+
+
+    def get_stats(self):
+        """
+        Get Clamscan stats, parsed
+
+        return: (ClamdStats)
+        """
+        return ClamdStats(self.stats())
+
+
+    def scan_file(self, file):
+        """
+        Scan a file given by filename
+
+        file (string) : filename (MUST BE ABSOLUTE PATH !)
+
+        return either :
+          - (dict): {filename1: ('FOUND', 'virusname')} or {filename1: ('ERROR', 'reason')}
+          - None: if no virus found
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        return self.submit_scan_file(file).result()
+
+
+    def scan_stream(self, buffer_to_test, chunk_size=None):
+        """
+        Scan a buffer
+
+        buffer_to_test, chunk_size : see _ClamdGeneric.scan_stream
+
+        return either:
+          - (dict): {'stream': ('FOUND', 'virusname')}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        return self.submit_scan_stream(buffer_to_test, chunk_size).result()
+
+
+    def submit_ping(self):
+        """
+        Send a PING without waiting for the reply
+
+        return: (ClamdRequest) whose result() is the same as ping()
+        """
+        return self._submit('PING', self._parse_ping)
+
+
+    def submit_version(self):
+        """
+        Send a VERSION without waiting for the reply
+
+        return: (ClamdRequest) whose result() is the same as version()
+        """
+        return self._submit('VERSION', self._parse_single)
+
+
+    def submit_stats(self):
+        """
+        Send a STATS without waiting for the reply
+
+        return: (ClamdRequest) whose result() is the same as stats()
+        """
+        return self._submit('STATS', self._parse_multiline, multiline=True)
+
+
+    def submit_scan_file(self, file):
+        """
+        Send a SCAN without waiting for the reply
+
+        return: (ClamdRequest) whose result() is the same as scan_file()
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        return self._submit('SCAN {0}'.format(file), self._parse_scan)
+
+
+    def submit_scan_stream(self, buffer_to_test, chunk_size=None):
+        """
+        Send an INSTREAM without waiting for the reply
+
+        chunk_size (int or None) : size of INSTREAM chunks, the chunk_size of
+          the client if None
+
+        return: (ClamdRequest) whose result() is the same as scan_stream()
+
+        May raise:
+          - BufferTooLongError: if the buffer exceeds the StreamMaxLength of
+            the client limits, clamd would close the session
+        """
+        _assert_stream_type(buffer_to_test)
+        self.client._check_stream_length(len(_stream_view(buffer_to_test)))
+        chunk_size = _check_chunk_size(chunk_size or self.client.chunk_size)
+        return self._submit('INSTREAM', self._parse_scan, payload=buffer_to_test, chunk_size=chunk_size)
+
+
+    def scan_fd(self, fd):
+        """
+        Scan an open file descriptor, passed to clamd (FILDES), see
+        ClamdUnixSocket.scan_fd
+
+        Only available with ClamdUnixSocket.
+        """
+        return self.submit_scan_fd(fd).result()
+
+
+    def submit_scan_fd(self, fd):
+        """
+        Send a FILDES without waiting for the reply
+
+        return: (ClamdRequest) whose result() is the same as scan_fd()
+        """
+        # fd is kept referenced until sent, a file object would close it
+        descriptor = _fileno(fd)
+        if self.clamd_socket.family != getattr(socket, 'AF_UNIX', None):
+            raise ConnectionError('FILDES needs a unix socket')
+        _check_fildes(self.clamd_socket)
+        return self._submit('FILDES', self._parse_scan, fildes=descriptor)
+
+
+    def _submit(self, command, parser, payload=None, multiline=False, fildes=None, chunk_size=None):
+        """
+        internal use only
+        registers a new request and sends its command (and INSTREAM payload or
+        FILDES file descriptor)
+        """
+        _check_fork(self)
+        with self._send_lock:
+            with self._lock:
+                while len(self._pending) >= self.max_pending and self.error is None:
+                    self._wait_locked(self._pending[min(self._pending)])
+                if self.closed:
+                    raise ConnectionError('Session is closed')
+                if self.error is not None:
+                    raise self.error
+                self._last_id += 1
+                request = ClamdRequest(self, self._last_id, command, parser, multiline)
+                self._pending[request.request_id] = request
+
+            try:
+                if fildes is not None:
+                    _send_fildes(self.clamd_socket, fildes)
+                elif payload is None:
+                    self.clamd_socket.sendall(_encode_command(command))
+                else:
+                    _send_stream(self.clamd_socket, payload, chunk_size, header=_encode_command(command))
+            except socket.error:
+                with self._lock:
+                    self._fail(ConnectionError('Unable to send {0} in session'.format(command.split()[0])))
+                    self._lock.notify_all()
+                raise request.error
+            except:
+                # the command may be partly sent, the session can not be
+                # used anymore and the request must not stay pending
+                error = sys.exc_info()[1]
+                with self._lock:
+                    self._fail(ConnectionError('Unable to send {0} in session [{1!r}]'.format(command.split()[0], error)))
+                    self._lock.notify_all()
+                raise
+        return request
+
+
+    def _wait(self, request):
+        """
+        internal use only
+        """
+        with self._lock:
+            self._wait_locked(request)
+        return
+
+
+    def _wait_locked(self, request):
+        """
+        internal use only
+        reads replies until request is done, self._lock being held.
+        Only one thread reads the socket at a time, the other ones wait to
+        be notified.
+        """
+        while not request.done:
+            if self._reading:
+                self._lock.wait()
+                continue
+
+            self._reading = True
+            self._lock.release()
+            try:
+                try:
+                    data = self.clamd_socket.recv(4096)
+                    error = None
+                    if not data:
+                        error = 'connection closed by clamd'
+                except socket.error as e:
+                    error = e
+            finally:
+                self._lock.acquire()
+                self._reading = False
+
+            if error is not None:
+                self._fail(ConnectionError('Unable to read reply in session [{0}]'.format(error)))
+            else:
+                self._feed(data)
+            self._lock.notify_all()
+        return
+
+
+    def _feed(self, data):
+        """
+        internal use only
+        dispatches complete reply lines to their requests
+        """
+        for line in self._decoder.feed(data):
+            if self.error is not None:
+                break
+            self._dispatch(line.strip())
+        return
+
+
+    def _dispatch(self, line):
+        """
+        internal use only
+        """
+        request = self._collecting
+        if request is not None:
+            # following lines of a multiline reply, terminated by END
+            request.lines.append(line)
+            if line == b'END':
+                self._collecting = None
+                request.done = True
+            return
+
+        try:
+            request_id, reply = line.split(b': ', 1)
+            request = self._pending.pop(int(request_id))
+        except (ValueError, KeyError):
+            self._fail(ConnectionError('Unexpected reply from clamd in session [{0}]'.format(_decode(line))))
+            return
+
+        request.lines.append(reply)
+        if request.multiline and reply != b'END':
+            self._collecting = request
+        else:
+            request.done = True
+        return
+
+
+    def _fail(self, error):
+        """
+        internal use only
+        marks the session as broken, all waiting requests get error
+        """
+        self.error = error
+        requests = list(self._pending.values())
+        if self._collecting is not None:
+            requests.append(self._collecting)
+        for request in requests:
+            request.error = error
+            request.done = True
+        self._pending = {}
+        self._collecting = None
+        try:
+            self.clamd_socket.close()
+        except socket.error:
+            pass
+        return
+
+
+    def _parse_ping(self, lines):
+        """
+        internal use only
+        """
+        if lines[0] == 'PONG':
+            return True
+        raise ConnectionError('Could not ping clamd server [{0}]'.format(lines[0]))
+
+
+    def _parse_single(self, lines):
+        """
+        internal use only
+        """
+        return lines[0]
+
+
+    def _parse_multiline(self, lines):
+        """
+        internal use only
+        """
+        return ''.join('{0}\n'.format(line) for line in lines)
+
+
+    def _parse_scan(self, lines):
+        """
+        internal use only
+        """
+        return _parse_scan_results(lines)
+
+
+
+############################################################################
+
+
 # Backwards compatibility API ##############################################
 
 socketinst = None
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+
+"""
+scheduler.py - priority classes and weighted fair queuing of requests
+
+Usage :
+
+  import pyclamd
+  scheduler = pyclamd.PriorityScheduler(pyclamd.ClamdAgnostic(), concurrency=8, reserved={'interactive': 2})
+  scheduler.lane('interactive', tenant='alice').scan_stream(scheduler.EICAR())['stream']
+  # ('FOUND', 'Eicar-Test-Signature')
+  bulk = scheduler.lane('bulk', tenant='nightly')
+  results = list(bulk.scan_many(['/srv/data/a', '/srv/data/b']))
+  scheduler.scheduler_stats()['interactive']['wait_time']['p99']
+  # 0.0005
+"""
+
+import collections
+import threading
+import time
+
+from .pyclamd import scan_many
+from .admission import OverloadError
+from .metrics import Histogram
+
+
+############################################################################
+
+
+# weight of each priority class, its share of the slots when every class
+# has requests waiting
+DEFAULT_CLASSES = {'interactive': 8, 'bulk': 1}
+
+
+class _Ticket(object):
+    """
+    internal use only
+    a request waiting for a slot
+    """
+    def __init__(self, priority_class, tenant):
+        self.priority_class = priority_class
+        self.tenant = tenant
+        self.queued_at = time.time()
+        self.granted = False
+        self.event = threading.Event()
+        return
+
+
+
+class _Tenant(object):
+    """
+    internal use only
+    requests of a tenant waiting in a priority class
+    """
+    def __init__(self, name, weight, vtime):
+        self.name = name
+        self.weight = weight
+        self.vtime = vtime
+        self.queue = collections.deque()
+        return
+
+
+
+class _PriorityClass(object):
+    """
+    internal use only
+    """
+    def __init__(self, name, weight, reserved):
+        self.name = name
+        self.weight = weight
+        self.reserved = reserved
+        # virtual time: slots given to the class divided by its weight
+        self.vtime = 0.0
+        # virtual time of the class tenants, of the last one served
+        self.tenant_vtime = 0.0
+        self.tenants = {}
+        self.waiting = 0
+        self.in_flight = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        return
+
+
+
+class PriorityScheduler(object):
+    """
+    Client wrapper running at most concurrency requests at the same time,
+    the waiting requests being given the free slots by weighted fair queuing:
+      - between priority classes, in proportion to their weights: with the
+        default classes, 8 interactive requests for 1 bulk request while
+        both are waiting
+      - between the tenants of a class, in proportion to their weights
+    A class may have slots reserved, which the other classes never use: a
+    burst of bulk requests can not delay the interactive ones beyond the
+    reserved slots. A class uses no more than its reserved slots plus the
+    slots reserved to no class.
+
+    Each request counts for one, whatever its size. Requests are sent through
+    a lane (see lane()), or through the scheduler itself in default_class.
+
+    Other methods are those of the wrapped client, without scheduling.
+    """
+    # methods sending a request which are scheduled
+    _scheduled = frozenset(['ping', 'version', 'stats', 'get_stats', 'scan_file', 'contscan_file', 'multiscan_file',
+                            'scan_stream', 'scan_iter', 'scan_fileobj', 'scan_fd', 'scan_path_fildes'])
+
+    def __init__(self, client, concurrency=8, classes=None, reserved=None, default_class='interactive',
+                 tenant_weights=None, max_waiting=None, wait_timeout=None):
+        """
+        client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool, ClamdCluster...
+        concurrency (int) : requests sent to clamd at the same time
+        classes (dict or None) : {name: weight} of the priority classes,
+          DEFAULT_CLASSES if None
+        reserved (dict or None) : {name: slots} reserved to priority classes
+        default_class (string) : class of the requests sent through the
+          scheduler itself
+        tenant_weights (dict or None) : {tenant: weight}, 1 for the tenants
+          not given
+        max_waiting (int or None) : requests allowed to wait for a slot in
+          each class, None for no limit
+        wait_timeout (float or None) : longest wait for a slot, None to wait
+          forever
+        """
+        if classes is None:
+            classes = DEFAULT_CLASSES
+        if reserved is None:
+            reserved = {}
+        assert isinstance(concurrency, int) and concurrency > 0, 'Wrong value for [concurrency], should be a positive int [was {0}]'.format(concurrency)
+        assert all(weight > 0 for weight in classes.values()), 'Wrong value for [classes], weights should be positive [was {0}]'.format(classes)
+        assert set(reserved) <= set(classes), 'Wrong value for [reserved], unknown classes {0}'.format(sorted(set(reserved) - set(classes)))
+        assert sum(reserved.values()) < concurrency, 'Wrong value for [reserved], at least one slot should not be reserved [was {0}]'.format(reserved)
+        assert default_class in classes, 'Wrong value for [default_class], should be one of {0} [was {1}]'.format(sorted(classes), default_class)
+
+        self.client = client
+        self.concurrency = concurrency
+        self.default_class = default_class
+        self.tenant_weights = dict(tenant_weights or {})
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+
+        self._lock = threading.Lock()
+        self._classes = dict((name, _PriorityClass(name, weight, reserved.get(name, 0))) for name, weight in classes.items())
+        self._shared = concurrency - sum(reserved.values())
+        self._in_flight = 0
+        self._vtime = 0.0
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.lane(self.default_class)._method(name)
+
+
+    def lane(self, priority_class, tenant=None):
+        """
+        Get a client whose requests are scheduled in a class, for a tenant
+
+        priority_class (string) : one of the classes
+        tenant (hashable or None) : tenant sending the requests
+
+        return: (SchedulerLane) with the methods of the wrapped client
+        """
+        assert priority_class in self._classes, 'Wrong value for [priority_class], should be one of {0} [was {1}]'.format(sorted(self._classes), priority_class)
+        return SchedulerLane(self, priority_class, tenant)
+
+
+    def scan_many(self, items, concurrency=None, ordered=False):
+        """
+        See pyclamd.scan_many, in default_class
+
+        concurrency (int or None) : number of threads, self.concurrency if None
+        """
+        return self.lane(self.default_class).scan_many(items, concurrency=concurrency, ordered=ordered)
+
+
+    def scheduler_stats(self):
+        """
+        Get statistics about scheduling
+
+        return: (dict) {class: stats}, stats being a dict with keys
+          - weight, reserved: settings of the class
+          - in_flight: requests of the class sent to clamd
+          - waiting: requests of the class waiting for a slot
+          - tenants: tenants with requests waiting
+          - dispatched: requests given a slot since creation
+          - rejected: requests refused with OverloadError
+          - wait_time: Histogram.as_dict() of the time spent waiting for a
+            slot (seconds)
+        """
+        with self._lock:
+            return dict((name, {
+                'weight': priority_class.weight,
+                'reserved': priority_class.reserved,
+                'in_flight': priority_class.in_flight,
+                'waiting': priority_class.waiting,
+                'tenants': len(priority_class.tenants),
+                'dispatched': priority_class.dispatched,
+                'rejected': priority_class.rejected,
+                'wait_time': priority_class.wait_time.as_dict(),
+                }) for name, priority_class in self._classes.items())
+
+
+    def _call(self, priority_class, tenant, method, *args, **kwargs):
+        """
+        internal use only
+        runs method once a slot is given to the request
+        """
+        ticket = self._acquire(priority_class, tenant)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._release(ticket)
+
+
+    def _acquire(self, name, tenant):
+        """
+        internal use only
+        """
+        priority_class = self._classes[name]
+        ticket = _Ticket(priority_class, tenant)
+        with self._lock:
+            if self.max_waiting is not None and priority_class.waiting >= self.max_waiting:
+                priority_class.rejected += 1
+                raise OverloadError('Too many {0} requests waiting for clamd ({1})'.format(name, priority_class.waiting))
+            self._enqueue(ticket)
+            self._dispatch()
+            if ticket.granted:
+                return ticket
+
+        if ticket.event.wait(self.wait_timeout):
+            return ticket
+        with self._lock:
+            if ticket.granted:
+                return ticket
+            self._dequeue(ticket)
+            priority_class.rejected += 1
+        raise OverloadError('No slot for clamd after {0}s'.format(self.wait_timeout))
+
+
+    def _release(self, ticket):
+        """
+        internal use only
+        """
+        with self._lock:
+            self._in_flight -= 1
+            ticket.priority_class.in_flight -= 1
+            self._dispatch()
+        return
+
+
+    def _enqueue(self, ticket):
+        """
+        internal use only
+        self._lock being held. A class or a tenant which had no request
+        waiting starts from the current virtual time, it does not get back
+        the slots it did not use.
+        """
+        priority_class = ticket.priority_class
+        if not priority_class.waiting:
+            priority_class.vtime = max(priority_class.vtime, self._vtime)
+        tenant = priority_class.tenants.get(ticket.tenant)
+        if tenant is None:
+            tenant = priority_class.tenants[ticket.tenant] = _Tenant(ticket.tenant, self.tenant_weights.get(ticket.tenant, 1), priority_class.tenant_vtime)
+        tenant.queue.append(ticket)
+        priority_class.waiting += 1
+        return
+
+
+    def _dequeue(self, ticket):
+        """
+        internal use only
+        removes a ticket which timed out, self._lock being held
+        """
+        priority_class = ticket.priority_class
+        tenant = priority_class.tenants[ticket.tenant]
+        tenant.queue.remove(ticket)
+        if not tenant.queue:
+            del priority_class.tenants[ticket.tenant]
+        priority_class.waiting -= 1
+        return
+
+
+    def _may_start(self, priority_class):
+        """
+        internal use only
+        True if a request of priority_class may be given a slot now, on its
+        reserved slots or on the shared ones
+        """
+        if priority_class.in_flight < priority_class.reserved:
+            return True
+        shared_in_use = sum(max(0, other.in_flight - other.reserved) for other in self._classes.values())
+        return shared_in_use < self._shared
+
+
+    def _dispatch(self):
+        """
+        internal use only
+        gives the free slots to the waiting requests, self._lock being held:
+        the class with the lowest virtual time, then its tenant with the
+        lowest virtual time
+        """
+        while self._in_flight < self.concurrency:
+            candidates = [priority_class for priority_class in self._classes.values() if priority_class.waiting and self._may_start(priority_class)]
+            if not candidates:
+                return
+            priority_class = min(candidates, key=lambda candidate: candidate.vtime)
+            tenant = min(priority_class.tenants.values(), key=lambda candidate: candidate.vtime)
+
+            self._vtime = priority_class.vtime
+            priority_class.vtime += 1.0 / priority_class.weight
+            priority_class.tenant_vtime = tenant.vtime
+            tenant.vtime += 1.0 / tenant.weight
+
+            ticket = tenant.queue.popleft()
+            if not tenant.queue:
+                del priority_class.tenants[tenant.name]
+            priority_class.waiting -= 1
+            priority_class.in_flight += 1
+            priority_class.dispatched += 1
+            priority_class.wait_time.add(time.time() - ticket.queued_at)
+            self._in_flight += 1
+            ticket.granted = True
+            ticket.event.set()
+        return
+
+
+
+class SchedulerLane(object):
+    """
+    Client sending its requests through a PriorityScheduler, in a priority
+    class and for a tenant, see PriorityScheduler.lane()
+    """
+    def __init__(self, scheduler, priority_class, tenant=None):
+        self.scheduler = scheduler
+        self.priority_class = priority_class
+        self.tenant = tenant
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._method(name)
+
+
+    def scan_many(self, items, concurrency=None, ordered=False):
+        """
+        See pyclamd.scan_many, in the class of the lane
+
+        concurrency (int or None) : number of threads, the concurrency of
+          the scheduler if None
+        """
+        return scan_many(self, items, concurrency=concurrency or self.scheduler.concurrency, ordered=ordered)
+
+
+    def _method(self, name):
+        """
+        internal use only
+        returns the attribute name of the wrapped client, scheduled if it is
+        a request
+        """
+        attribute = getattr(self.scheduler.client, name)
+        if name not in PriorityScheduler._scheduled:
+            return attribute
+
+        def scheduled(*args, **kwargs):
+            return self.scheduler._call(self.priority_class, self.tenant, attribute, *args, **kwargs)
+        return scheduled
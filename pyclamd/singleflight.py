@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+
+"""
+singleflight.py - identical scans running at the same time sent only once
+
+Usage :
+
+  import pyclamd
+  cd = pyclamd.SingleFlightClamd(pyclamd.ClamdAgnostic())
+  results = list(cd.scan_many([cd.EICAR()] * 20, concurrency=20))
+  cd.flight_stats()['shared'] > 0
+  # True
+"""
+
+import os
+import stat
+import sys
+import threading
+
+from .pyclamd import isstr, scan_many, _assert_stream_type
+from .cache import content_digest
+
+
+############################################################################
+
+
+def _file_key(file):
+    """
+    internal use only
+    returns the key of a scan of a regular file, its path and stat, None if
+    it is not a regular file
+    """
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return ('file', file, st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def _copy_result(result):
+    """
+    internal use only
+    each caller gets its own result dict
+    """
+    if result is None:
+        return None
+    return dict(result)
+
+
+
+class _Flight(object):
+    """
+    internal use only
+    a scan other callers with the same key wait for
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        return
+
+
+
+class SingleFlightClamd(object):
+    """
+    Client wrapper sending a scan only once when identical scans are
+    requested at the same time: the other callers wait for the result of the
+    first one, and get the same verdict or exception. Scans are identical
+    when:
+      - scan_stream: the buffers have the same content digest
+      - scan_file: a regular file has the same path and stat (device,
+        inode, size, modification and change times)
+    Nothing is kept once the scan is done, see CachingClamd for that.
+
+    Other methods are those of the wrapped client.
+    """
+    def __init__(self, client):
+        """
+        client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool,
+          CachingClamd...
+        """
+        self.client = client
+
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._calls = 0
+        self._shared = 0
+        return
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+
+    def scan_stream(self, buffer_to_test, *args, **kwargs):
+        """
+        See _ClamdGeneric.scan_stream, a buffer being scanned already is not
+        sent again
+        """
+        _assert_stream_type(buffer_to_test)
+        return self._do(('stream', content_digest(buffer_to_test)), self.client.scan_stream, buffer_to_test, *args, **kwargs)
+
+
+    def scan_file(self, file):
+        """
+        See _ClamdGeneric.scan_file, a file being scanned already is not
+        scanned again, directories always are
+        """
+        assert isstr(file), 'Wrong type for [file], should be a string [was {0}]'.format(type(file))
+        key = _file_key(file)
+        if key is None:
+            return self.client.scan_file(file)
+        return self._do(key, self.client.scan_file, file)
+
+
+    def scan_many(self, items, concurrency=8, ordered=False):
+        """
+        See pyclamd.scan_many, identical items being scanned once
+        """
+        return scan_many(self, items, concurrency=concurrency, ordered=ordered)
+
+
+    def flight_stats(self):
+        """
+        Get statistics about deduplication
+
+        return: (dict) with keys
+          - calls: scans requested
+          - shared: scans which waited for an identical one instead of
+            being sent
+          - in_flight: distinct scans running
+        """
+        with self._lock:
+            return {'calls': self._calls, 'shared': self._shared, 'in_flight': len(self._flights)}
+
+
+    def _do(self, key, scan, *args, **kwargs):
+        """
+        internal use only
+        runs scan, or waits for the running scan with the same key
+        """
+        with self._lock:
+            self._calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._shared += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return _copy_result(flight.result)
+
+        try:
+            flight.result = scan(*args, **kwargs)
+        except:
+            flight.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return _copy_result(flight.result)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# LICENSE:
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software  Foundation; either version 3 of the License, or (at your option) any
+# later version. See http://www.gnu.org/licenses/lgpl-3.0.txt.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 675 Mass Ave, Cambridge, MA 02139, USA.
+#------------------------------------------------------------------------------
+
+"""
+watch.py - scans files as they are written in directories (Linux inotify)
+
+Files closed after writing (IN_CLOSE_WRITE) or moved (IN_MOVED_TO) into a
+watched directory are scanned once they have been quiet for a debounce
+delay, on a pool of worker threads. A file whose size, mtime and inode did
+not change since its last scan is not scanned again.
+
+Usage :
+
+  import pyclamd
+  def on_result(path, result, error):
+      if result:
+          print(result)
+  watcher = pyclamd.Watcher(pyclamd.ClamdAgnostic(), ['/srv/uploads'], on_result, debounce=0.5)
+  watcher.start()
+  # writing an infected file in /srv/uploads prints
+  # {'/srv/uploads/EICAR': ('FOUND', 'Eicar-Test-Signature')}
+  watcher.stop()
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # Python2
+    import Queue as queue
+
+from .pyclamd import isstr
+
+
+############################################################################
+
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct('iIII')
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding with ctypes
+    """
+    def __init__(self):
+        """
+        May raise:
+          - OSError: if inotify is not available (not Linux, or limit of
+            instances reached)
+        """
+        name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        return
+
+
+    def add_watch(self, path, mask):
+        """
+        return: (int) watch descriptor of path
+
+        May raise:
+          - OSError: if path can not be watched
+        """
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8', 'surrogateescape') if str is not bytes else path
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+
+    def rm_watch(self, wd):
+        """
+        Remove a watch, errors ignored (the watch may be gone already)
+        """
+        self._libc.inotify_rm_watch(self.fd, wd)
+        return
+
+
+    def read(self):
+        """
+        return: (list) (wd, mask, cookie, name) of the pending events, name
+          being bytes, empty for the watched directory itself
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+
+    def close(self):
+        """
+        Close the inotify instance
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        return
+
+
+    def _raise(self, path=None):
+        """
+        internal use only
+        """
+        code = ctypes.get_errno()
+        if path is None:
+            raise OSError(code, os.strerror(code))
+        raise OSError(code, os.strerror(code), path)
+
+
+
+############################################################################
+
+
+def _signature(path):
+    """
+    internal use only
+    returns what tells that a file changed, None if it is not a regular file
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+
+class Watcher(object):
+    """
+    Scans the files written or moved into directories, with inotify
+
+    A file is scanned once no event was received for it during debounce
+    seconds, by one of concurrency worker threads, and the result given to
+    callback(path, result, error), result being the return value of
+    scan_file (or scan_fileobj with use_stream) and error the exception
+    raised by the scan or None. The callback is called from worker threads,
+    an exception it raises is counted in watch_stats() and does not stop
+    the worker.
+    """
+    def __init__(self, client, paths, callback, debounce=0.5, concurrency=4, recursive=True, use_stream=False):
+        """
+        client : ClamdUnixSocket, ClamdNetworkSocket, ClamdPool, ClamdCluster...
+          shared by the worker threads
+        paths (string or list) : directories to watch
+        callback (callable) : called as callback(path, result, error)
+        debounce (float) : seconds without event before a file is scanned
+        concurrency (int) : number of worker threads
+        recursive (bool) : watch subdirectories, including new ones
+        use_stream (bool) : send the content of files with INSTREAM instead of
+          their path, when clamd can not read them (other host, permissions)
+
+        May raise:
+          - OSError: if inotify is not available or a path can not be watched
+        """
+        if isstr(paths):
+            paths = [paths]
+        assert isinstance(debounce, (float, int)) and debounce >= 0, 'Wrong value for [debounce], should be a positive float [was {0}]'.format(debounce)
+        assert isinstance(concurrency, int) and concurrency > 0, 'Wrong value for [concurrency], should be a positive int [was {0}]'.format(concurrency)
+
+        self.client = client
+        self.callback = callback
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self.recursive = recursive
+        self.use_stream = use_stream
+
+        self._inotify = Inotify()
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._pending = {}
+        self._scanned = {}
+        self._work = queue.Queue()
+        self._stop = threading.Event()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._threads = []
+
+        self._events = 0
+        self._overflows = 0
+        self._scans = 0
+        self._unchanged = 0
+        self._errors = 0
+        self._callback_errors = 0
+        # last exception raised by callback, None if none
+        self.last_callback_error = None
+
+        self.roots = [os.path.abspath(path) for path in paths]
+        for root in self.roots:
+            self._add_tree(root, scan=False)
+        return
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return
+
+
+    def start(self):
+        """
+        Start watching in background threads
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return
+
+
+    def run(self):
+        """
+        Watch until stop() is called, in the calling thread
+        """
+        workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        try:
+            while not self._stop.is_set():
+                timeout = self._next_timeout()
+                readable = select.select([self._inotify.fd, self._wakeup_read], [], [], timeout)[0]
+                if self._inotify.fd in readable:
+                    self._handle(self._inotify.read())
+                self._flush_due()
+        finally:
+            for worker in workers:
+                self._work.put(None)
+            for worker in workers:
+                worker.join()
+            self._inotify.close()
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+        return
+
+
+    def stop(self):
+        """
+        Stop watching, the scans already started are completed
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        os.write(self._wakeup_write, b'x')
+        for thread in self._threads:
+            thread.join()
+        return
+
+
+    def watch_stats(self):
+        """
+        Get statistics about the watcher
+
+        return: (dict) with keys
+          - watches: directories watched
+          - events: inotify events received
+          - overflows: event queue overflows (the trees are then checked)
+          - pending: files waiting for their debounce delay or a worker
+          - scans: files scanned
+          - unchanged: files not scanned again because they did not change
+          - errors: scans which raised an exception
+          - callback_errors: calls of callback which raised an exception
+            (see last_callback_error)
+        """
+        with self._lock:
+            return {
+                'watches': len(self._watches),
+                'events': self._events,
+                'overflows': self._overflows,
+                'pending': len(self._pending) + self._work.qsize(),
+                'scans': self._scans,
+                'unchanged': self._unchanged,
+                'errors': self._errors,
+                'callback_errors': self._callback_errors,
+                }
+
+
+    def _add_tree(self, top, scan=True):
+        """
+        internal use only
+        watches top (and its subdirectories when recursive), files already
+        there being scanned if scan is True: they may have been written
+        before the watch was added
+        """
+        directories = [top]
+        while directories:
+            directory = directories.pop()
+            try:
+                wd = self._inotify.add_watch(directory, _WATCH_MASK)
+            except OSError:
+                if directory == top and top in self.roots:
+                    raise
+                continue
+            self._watches[wd] = directory
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    if self.recursive:
+                        directories.append(path)
+                elif scan:
+                    self._touch(path)
+        return
+
+
+    def _handle(self, events):
+        """
+        internal use only
+        """
+        with self._lock:
+            self._events += len(events)
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, every file is checked against its last scan
+                with self._lock:
+                    self._overflows += 1
+                for root in self.roots:
+                    self._add_tree(root)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if not name:
+                continue
+
+            path = os.path.join(directory, name.decode('utf-8', 'surrogateescape') if str is not bytes else name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive:
+                    self._add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._touch(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                with self._lock:
+                    self._pending.pop(path, None)
+                    self._scanned.pop(path, None)
+        return
+
+
+    def _touch(self, path):
+        """
+        internal use only
+        (re)starts the debounce delay of path
+        """
+        with self._lock:
+            self._pending[path] = time.time() + self.debounce
+        return
+
+
+    def _next_timeout(self):
+        """
+        internal use only
+        """
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(min(self._pending.values()) - time.time(), 0.0)
+
+
+    def _flush_due(self):
+        """
+        internal use only
+        queues the files whose debounce delay is over and which changed
+        since their last scan
+        """
+        now = time.time()
+        with self._lock:
+            due = [path for path, deadline in self._pending.items() if deadline <= now]
+            for path in due:
+                del self._pending[path]
+                signature = _signature(path)
+                if signature is None:
+                    continue
+                if self._scanned.get(path) == signature:
+                    self._unchanged += 1
+                    continue
+                self._scanned[path] = signature
+                self._work.put(path)
+        return
+
+
+    def _worker(self):
+        """
+        internal use only
+        """
+        while True:
+            path = self._work.get()
+            if path is None:
+                return
+            result, error = None, None
+            try:
+                if self.use_stream:
+                    with open(path, 'rb') as fileobj:
+                        result = self.client.scan_fileobj(fileobj)
+                    if result is not None:
+                        result = {path: result['stream']}
+                else:
+                    result = self.client.scan_file(path)
+            except Exception as e:
+                error = e
+                with self._lock:
+                    # scanned again on its next change
+                    self._scanned.pop(path, None)
+                    self._errors += 1
+            with self._lock:
+                self._scans += 1
+            try:
+                self.callback(path, result, error)
+            except Exception as e:
+                # the worker keeps running for the next files
+                with self._lock:
+                    self._callback_errors += 1
+                    self.last_callback_error = e
+
+
+
+def watch(client, paths, callback, debounce=0.5, concurrency=4, recursive=True, use_stream=False):
+    """
+    Scan the files written or moved into directories until interrupted, see
+    Watcher
+    """
+    watcher = Watcher(client, paths, callback, debounce=debounce, concurrency=concurrency, recursive=recursive, use_stream=use_stream)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return
@@ -20,7 +20,8 @@ setup (name = 'pyClamd',
        version = pyclamd.__version__,
        download_url = 'http://xael.org/norman/python/pyclamd/',
        package_dir={'pyclamd': 'pyclamd'},
-       packages=['pyclamd'],
+       packages=['pyclamd', 'pyclamd.bench', 'pyclamd.contrib'],
+       entry_points={'console_scripts': ['pyclamd = pyclamd.cli:main']},
 
        license ='License :: OSI Approved :: GNU Lesser General Public License v3 or later (LGPLv3+)',
        author = 'Alexandre Norman',
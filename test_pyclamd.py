@@ -1,3 +1,4 @@
+import sys
 import unittest
 import pyclamd
 
@@ -56,6 +57,577 @@ class Test_pyclamd(unittest.TestCase):
         return
 
 
+    def test_iter_contscan(self):
+        v = list(self.clamd.iter_contscan('/home/xael/ESPACE_KM/python/pyclamd/eicar.com'))
+        self.assertEqual(v, [('/home/xael/ESPACE_KM/python/pyclamd/eicar.com', 'FOUND', 'Eicar-Test-Signature')])
+        v = list(self.clamd.iter_multiscan('/home/xael/ESPACE_KM/python/pyclamd/probleme_data_clean.pdf', include_ok=True))
+        self.assertEqual(v, [('/home/xael/ESPACE_KM/python/pyclamd/probleme_data_clean.pdf', 'OK', '')])
+        return
+
+
+    def test_reply_decoder_split_reads(self):
+        decoder = pyclamd.ReplyDecoder()
+        self.assertEqual(decoder.feed(b'/tmp/a: OK\n/tmp/b: Eicar-Te'), [b'/tmp/a: OK'])
+        self.assertEqual(decoder.feed(b'st-Signature FOUND\0/tmp/c: lstat() failed: No such file or directory. ERROR'), [b'/tmp/b: Eicar-Test-Signature FOUND'])
+        self.assertEqual(decoder.flush(), [b'/tmp/c: lstat() failed: No such file or directory. ERROR'])
+        self.assertEqual(pyclamd.pyclamd._parse_reply(b'/tmp/c: lstat() failed: No such file or directory. ERROR'), ('/tmp/c', 'lstat() failed: No such file or directory.', 'ERROR'))
+        return
+
+
+    def test_get_stats(self):
+        v = self.clamd.get_stats()
+        self.assertTrue(v.threads_max > 0)
+        self.assertEqual(v.queue_length, len(v.queue_items))
+        poller = pyclamd.StatsPoller([self.clamd], start=False)
+        poller.poll()
+        self.assertEqual(len(poller.series(poller.names[0], 'threads_live')), 1)
+        return
+
+
+    def test_admission_controller(self):
+        cd = pyclamd.AdmissionController(self.clamd, initial_limit=2, max_limit=4, target_latency=10.0)
+        v = list(cd.scan_many([cd.EICAR()] * 20, concurrency=8))
+        self.assertEqual([r.result for r in v], [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 20)
+        stats = cd.admission_stats()
+        self.assertEqual(stats['admitted'], 20)
+        self.assertEqual(stats['limit'], 4)
+        return
+
+
+    def test_histogram_observer(self):
+        self.clamd.observer = pyclamd.HistogramObserver()
+        self.clamd.scan_stream(self.clamd.EICAR())
+        self.clamd.ping()
+        summary = self.clamd.observer.summary()
+        self.assertEqual(summary[('INSTREAM', '<1KiB')]['verdicts'], {'FOUND': 1})
+        self.assertEqual(summary[('PING', '<1KiB')]['count'], 1)
+        self.assertEqual(self.clamd.observer.histogram('INSTREAM', 'first_byte_time').count, 1)
+        return
+
+
+    def test_session_scan_stream_pipelined(self):
+        with self.clamd.session() as session:
+            requests = [session.submit_scan_stream(self.clamd.EICAR()) for i in range(10)]
+            requests.append(session.submit_scan_stream(b'no virus in this buffer'))
+            v = [request.result() for request in requests]
+        self.assertEqual(v[:10], [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 10)
+        self.assertEqual(v[10], None)
+        return
+
+
+    def test_pool_shared_between_threads(self):
+        import threading
+        pool = pyclamd.ClamdPool(self.clamd, maxsize=2)
+        results = []
+        def scan():
+            for i in range(10):
+                results.append(pool.scan_stream(self.clamd.EICAR()))
+        threads = [threading.Thread(target=scan) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+        self.assertEqual(results, [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 40)
+        self.assertEqual(pool.pool_stats()['checkouts'], 40)
+        self.assertTrue(pool.pool_stats()['misses'] <= 2)
+        return
+
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio client needs Python >= 3.5')
+    def test_async_scan_stream_chunks(self):
+        import asyncio
+        cd = pyclamd.AsyncClamdNetworkSocket(max_concurrency=2)
+        eicar = self.clamd.EICAR()
+        async def scan():
+            return await asyncio.gather(*[cd.scan_stream([eicar[:10], eicar[10:]]) for i in range(4)])
+        v = asyncio.get_event_loop().run_until_complete(scan())
+        self.assertEqual(v, [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 4)
+        return
+
+
+    def test_scan_stream_buffer_protocol_small_chunks(self):
+        file_data = bytearray(b'no virus' * 1000) + self.clamd.EICAR()
+        v = self.clamd.scan_stream(memoryview(file_data), chunk_size=7)
+        self.assertEqual(v, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        return
+
+
+    def test_scanning_writer(self):
+        import io
+        dest = io.BytesIO()
+        with pyclamd.ScanningWriter(self.clamd, dest) as writer:
+            writer.write(b'no virus' * 1000)
+            writer.write(self.clamd.EICAR())
+        self.assertEqual(writer.result, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        self.assertEqual(dest.getvalue(), b'no virus' * 1000 + self.clamd.EICAR())
+        return
+
+
+    def test_scan_fileobj(self):
+        import io
+        v = self.clamd.scan_fileobj(io.BytesIO(b'no virus' * 1000 + self.clamd.EICAR()), chunk_size=100)
+        self.assertEqual(v, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        return
+
+
+    def test_scan_path_fildes(self):
+        import os, tempfile
+        clamd = pyclamd.ClamdUnixSocket()
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, self.clamd.EICAR())
+        os.close(fd)
+        # readable by the client only
+        os.chmod(filename, 0o600)
+        try:
+            v = clamd.scan_path_fildes(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(v, {filename: ('FOUND', 'Eicar-Test-Signature')})
+        return
+
+
+    def test_caching_clamd(self):
+        cd = pyclamd.CachingClamd(self.clamd, pyclamd.VerdictCache(maxsize=10))
+        for i in range(3):
+            v = cd.scan_stream(self.clamd.EICAR())
+            self.assertEqual(v, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        stats = cd.cache.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        cd.reload()
+        self.assertEqual(len(cd.cache), 0)
+        return
+
+
+    def test_scan_tree_incremental(self):
+        import os, shutil, tempfile
+        top = tempfile.mkdtemp()
+        try:
+            open(os.path.join(top, 'EICAR'), 'wb').write(self.clamd.EICAR())
+            open(os.path.join(top, 'NO_EICAR'), 'wb').write(b'no virus in this file')
+            os.chmod(top, 0o755)
+            index = pyclamd.ScanIndex(':memory:')
+            expected = {os.path.join(top, 'EICAR'): ('FOUND', 'Eicar-Test-Signature')}
+            self.assertEqual(pyclamd.scan_tree_incremental(self.clamd, top, index), expected)
+            self.assertEqual(index.last_run['scanned'], 2)
+            self.assertEqual(pyclamd.scan_tree_incremental(self.clamd, top, index), expected)
+            self.assertEqual(index.last_run['scanned'], 0)
+            self.assertEqual(index.last_run['unchanged'], 2)
+        finally:
+            shutil.rmtree(top)
+        return
+
+
+    def test_scan_many(self):
+        items = [self.clamd.EICAR(), b'no virus in this buffer'] * 10
+        v = list(self.clamd.scan_many(items, concurrency=4, ordered=True))
+        self.assertEqual([r.index for r in v], list(range(20)))
+        self.assertEqual([r.result for r in v], [{'stream': ('FOUND', 'Eicar-Test-Signature')}, None] * 10)
+        self.assertEqual([r.error for r in v], [None] * 20)
+        return
+
+
+    def test_cluster_failover(self):
+        cluster = pyclamd.ClamdCluster([self.clamd, ('127.0.0.1', 1)], health_interval=None, eject_after=1)
+        cluster.check_health()
+        for i in range(4):
+            self.assertEqual(cluster.scan_stream(cluster.EICAR()), {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        stats = cluster.node_stats()
+        self.assertEqual(stats[0]['errors'], 0)
+        self.assertFalse(stats[1]['healthy'])
+        cluster.close()
+        return
+
+
+    def test_hedged_scan_stream(self):
+        cd = pyclamd.HedgedClamd([self.clamd, self.clamd], min_delay=0.0, max_delay=0.0, budget=1.0)
+        self.assertEqual(cd.scan_stream(cd.EICAR()), {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        self.assertEqual(cd.scan_stream(b'no virus in this buffer'), None)
+        self.assertEqual(cd.hedge_stats()['scans'], 2)
+        return
+
+
+
+class Test_fakeclamd(unittest.TestCase):
+    """
+    Test suite for pyclamd against the clamd emulator, no clamd needed
+    """
+
+    def setUp(self):
+        """
+        Set Up prior to testing
+        """
+        from pyclamd.bench import FakeClamd
+        self.fake = FakeClamd()
+        self.clamd = self.fake.client()
+        return
+
+    def tearDown(self):
+        """
+        Cleanup, post test
+        """
+        self.fake.close()
+        return
+
+
+    def test_commands(self):
+        self.assertTrue(self.clamd.ping())
+        self.assertEqual(self.clamd.version().split()[0], 'ClamAV')
+        self.assertEqual(self.clamd.scan_stream(self.clamd.EICAR()), {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        self.assertEqual(self.clamd.scan_stream(b'no virus in this buffer'), None)
+        self.assertEqual(self.clamd.get_stats().threads_max, 10)
+        return
+
+
+    def test_scan_directory(self):
+        import os, shutil, tempfile
+        top = tempfile.mkdtemp()
+        try:
+            open(os.path.join(top, 'EICAR'), 'wb').write(self.clamd.EICAR())
+            open(os.path.join(top, 'NO_EICAR'), 'wb').write(b'no virus in this file')
+            expected = {os.path.join(top, 'EICAR'): ('FOUND', 'Eicar-Test-Signature')}
+            self.assertEqual(self.clamd.multiscan_file(top), expected)
+            self.assertEqual(self.clamd.contscan_file(top), expected)
+        finally:
+            shutil.rmtree(top)
+        return
+
+
+    def test_scan_tree_incremental_commits(self):
+        import os, shutil, tempfile
+        top = tempfile.mkdtemp()
+        try:
+            for i in range(5):
+                open(os.path.join(top, str(i)), 'wb').write(b'no virus in this file')
+            index = pyclamd.ScanIndex(':memory:')
+            commits = []
+            commit = index.commit
+            index.commit = lambda: commits.append(len(commits)) or commit()
+            self.assertEqual(pyclamd.scan_tree_incremental(self.clamd, top, index, max_pending=1, commit_every=2), None)
+            # every 2 scans, then at the end of the run
+            self.assertEqual(len(commits), 3)
+            self.assertEqual(index.last_run['scanned'], 5)
+        finally:
+            shutil.rmtree(top)
+        return
+
+
+    def test_session_pipelined(self):
+        with self.clamd.session() as session:
+            requests = [session.submit_scan_stream(self.clamd.EICAR()) for i in range(10)]
+            v = [request.result() for request in requests]
+        self.assertEqual(v, [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 10)
+        return
+
+
+    def test_pool_chunk_size(self):
+        pool = pyclamd.ClamdPool(self.clamd, maxsize=2)
+        try:
+            v = pool.scan_stream(b'no virus' * 100 + self.clamd.EICAR(), chunk_size=7)
+            self.assertEqual(v, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+            self.assertEqual(pool.scan_stream(b'no virus', 3), None)
+        finally:
+            pool.close()
+        return
+
+
+    def test_benchmarks(self):
+        from pyclamd.bench import bench_connect, bench_instream
+        results = bench_connect(self.clamd, 10) + bench_instream(self.clamd, [1024 * 1024], [1024, 65536])
+        self.assertEqual([r['unit'] for r in results], ['calls/s'] * 3 + ['MB/s'] * 2)
+        self.assertTrue(all(r['value'] > 0 for r in results))
+        return
+
+
+    def test_cli(self):
+        import json, os, shutil, tempfile
+        from pyclamd.cli import main
+        top = tempfile.mkdtemp()
+        stdout = sys.stdout
+        try:
+            open(os.path.join(top, 'EICAR'), 'wb').write(self.clamd.EICAR())
+            open(os.path.join(top, 'NO_EICAR'), 'wb').write(b'no virus in this file')
+            sys.stdout = output = tempfile.TemporaryFile('w+')
+            status = main(['-e', self.fake.endpoint, '--mode', 'instream', '--summary', 'none', top])
+            output.seek(0)
+            records = sorted((json.loads(line) for line in output), key=lambda record: record['path'])
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(top)
+        self.assertEqual(status, 1)
+        self.assertEqual([(r['status'], r['reason'], r['method']) for r in records], [('FOUND', 'Eicar-Test-Signature', 'INSTREAM'), ('OK', None, 'INSTREAM')])
+        return
+
+
+    def test_limits(self):
+        import os, tempfile
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, b'StreamMaxLength 1000\nMaxFileSize 10M\n# MaxScanSize 1M\n')
+        os.close(fd)
+        try:
+            limits = pyclamd.limits_from_conf(filename)
+            self.assertEqual((limits.stream_max_length, limits.max_file_size, limits.max_scan_size), (1000, 10 * 1024 * 1024, 400 * 1024 * 1024))
+            self.clamd.limits = limits
+            commands = self.fake.commands
+            self.assertRaises(pyclamd.BufferTooLongError, self.clamd.scan_stream, b'x' * 2000)
+            self.assertEqual(self.fake.commands, commands)
+            with open(filename, 'wb') as fileobj:
+                fileobj.write(b'x' * 2000 + self.clamd.EICAR())
+            self.clamd.observer = pyclamd.HistogramObserver()
+            with open(filename, 'rb') as fileobj:
+                # scanned by path, clamd being local
+                self.assertEqual(self.clamd.scan_fileobj(fileobj), {'stream': ('FOUND', 'Eicar-Test-Signature')})
+            self.assertEqual([command for command, size in self.clamd.observer.summary()], ['SCAN'])
+        finally:
+            os.remove(filename)
+        return
+
+
+    def test_lazy_agnostic(self):
+        import os, tempfile
+        cd = pyclamd.ClamdNetworkSocket('127.0.0.1', 1, lazy=True)
+        self.assertRaises(pyclamd.ConnectionError, cd.ping)
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, 'TCPSocket {0}\nTCPAddr 0.0.0.0\n'.format(self.fake.address[1]).encode())
+        os.close(fd)
+        paths = pyclamd.CLAMD_CONF_PATHS[:]
+        pyclamd.CLAMD_CONF_PATHS[:] = [filename]
+        try:
+            connections = self.fake.connections
+            cd = pyclamd.ClamdAgnostic()
+            self.assertEqual((cd.host, cd.port), ('127.0.0.1', self.fake.address[1]))
+            self.assertEqual(self.fake.connections, connections)
+            self.assertTrue(cd.ping())
+        finally:
+            pyclamd.CLAMD_CONF_PATHS[:] = paths
+            os.remove(filename)
+        return
+
+
+    def test_pickle_and_fork(self):
+        import os, pickle
+        cd = pickle.loads(pickle.dumps(self.clamd))
+        self.assertEqual((cd.host, cd.port), (self.clamd.host, self.clamd.port))
+        self.assertTrue(cd.ping())
+        pool = pickle.loads(pickle.dumps(pyclamd.ClamdPool(self.clamd, maxsize=2)))
+        self.assertTrue(pool.ping())
+
+        if not hasattr(os, 'fork'):
+            return
+        session = self.clamd.session()
+        self.assertTrue(session.ping())
+        pid = os.fork()
+        if pid == 0:
+            # a session of the parent is unusable, the pool opens its own
+            # connection
+            try:
+                session.ping()
+                status = 1
+            except pyclamd.ConnectionError:
+                status = 0 if pool.pool_stats()['size'] == 0 and pool.scan_stream(pool.EICAR()) else 1
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(session.ping())
+        self.assertTrue(pool.ping())
+        session.close()
+        return
+
+
+    def test_middleware(self):
+        import io
+        from pyclamd.contrib import ScanningMiddleware
+        def app(environ, start_response):
+            body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+            start_response('200 OK', [])
+            return [body]
+        for spool in (True, False):
+            for body, status in [(b'x' * 1000 + self.clamd.EICAR(), '403 Forbidden'), (b'x' * 1000, '200 OK')]:
+                statuses = []
+                environ = {'wsgi.input': io.BytesIO(body), 'CONTENT_LENGTH': str(len(body))}
+                response = ScanningMiddleware(app, self.clamd, spool=spool, chunk_size=100)(environ, lambda s, headers, exc_info=None: statuses.append(s))
+                data = b''.join(response)
+                self.assertEqual(statuses[-1], status)
+                if status == '200 OK':
+                    self.assertEqual(data, body)
+                    self.assertEqual(environ['pyclamd.scan'].size, len(body))
+        return
+
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio client needs Python >= 3.5')
+    def test_async_middleware(self):
+        import asyncio
+        from pyclamd.contrib import AsyncScanningMiddleware
+        host, port = self.fake.address
+        cd = pyclamd.AsyncClamdNetworkSocket(host, port, limits=pyclamd.ClamdLimits(stream_max_length=10000))
+        async def app(scope, receive, send):
+            body = b''
+            while True:
+                message = await receive()
+                body += message.get('body', b'')
+                if not message.get('more_body', False):
+                    break
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': body})
+        async def request(middleware, body, chunked):
+            if chunked:
+                headers = [(b'transfer-encoding', b'chunked')]
+            else:
+                headers = [(b'content-length', str(len(body)).encode('ascii'))]
+            scope = {'type': 'http', 'headers': headers}
+            messages = [{'type': 'http.request', 'body': body[i:i + 100], 'more_body': i + 100 < len(body)} for i in range(0, len(body), 100)]
+            async def receive():
+                return messages.pop(0)
+            sent = []
+            async def send(message):
+                sent.append(message)
+            await middleware(scope, receive, send)
+            return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+        loop = asyncio.new_event_loop()
+        try:
+            for spool in (True, False):
+                middleware = AsyncScanningMiddleware(app, cd, spool=spool, chunk_size=100, queue_size=2)
+                for chunked in (True, False):
+                    for body, status in [(b'x' * 1000 + cd.EICAR(), 403), (b'x' * 1000, 200)]:
+                        v = loop.run_until_complete(request(middleware, body, chunked))
+                        self.assertEqual(v[0], status)
+                        if status == 200:
+                            self.assertEqual(v[1], body)
+                # refused from its Content-Length, before clamd is reached
+                commands = self.fake.commands
+                self.assertEqual(loop.run_until_complete(request(middleware, b'x' * 20000, False))[0], 413)
+                self.assertEqual(self.fake.commands, commands)
+        finally:
+            loop.close()
+        return
+
+
+    def test_priority_scheduler(self):
+        import threading, time
+        self.fake.latency = 0.01
+        release = threading.Event()
+        def held():
+            # the request keeps its slot until release is set
+            yield b'no virus'
+            release.wait()
+        def wait_for(scheduler, name, key, value):
+            while scheduler.scheduler_stats()[name][key] != value:
+                time.sleep(0.001)
+
+        scheduler = pyclamd.PriorityScheduler(self.clamd, concurrency=1)
+        order = []
+        def scan(priority_class):
+            scheduler.lane(priority_class, tenant='t').scan_stream(b'no virus')
+            order.append(priority_class[0])
+        blocker = threading.Thread(target=scheduler.lane('interactive').scan_iter, args=(held(),))
+        blocker.start()
+        wait_for(scheduler, 'interactive', 'in_flight', 1)
+        threads = [threading.Thread(target=scan, args=(priority_class,)) for priority_class in ['bulk'] * 9 + ['interactive'] * 9]
+        for thread in threads:
+            thread.start()
+        wait_for(scheduler, 'bulk', 'waiting', 9)
+        wait_for(scheduler, 'interactive', 'waiting', 9)
+        release.set()
+        for thread in threads + [blocker]:
+            thread.join()
+        # 8 interactive requests for 1 bulk request
+        self.assertEqual(order[:9].count('i'), 8)
+        stats = scheduler.scheduler_stats()
+        self.assertEqual((stats['interactive']['dispatched'], stats['bulk']['dispatched']), (10, 9))
+        self.assertEqual(stats['interactive']['wait_time']['count'], 10)
+        self.assertEqual((stats['bulk']['in_flight'], stats['bulk']['waiting'], stats['bulk']['tenants']), (0, 0, 0))
+
+        # a burst of bulk requests does not use the reserved slot
+        release.clear()
+        scheduler = pyclamd.PriorityScheduler(self.clamd, concurrency=3, reserved={'interactive': 1})
+        threads = [threading.Thread(target=scheduler.lane('bulk', tenant='nightly').scan_iter, args=(held(),)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        wait_for(scheduler, 'bulk', 'waiting', 4)
+        v = scheduler.lane('interactive', tenant='alice').scan_stream(self.clamd.EICAR())
+        self.assertEqual(v, {'stream': ('FOUND', 'Eicar-Test-Signature')})
+        stats = scheduler.scheduler_stats()
+        self.assertEqual((stats['bulk']['in_flight'], stats['bulk']['waiting']), (2, 4))
+        self.assertEqual((stats['interactive']['dispatched'], stats['interactive']['reserved']), (1, 1))
+        release.set()
+        for thread in threads:
+            thread.join()
+        stats = scheduler.scheduler_stats()
+        self.assertEqual((stats['bulk']['dispatched'], stats['bulk']['in_flight'], stats['bulk']['waiting']), (6, 0, 0))
+        return
+
+
+    def test_hedged_scan_stream(self):
+        from pyclamd.bench import FakeClamd
+        self.fake.latency = 0.2
+        with FakeClamd() as fast:
+            cd = pyclamd.HedgedClamd([self.clamd, fast.client()], max_delay=0.05, budget=1.0)
+            self.assertEqual(cd.scan_stream(self.clamd.EICAR()), {'stream': ('FOUND', 'Eicar-Test-Signature')})
+            stats = cd.hedge_stats()
+            self.assertEqual((stats['scans'], stats['hedges'], stats['hedge_wins']), (1, 1, 1))
+            # the latency seen by the caller, hedging delay included
+            self.assertTrue(cd.latencies.percentile(100) >= 0.05)
+        return
+
+
+    def test_single_flight(self):
+        self.fake.latency = 0.05
+        cd = pyclamd.SingleFlightClamd(self.clamd)
+        commands = self.fake.commands
+        v = [r.result for r in cd.scan_many([self.clamd.EICAR()] * 10 + [b'no virus'] * 10, concurrency=20, ordered=True)]
+        self.assertEqual(v, [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 10 + [None] * 10)
+        self.assertEqual(self.fake.commands - commands, 2)
+        self.assertEqual(cd.flight_stats(), {'calls': 20, 'shared': 18, 'in_flight': 0})
+        return
+
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), 'inotify needs Linux')
+    def test_watcher(self):
+        import os, shutil, tempfile, time
+        top = tempfile.mkdtemp()
+        results = []
+        try:
+            with pyclamd.Watcher(self.clamd, top, lambda path, result, error: results.append((path, result, error)), debounce=0.05) as watcher:
+                for i in range(3):
+                    open(os.path.join(top, 'EICAR'), 'wb').write(self.clamd.EICAR())
+                open(os.path.join(top, 'NO_EICAR'), 'wb').write(b'no virus in this file')
+                for i in range(100):
+                    if len(results) == 2:
+                        break
+                    time.sleep(0.02)
+                stats = watcher.watch_stats()
+        finally:
+            shutil.rmtree(top)
+        self.assertEqual(sorted(results, key=lambda r: r[0]), [(os.path.join(top, 'EICAR'), {os.path.join(top, 'EICAR'): ('FOUND', 'Eicar-Test-Signature')}, None), (os.path.join(top, 'NO_EICAR'), None, None)])
+        self.assertEqual(stats['scans'], 2)
+        return
+
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), 'inotify needs Linux')
+    def test_watcher_callback_error(self):
+        import os, shutil, tempfile, time
+        top = tempfile.mkdtemp()
+        results = []
+        def callback(path, result, error):
+            results.append(path)
+            if len(results) == 1:
+                raise ValueError('callback failure')
+        try:
+            with pyclamd.Watcher(self.clamd, top, callback, debounce=0.02, concurrency=1) as watcher:
+                for name in ('first', 'second'):
+                    open(os.path.join(top, name), 'wb').write(self.clamd.EICAR())
+                    for i in range(100):
+                        if os.path.join(top, name) in results:
+                            break
+                        time.sleep(0.02)
+                stats = watcher.watch_stats()
+        finally:
+            shutil.rmtree(top)
+        self.assertEqual(results, [os.path.join(top, 'first'), os.path.join(top, 'second')])
+        self.assertEqual(stats['callback_errors'], 1)
+        self.assertTrue(isinstance(watcher.last_callback_error, ValueError))
+        return
+
+
 
 def main():
     unittest.main()